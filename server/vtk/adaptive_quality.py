@@ -0,0 +1,249 @@
+r"""
+    Quality of interactive frames adapted to the link of a connection.
+
+    With a fixed quality and ratio, a reader on a slow VPN gets frames
+    faster than the link carries them: they queue in the socket and the
+    view stalls behind the mouse. A QualityController measures, per
+    connection:
+
+        round trip  the client acknowledges every frame by echoing its
+                    localTime ("viewport.image.push.ack"), frames not yet
+                    acknowledged count with their age
+        encode time and frame size of the frames sent
+
+    and every CONTROL_INTERVAL moves quality, render ratio and frame rate
+    one step towards a target latency. Too slow: the ratio goes down first
+    if encoding takes half the target, otherwise the quality, then the
+    ratio, then the frame rate. Headroom: the frame rate comes back first,
+    then the ratio, then the quality. With MAX_IN_FLIGHT frames
+    unacknowledged no further animation frame is rendered; frames not
+    acknowledged within LOST_AFTER are given up on.
+
+    The settings only cap the frames of an interaction; the still frame at
+    the end keeps the quality and ratio the client asked for. Clients that
+    do not acknowledge frames leave the controller disabled, see
+    vtk_override_protocols.py.
+
+    Every client of a shared session gets every frame published, so
+    ClientControllers keeps one QualityController per client, all of them
+    count each frame, and interactive frames follow the slowest client. A
+    client that acknowledged nothing for FORGET_AFTER while frames were in
+    flight is taken as gone.
+"""
+import collections
+import time
+
+DEFAULT_TARGET_LATENCY = 150
+
+CONTROL_INTERVAL = 0.5
+
+# Weight of a new sample in the moving averages
+SMOOTHING = 0.2
+
+MAX_IN_FLIGHT = 3
+
+# Milliseconds after which a frame is taken as lost, its age as round trip
+LOST_AFTER = 2000
+
+# Seconds without an acknowledgement after which a client is forgotten
+FORGET_AFTER = 10
+
+# Too slow above, headroom below these shares of the target
+SLOW = 1.25
+FAST = 0.75
+
+(MIN_QUALITY, MAX_QUALITY, QUALITY_STEP) = (30, 100, 10)
+(MIN_RATIO, MAX_RATIO, RATIO_STEP) = (0.5, 1.0, 0.1)
+(MIN_FPS, MAX_FPS, FPS_STEP) = (5.0, 30.0, 5.0)
+
+# -----------------------------------------------------------------------------
+
+def average(value, sample):
+    return sample if value is None else value + SMOOTHING * (sample - value)
+
+class QualityController(object):
+    def __init__(self, targetLatency=DEFAULT_TARGET_LATENCY, clock=time.time):
+        self.clock = clock
+        self.enabled = False
+        self.targetLatency = targetLatency
+        self.reset()
+
+    def reset(self):
+        self.quality = MAX_QUALITY
+        self.ratio = MAX_RATIO
+        self.fps = MAX_FPS
+        # Moving averages, milliseconds and bytes
+        self.roundTrip = None
+        self.encodeTime = None
+        self.frameSize = None
+        # localTime of the frames not acknowledged yet, oldest first
+        self.inFlight = collections.deque()
+        self.lastControl = self.clock()
+        self.lastAcknowledged = self.clock()
+        self.headroom = 0
+
+    def enable(self, targetLatency=DEFAULT_TARGET_LATENCY):
+        self.enabled = True
+        self.targetLatency = targetLatency
+        self.reset()
+
+    def disable(self):
+        self.enabled = False
+        self.reset()
+
+    def now(self):
+        """
+        The localTime of a frame sent now, in milliseconds
+        """
+        return int(round(self.clock() * 1000))
+
+    def sent(self, localTime, size, encodeTime):
+        self.inFlight.append(localTime)
+        self.frameSize = average(self.frameSize, size)
+        self.encodeTime = average(self.encodeTime, encodeTime)
+        self.control()
+
+    def acknowledged(self, localTime):
+        """
+        The client shows the frame of localTime, and so all before it
+        """
+        if localTime not in self.inFlight:
+            return
+        self.lastAcknowledged = self.clock()
+        while self.inFlight and self.inFlight[0] <= localTime:
+            self.inFlight.popleft()
+        self.roundTrip = average(self.roundTrip, self.now() - localTime)
+        self.control()
+
+    def congested(self):
+        self.expire()
+        return self.enabled and len(self.inFlight) >= MAX_IN_FLIGHT
+
+    def expire(self):
+        now = self.now()
+        while self.inFlight and now - self.inFlight[0] > LOST_AFTER:
+            self.roundTrip = average(self.roundTrip, now - self.inFlight.popleft())
+
+    def latency(self):
+        """
+        The round trip, at least the age of the oldest frame in flight
+        """
+        latency = self.roundTrip or 0
+        if self.inFlight:
+            latency = max(latency, self.now() - self.inFlight[0])
+        return latency
+
+    def control(self):
+        if not self.enabled or self.clock() - self.lastControl < CONTROL_INTERVAL:
+            return
+        self.lastControl = self.clock()
+        self.expire()
+        latency = self.latency()
+        if latency > SLOW * self.targetLatency:
+            self.headroom = 0
+            self.slower()
+        elif latency < FAST * self.targetLatency:
+            # Twice in a row, so one fast frame does not bring a step back
+            self.headroom += 1
+            if self.headroom >= 2:
+                self.headroom = 0
+                self.faster()
+        else:
+            self.headroom = 0
+
+    def slower(self):
+        encodeBound = (self.encodeTime or 0) > 0.5 * self.targetLatency
+        if encodeBound and self.ratio > MIN_RATIO:
+            self.ratio = max(MIN_RATIO, round(self.ratio - RATIO_STEP, 2))
+        elif self.quality > MIN_QUALITY:
+            self.quality = max(MIN_QUALITY, self.quality - QUALITY_STEP)
+        elif self.ratio > MIN_RATIO:
+            self.ratio = max(MIN_RATIO, round(self.ratio - RATIO_STEP, 2))
+        elif self.fps > MIN_FPS:
+            self.fps = max(MIN_FPS, self.fps - FPS_STEP)
+
+    def faster(self):
+        if self.fps < MAX_FPS:
+            self.fps = min(MAX_FPS, self.fps + FPS_STEP)
+        elif self.ratio < MAX_RATIO:
+            self.ratio = min(MAX_RATIO, round(self.ratio + RATIO_STEP, 2))
+        elif self.quality < MAX_QUALITY:
+            self.quality = min(MAX_QUALITY, self.quality + QUALITY_STEP)
+
+    def describe(self):
+        return {
+            'enabled': self.enabled,
+            'targetLatency': self.targetLatency,
+            'quality': self.quality,
+            'ratio': self.ratio,
+            'fps': self.fps,
+            'roundTrip': self.roundTrip,
+            'encodeTime': self.encodeTime,
+            'frameSize': self.frameSize,
+            'inFlight': len(self.inFlight),
+        }
+
+# -----------------------------------------------------------------------------
+
+class ClientControllers(object):
+    """
+    The QualityController of every client that enabled it, by client id.
+    quality, ratio and fps are those of the slowest client.
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.controllers = {}
+
+    @property
+    def enabled(self):
+        return len(self.controllers) > 0
+
+    def enable(self, client, targetLatency=DEFAULT_TARGET_LATENCY):
+        controller = QualityController(targetLatency, self.clock)
+        controller.enable(targetLatency)
+        self.controllers[client] = controller
+
+    def disable(self, client):
+        self.controllers.pop(client, None)
+
+    def now(self):
+        return int(round(self.clock() * 1000))
+
+    def sent(self, localTime, size, encodeTime):
+        self.forget()
+        for controller in self.controllers.values():
+            controller.sent(localTime, size, encodeTime)
+
+    def acknowledged(self, client, localTime):
+        if client in self.controllers:
+            self.controllers[client].acknowledged(localTime)
+
+    def congested(self):
+        return any([controller.congested() for controller in self.controllers.values()])
+
+    def forget(self):
+        for (client, controller) in list(self.controllers.items()):
+            if controller.inFlight and self.clock() - controller.lastAcknowledged > FORGET_AFTER:
+                del self.controllers[client]
+
+    @property
+    def quality(self):
+        return min([MAX_QUALITY] + [controller.quality for controller in self.controllers.values()])
+
+    @property
+    def ratio(self):
+        return min([MAX_RATIO] + [controller.ratio for controller in self.controllers.values()])
+
+    @property
+    def fps(self):
+        return min([MAX_FPS] + [controller.fps for controller in self.controllers.values()])
+
+    def describe(self, client=None):
+        """
+        The settings frames follow, and those of the controller of client
+        """
+        description = { 'enabled': self.enabled, 'clients': len(self.controllers),
+                        'quality': self.quality, 'ratio': self.ratio, 'fps': self.fps }
+        if client in self.controllers:
+            description['client'] = self.controllers[client].describe()
+        return description
@@ -0,0 +1,94 @@
+r"""
+    Latency of interactive frames on slow links, with and without the
+    adaptive quality controller.
+
+        $ python bench_adaptive_quality.py
+        $ python bench_adaptive_quality.py --target 100 --frame-size 400 --seconds 30
+
+    Simulates an interaction of --seconds on the links of LINKS with a
+    simulated clock: the animation loop asks for frames at the controller's
+    frame rate, a frame of --frame-size kB at quality 100 and ratio 1
+    shrinks with the square of the ratio and of the quality, takes
+    --encode-time ms at ratio 1, queues on the link and is acknowledged one
+    way delay after it arrived. Reported per link are the settings the
+    controller ends with, the frames shown and their latency, from the
+    request to the acknowledgement, over the last second.
+
+    A model, not a measurement: it shows how the controller settles and
+    helps tuning the constants of adaptive_quality.py. Needs no VTK.
+"""
+import argparse
+
+import adaptive_quality
+
+# Links to simulate, name and bytes per second
+LINKS = [
+    ('VPN 10 Mbit/s', 10e6 / 8),
+    ('DSL 40 Mbit/s', 40e6 / 8),
+    ('WAN 100 Mbit/s', 100e6 / 8),
+    ('LAN 1 Gbit/s', 1e9 / 8),
+]
+
+STEP = 0.005
+
+# -----------------------------------------------------------------------------
+
+class Clock(object):
+    def __init__(self):
+        self.time = 1000.0
+
+    def __call__(self):
+        return self.time
+
+def simulate(rate, args, adaptive):
+    """
+    Return the controller and the (shown, latency) of the frames shown
+    """
+    clock = Clock()
+    controller = adaptive_quality.QualityController(clock=clock)
+    if adaptive:
+        controller.enable(args.target)
+    end = clock.time + args.seconds
+    (linkFree, nextFrame) = (clock.time, clock.time)
+    (inFlight, shown) = ([], [])
+    while clock.time < end:
+        for (arrival, localTime) in [frame for frame in inFlight if frame[0] <= clock.time]:
+            inFlight.remove((arrival, localTime))
+            controller.acknowledged(localTime)
+            shown.append((arrival, arrival * 1000 - localTime))
+
+        if clock.time >= nextFrame:
+            nextFrame = clock.time + 1.0 / controller.fps
+            if not controller.congested():
+                size = args.frame_size * 1024 * controller.ratio ** 2 * (0.3 + 0.7 * (controller.quality / 100.0) ** 2)
+                encodeTime = args.encode_time * controller.ratio ** 2
+                localTime = controller.now()
+                controller.sent(localTime, size, encodeTime)
+                linkFree = max(linkFree, clock.time + encodeTime / 1000.0) + size / rate
+                inFlight.append((linkFree + args.delay / 1000.0, localTime))
+        clock.time += STEP
+    return (controller, [latency for (time, latency) in shown if time > end - 1.0])
+
+def report(name, controller, latencies):
+    average = sum(latencies) / len(latencies) if latencies else float('nan')
+    print("  %-15s quality %3d  ratio %.1f  fps %4.1f  %3d frames/s  latency %8.0f ms" % (
+        name, controller.quality, controller.ratio, controller.fps, len(latencies), average))
+
+# =============================================================================
+# Main
+# =============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulated latency of interactive frames on slow links")
+    parser.add_argument("--target", type=int, default=adaptive_quality.DEFAULT_TARGET_LATENCY,
+                        help="target latency in ms")
+    parser.add_argument("--frame-size", type=float, default=250, help="kB of a frame at quality 100, ratio 1")
+    parser.add_argument("--encode-time", type=float, default=40, help="ms to encode a frame at ratio 1")
+    parser.add_argument("--delay", type=float, default=20, help="one way delay in ms")
+    parser.add_argument("--seconds", type=float, default=20, help="length of the interaction")
+    args = parser.parse_args()
+
+    for (mode, adaptive) in [('fixed quality', False), ('adaptive, target %d ms' % args.target, True)]:
+        print(mode)
+        for (name, rate) in LINKS:
+            report(name, *simulate(rate, args, adaptive))
@@ -0,0 +1,42 @@
+r"""
+    Helpers the bench_*.py scripts share.
+
+        memory(pid)                          (rss, pss, uss) of a process,
+                                             from /proc, Linux only
+        measure(childSource, uid, options)   load a series in a fresh
+                                             process and return its result
+"""
+import io
+import json
+import os
+import subprocess
+import sys
+
+# -----------------------------------------------------------------------------
+
+def memory(pid):
+    """
+    Return (rss, pss, uss) in kB of a process
+    """
+    values = {}
+    with io.open("/proc/%d/smaps_rollup" % pid, encoding="utf-8") as smaps:
+        for line in smaps:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                values[parts[0].rstrip(':')] = int(parts[1])
+    uss = values.get("Private_Clean", 0) + values.get("Private_Dirty", 0)
+    return (values.get("Rss", 0), values.get("Pss", 0), uss)
+
+def measure(childSource, uid, options):
+    """
+    Run childSource, with %(here)s the directory of the scripts, in a
+    fresh Python on the command line options + [uid] and return the JSON
+    of the last line it prints
+    """
+    proc = subprocess.Popen([ sys.executable, "-c", childSource % { 'here': os.path.dirname(os.path.abspath(__file__)) } ]
+                            + options + [ uid ], stdout=subprocess.PIPE)
+    output = proc.communicate()[0]
+    if proc.returncode:
+        raise RuntimeError("Loading series %s failed" % uid)
+    # The loader prints its timings first, the result is the last line
+    return json.loads(output.decode('utf-8').strip().split('\n')[-1])
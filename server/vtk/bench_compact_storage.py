@@ -0,0 +1,104 @@
+r"""
+    Memory of series loaded rescaled and with --compact-storage.
+
+        $ vtkpython bench_compact_storage.py 1.2.3.4 1.2.3.5
+        $ vtkpython bench_compact_storage.py --catalog /.../catalog.db --all --limit 20
+
+    Every series is loaded twice, each time in a fresh process: 'rescaled'
+    as the MPR and 4-view servers do by default, where vtkDICOMReader applies
+    slope and intercept and may widen the voxel type, and 'compact', which
+    keeps the stored values and only carries the rescale. Reported per
+    series and mode are the voxel type, the size of the voxels, the peak
+    resident memory of the process and the load time.
+
+    Needs the image catalog and the DICOM files, and Linux for the peak
+    memory. No series cache is used, every load decodes.
+"""
+import argparse
+
+import bench_common
+
+CHILD_SOURCE = """
+import argparse
+import json
+import resource
+import sys
+import time
+sys.path.insert(0, %(here)r)
+
+import vtk
+
+import series_loader
+
+parser = argparse.ArgumentParser()
+series_loader.add_arguments(parser)
+parser.add_argument("uid")
+args = parser.parse_args()
+series_loader.configure(args)
+
+begin = time.time()
+series = series_loader.loadSeries(args.uid)
+elapsed = time.time() - begin
+scalars = series.GetOutput().GetPointData().GetScalars()
+print(json.dumps({
+    'type': scalars.GetDataTypeAsString(),
+    'bytes': scalars.GetNumberOfValues() * scalars.GetDataTypeSize(),
+    'peak': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'seconds': elapsed,
+    'rescale': list(series.rescale),
+}))
+"""
+
+MODES = [
+    ('rescaled', []),
+    ('compact', ["--compact-storage"]),
+]
+
+# -----------------------------------------------------------------------------
+
+def report(uid, results):
+    print("%s" % uid)
+    for (mode, result) in results:
+        print("  %-9s %-15s voxels %8d kB  peak RSS %8d kB  %6.2fs  rescale %g, %g" % (
+            mode, result['type'], result['bytes'] // 1024, result['peak'], result['seconds'],
+            result['rescale'][0], result['rescale'][1]))
+    (rescaled, compact) = (results[0][1], results[1][1])
+    print("  compact saves %d kB voxels, %d kB peak" % (
+        (rescaled['bytes'] - compact['bytes']) // 1024, rescaled['peak'] - compact['peak']))
+
+# =============================================================================
+# Main
+# =============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render process memory of rescaled and compact series")
+    parser.add_argument("series", nargs="*", help="uids of the series to load")
+    parser.add_argument("--all", action="store_true", help="load the series of the catalog")
+    parser.add_argument("--limit", type=int, default=10, help="series to load with --all")
+    parser.add_argument("--catalog", default=None, help="SQLite image catalog, default the MySQL database")
+    parser.add_argument("--header-index", default=None, help="header index to take the slice order from")
+    args = parser.parse_args()
+
+    options = []
+    if args.catalog:
+        options += [ "--catalog", args.catalog ]
+    if args.header_index:
+        options += [ "--header-index", args.header_index ]
+
+    series = list(args.series)
+    if args.all:
+        import image_catalog
+        catalog = image_catalog.SQLiteCatalog(args.catalog) if args.catalog else image_catalog.MySQLCatalog()
+        series += catalog.listSeries()[:args.limit]
+        catalog.close()
+
+    totals = dict((mode, 0) for (mode, flags) in MODES)
+    for uid in series:
+        results = [ (mode, bench_common.measure(CHILD_SOURCE, uid, options + flags)) for (mode, flags) in MODES ]
+        report(uid, results)
+        for (mode, result) in results:
+            totals[mode] += result['bytes']
+
+    if series:
+        print("voxels of all series: %s" % ', '.join(
+            ["%s %d kB" % (mode, totals[mode] // 1024) for (mode, flags) in MODES]))
@@ -0,0 +1,182 @@
+r"""
+    Decode throughput of compressed series, threads against processes.
+
+        $ vtkpython bench_decode_codecs.py --slices 200 --size 512
+        $ vtkpython bench_decode_codecs.py --codecs rle jpegls --processes 8
+
+    Writes a synthetic CT series (int16, --size x --size x --slices, a few
+    spheres of different density in noise) once per codec with pydicom and
+    loads it through series_loader twice, each time in a fresh process:
+    'threads' with --decode-processes -1, 'processes' with --decode-processes
+    --processes. Reported per codec and mode are the load time, decoded MB/s
+    and slices/s.
+
+    Needs pydicom with the encoders of the codecs (numpy for RLE, pyjpegls
+    for JPEG-LS, pylibjpeg-openjpeg for JPEG 2000; codecs without one are
+    skipped) and a vtkDICOM built with the matching decoders. No MySQL, the
+    series go into a SQLite catalog.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+
+import numpy
+
+import bench_common
+
+CHILD_SOURCE = """
+import argparse
+import json
+import sys
+import time
+sys.path.insert(0, %(here)r)
+
+import vtk
+
+import series_loader
+
+parser = argparse.ArgumentParser()
+series_loader.add_arguments(parser)
+parser.add_argument("uid")
+args = parser.parse_args()
+series_loader.configure(args)
+
+begin = time.time()
+series = series_loader.loadSeries(args.uid)
+elapsed = time.time() - begin
+scalars = series.GetOutput().GetPointData().GetScalars()
+print(json.dumps({
+    'bytes': scalars.GetNumberOfValues() * scalars.GetDataTypeSize(),
+    'slices': series.GetOutput().GetDimensions()[2],
+    'seconds': elapsed,
+}))
+"""
+
+# (name, transfer syntax uid, pydicom encoding plugin or None for the default)
+CODECS = [
+    ('rle', '1.2.840.10008.1.2.5', None),
+    ('jpegls', '1.2.840.10008.1.2.4.80', 'pyjpegls'),
+    ('j2k', '1.2.840.10008.1.2.4.90', 'pylibjpeg'),
+]
+
+# -----------------------------------------------------------------------------
+
+def phantom(size, slices, seed=0):
+    """
+    Return (slices, size, size) int16 HU + 1024 values: air, a body and a few
+    spheres, with noise so the codecs have something to do
+    """
+    random = numpy.random.RandomState(seed)
+    (z, y, x) = numpy.ogrid[:slices, :size, :size]
+    volume = numpy.zeros((slices, size, size), dtype=numpy.int16)
+    body = (x - size / 2.0) ** 2 + (y - size / 2.0) ** 2 < (size * 0.45) ** 2
+    volume[numpy.broadcast_to(body, volume.shape)] = 1024
+    for (center, radius, value) in [((0.5, 0.4, 0.4), 0.15, 1024 + 60),
+                                    ((0.3, 0.6, 0.55), 0.1, 1024 + 700),
+                                    ((0.7, 0.5, 0.3), 0.08, 1024 - 500)]:
+        inside = ((z - center[0] * slices) ** 2 + (y - center[1] * size) ** 2 + (x - center[2] * size) ** 2
+                  < (radius * size) ** 2)
+        volume[inside] = value
+    volume += random.normal(0, 15, volume.shape).astype(numpy.int16)
+    return numpy.clip(volume, 0, 4095).astype(numpy.int16)
+
+def writeSeries(directory, uid, volume, syntax, plugin):
+    """
+    Write one compressed file per slice, return the paths
+    """
+    import pydicom
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import generate_uid
+
+    study = generate_uid()
+    paths = []
+    for i in range(volume.shape[0]):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        ds = Dataset()
+        ds.file_meta = meta
+        ds.SOPClassUID = meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.StudyInstanceUID = study
+        ds.SeriesInstanceUID = uid
+        ds.Modality = 'CT'
+        ds.InstanceNumber = i + 1
+        ds.ImagePositionPatient = [0.0, 0.0, float(i)]
+        ds.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+        ds.PixelSpacing = [0.7, 0.7]
+        ds.SliceThickness = 1.0
+        ds.RescaleSlope = 1
+        ds.RescaleIntercept = -1024
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.Rows, ds.Columns = volume.shape[1:]
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.PixelData = volume[i].tobytes()
+        if plugin:
+            ds.compress(syntax, encoding_plugin=plugin)
+        else:
+            ds.compress(syntax)
+        path = os.path.join(directory, "%04d.dcm" % i)
+        ds.save_as(path, enforce_file_format=True)
+        paths.append(path)
+    return paths
+
+def report(codec, compressed, results):
+    (threads, processes) = (results[0][1], results[1][1])
+    print("%s, %d kB compressed, %d kB decoded" % (codec, compressed // 1024, threads['bytes'] // 1024))
+    for (mode, result) in results:
+        print("  %-9s %6.2fs  %8.1f MB/s  %8.1f slices/s" % (
+            mode, result['seconds'], result['bytes'] / result['seconds'] / 1e6, result['slices'] / result['seconds']))
+    print("  processes %.2fx threads" % (threads['seconds'] / processes['seconds']))
+
+# =============================================================================
+# Main
+# =============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Decode throughput of compressed series, threads and processes")
+    parser.add_argument("--slices", type=int, default=200, help="slices of the series")
+    parser.add_argument("--size", type=int, default=512, help="rows and columns of a slice")
+    parser.add_argument("--codecs", nargs="*", default=[name for (name, syntax, plugin) in CODECS],
+                        help="codecs to measure")
+    parser.add_argument("--processes", type=int, default=0, help="decode processes, 0 for one per core")
+    args = parser.parse_args()
+
+    import image_catalog
+
+    workdir = tempfile.mkdtemp(prefix="bench_codecs_")
+    try:
+        catalogPath = os.path.join(workdir, "catalog.db")
+        catalog = image_catalog.SQLiteCatalog(catalogPath)
+        volume = phantom(args.size, args.slices)
+        series = []
+        for (name, syntax, plugin) in CODECS:
+            if name not in args.codecs:
+                continue
+            directory = os.path.join(workdir, name)
+            os.makedirs(directory)
+            uid = "1.2.826.0.1.3680043.2.1125.%d" % len(series)
+            try:
+                paths = writeSeries(directory, uid, volume, syntax, plugin)
+            except Exception as e:
+                print("%s skipped, no encoder: %s" % (name, e))
+                continue
+            catalog.addSeries(uid, paths)
+            series.append((name, uid, sum(os.path.getsize(path) for path in paths)))
+        catalog.close()
+
+        options = [ "--catalog", catalogPath ]
+        for (name, uid, compressed) in series:
+            # Warm the page cache, both modes then read the files from memory
+            bench_common.measure(CHILD_SOURCE, uid, options + [ "--decode-processes", "-1" ])
+            results = [ ('threads', bench_common.measure(CHILD_SOURCE, uid, options + [ "--decode-processes", "-1" ])),
+                        ('processes', bench_common.measure(CHILD_SOURCE, uid, options + [ "--decode-processes", str(args.processes) ])) ]
+            report(name, compressed, results)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
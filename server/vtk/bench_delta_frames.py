@@ -0,0 +1,120 @@
+r"""
+    Bytes of full frames and of delta frames while scrolling slices.
+
+        $ vtkpython bench_delta_frames.py
+        $ vtkpython bench_delta_frames.py --size 1200 900 --frames 60 --encoder png
+
+    Renders the 4-view layout offscreen, an axial, a sagittal and a coronal
+    slice and a surface, and scrolls the slice of one quadrant by one for
+    every frame, like a user paging through the series. Every frame is
+    encoded in full and as a delta_frames frame with the same encoder.
+    Reported are the bytes per frame of both, the ratio, and the encode time.
+
+    No DICOM files are needed; the volume is the phantom of
+    bench_frame_encoders.py.
+"""
+import argparse
+import time
+
+import vtk
+
+import delta_frames
+import frame_encoders
+from bench_frame_encoders import phantom
+
+# Quadrants of vtk_4view.py: (xmin, ymin, xmax, ymax)
+VIEWPORTS = [(0.0, 0.5, 0.5, 1.0), (0.5, 0.5, 1.0, 1.0), (0.0, 0.0, 0.5, 0.5), (0.5, 0.0, 1.0, 0.5)]
+
+# -----------------------------------------------------------------------------
+
+def layout(image, size):
+    """
+    Return the render window and the image actors of the slices
+    """
+    window = vtk.vtkRenderWindow()
+    window.SetOffScreenRendering(1)
+    window.SetSize(size)
+    (x, y, z) = image.GetDimensions()
+    actors = []
+    for (i, viewport) in enumerate(VIEWPORTS):
+        renderer = vtk.vtkRenderer()
+        renderer.SetViewport(viewport)
+        window.AddRenderer(renderer)
+        if i < 3:
+            actor = vtk.vtkImageActor()
+            actor.GetMapper().SetInputData(image)
+            actor.GetProperty().SetColorWindow(400)
+            actor.GetProperty().SetColorLevel(40)
+            actor.SetDisplayExtent([(0, x - 1, 0, y - 1, z // 2, z // 2), (x // 2, x // 2, 0, y - 1, 0, z - 1),
+                                    (0, x - 1, y // 2, y // 2, 0, z - 1)][i])
+            renderer.AddActor(actor)
+            actors.append(actor)
+            camera = renderer.GetActiveCamera()
+            camera.SetFocalPoint(x / 2.0, y / 2.0, z / 2.0)
+            camera.SetPosition([(x / 2.0, y / 2.0, z * 3.0), (x * 3.0, y / 2.0, z / 2.0), (x / 2.0, -y * 2.0, z / 2.0)][i])
+            camera.SetViewUp([(0, 1, 0), (0, 0, 1), (0, 0, 1)][i])
+        else:
+            contour = vtk.vtkFlyingEdges3D()
+            contour.SetInputData(image)
+            contour.SetValue(0, 300)
+            mapper = vtk.vtkPolyDataMapper()
+            mapper.SetInputConnection(contour.GetOutputPort())
+            surface = vtk.vtkActor()
+            surface.SetMapper(mapper)
+            renderer.AddActor(surface)
+        renderer.ResetCamera()
+    return (window, actors)
+
+def scroll(actor, step):
+    """
+    Move the slice of an axial image actor by step
+    """
+    extent = list(actor.GetDisplayExtent())
+    extent[4] += step
+    extent[5] += step
+    actor.SetDisplayExtent(extent)
+
+# =============================================================================
+# Main
+# =============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bytes of full and delta frames while scrolling slices")
+    parser.add_argument("--size", type=int, nargs=2, default=[1000, 800], help="width and height of the window")
+    parser.add_argument("--frames", type=int, default=40, help="frames to scroll")
+    parser.add_argument("--encoder", default='jpeg', help="encoder of the frames and tiles")
+    parser.add_argument("--quality", type=int, default=80, help="quality of lossy encoders")
+    args = parser.parse_args()
+
+    encoder = frame_encoders.get(args.encoder)
+    if not encoder:
+        parser.error("Unknown encoder %s, known are %s" % (args.encoder,
+                     ", ".join([e.name for e in frame_encoders.available()])))
+
+    (window, actors) = layout(phantom(), args.size)
+    delta = delta_frames.DeltaEncoder()
+    (full, partial, fullTime, partialTime, keyframes) = (0, 0, 0.0, 0.0, 0)
+    for i in range(args.frames + 1):
+        if i:
+            scroll(actors[0], 1 if (i // 20) % 2 == 0 else -1)
+        frame = frame_encoders.grabFrame(window)
+
+        begin = time.time()
+        size = len(encoder.encode(frame, args.quality))
+        encoded = time.time()
+        (data, keyframe, rectangles) = delta.encode(frame, encoder, args.quality)
+        end = time.time()
+        # The first frame is a keyframe in both modes
+        if i:
+            full += size
+            partial += len(data) if data else 0
+            fullTime += encoded - begin
+            partialTime += end - encoded
+            keyframes += keyframe
+
+    print("%d x %d, %d frames scrolling the axial quadrant, encoder %s" % (args.size[0], args.size[1],
+                                                                          args.frames, encoder.name))
+    print("  full    %8.1f kB/frame  %6.2f ms/frame" % (full / 1024.0 / args.frames, fullTime * 1000 / args.frames))
+    print("  delta   %8.1f kB/frame  %6.2f ms/frame  %d keyframes" % (partial / 1024.0 / args.frames,
+                                                                     partialTime * 1000 / args.frames, keyframes))
+    print("  delta frames are %.1fx smaller" % (float(full) / max(1, partial)))
@@ -0,0 +1,135 @@
+r"""
+    Bytes per frame and encode time of the frame encoders.
+
+        $ vtkpython bench_frame_encoders.py
+        $ vtkpython bench_frame_encoders.py --size 1024 768 --frames 50 --quality 80
+
+    Renders two synthetic scenes offscreen, a grayscale slice like the MPR
+    views and a shaded, colored surface like volume rendering, and encodes
+    --frames frames of each with every encoder of frame_encoders. 'jpeg' is
+    encoded with vtkJPEGWriter here, the web application uses the same
+    library. Reported per scene and encoder are the bytes per frame, the
+    encode time per frame and the time a frame takes on the links in LINKS,
+    encode plus transfer.
+
+    Encoders whose module is missing (Pillow for webp, lz4 for rgb+lz4) are
+    not measured. No DICOM files are needed.
+"""
+import argparse
+import time
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+import frame_encoders
+
+# Links to compare on, name and bytes per second
+LINKS = [
+    ('VPN 10 Mbit/s', 10e6 / 8),
+    ('WAN 100 Mbit/s', 100e6 / 8),
+    ('LAN 1 Gbit/s', 1e9 / 8),
+]
+
+# -----------------------------------------------------------------------------
+
+def phantom(size=128):
+    """
+    A CT-like volume: body, organs of different density and noise
+    """
+    random = numpy.random.RandomState(0)
+    (z, y, x) = numpy.ogrid[:size, :size, :size]
+    volume = numpy.full((size, size, size), -1000, dtype=numpy.int16)
+    volume[((x - size / 2.0) ** 2 + (y - size / 2.0) ** 2 < (size * 0.45) ** 2).repeat(size, axis=0)] = 0
+    for (center, radius, value) in [((0.5, 0.4, 0.4), 0.15, 60), ((0.3, 0.6, 0.55), 0.1, 700),
+                                    ((0.7, 0.5, 0.3), 0.08, -500)]:
+        volume[(z - center[0] * size) ** 2 + (y - center[1] * size) ** 2 + (x - center[2] * size) ** 2
+               < (radius * size) ** 2] = value
+    volume += random.normal(0, 20, volume.shape).astype(numpy.int16)
+
+    image = vtk.vtkImageData()
+    image.SetDimensions(size, size, size)
+    image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(volume.ravel(), deep=True, array_type=vtk.VTK_SHORT))
+    return image
+
+def sliceScene(renderer, image):
+    (x, y, z) = image.GetDimensions()
+    actor = vtk.vtkImageActor()
+    actor.GetMapper().SetInputData(image)
+    actor.SetDisplayExtent(0, x - 1, 0, y - 1, z // 2, z // 2)
+    actor.GetProperty().SetColorWindow(400)
+    actor.GetProperty().SetColorLevel(40)
+    renderer.AddActor(actor)
+
+def surfaceScene(renderer, image):
+    contour = vtk.vtkFlyingEdges3D()
+    contour.SetInputData(image)
+    contour.SetValue(0, 300)
+    contour.SetValue(1, -300)
+    mapper = vtk.vtkPolyDataMapper()
+    mapper.SetInputConnection(contour.GetOutputPort())
+    mapper.SetScalarRange(-300, 300)
+    actor = vtk.vtkActor()
+    actor.SetMapper(mapper)
+    renderer.AddActor(actor)
+    renderer.SetBackground(0.1, 0.1, 0.2)
+
+SCENES = [
+    ('mpr', sliceScene),
+    ('vrt', surfaceScene),
+]
+
+def render(scene, image, size, frames):
+    """
+    Return frames RGB images of a scene, the camera turning a little each time
+    """
+    renderer = vtk.vtkRenderer()
+    window = vtk.vtkRenderWindow()
+    window.SetOffScreenRendering(1)
+    window.SetSize(size)
+    window.AddRenderer(renderer)
+    scene(renderer, image)
+    renderer.ResetCamera()
+
+    result = []
+    for i in range(frames):
+        renderer.GetActiveCamera().Azimuth(0 if scene is sliceScene else 2)
+        renderer.GetActiveCamera().Roll(2 if scene is sliceScene else 0)
+        frame = vtk.vtkImageData()
+        frame.DeepCopy(frame_encoders.grabFrame(window))
+        result.append(frame)
+    return result
+
+def measure(encoder, frames, quality):
+    """
+    Return (bytes per frame, seconds per frame)
+    """
+    size = 0
+    begin = time.time()
+    for frame in frames:
+        size += len(encoder.encode(frame, quality))
+    return (size / float(len(frames)), (time.time() - begin) / len(frames))
+
+# =============================================================================
+# Main
+# =============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bytes per frame and encode time of the frame encoders")
+    parser.add_argument("--size", type=int, nargs=2, default=[800, 600], help="width and height of a frame")
+    parser.add_argument("--frames", type=int, default=20, help="frames per scene")
+    parser.add_argument("--quality", type=int, default=80, help="quality of the lossy encoders")
+    args = parser.parse_args()
+
+    image = phantom()
+    print("%d x %d frames, quality %d, raw RGB %d kB" % (args.size[0], args.size[1], args.quality,
+                                                          args.size[0] * args.size[1] * 3 // 1024))
+    for (name, scene) in SCENES:
+        frames = render(scene, image, args.size, args.frames)
+        print("%s" % name)
+        print("  %-10s %10s %10s  %s" % ("encoder", "kB/frame", "ms/frame",
+                                         "  ".join(["%16s" % link for (link, rate) in LINKS])))
+        for encoder in frame_encoders.available():
+            (size, seconds) = measure(encoder, frames, args.quality)
+            print("  %-10s %10.1f %10.2f  %s" % (encoder.name, size / 1024, seconds * 1000,
+                  "  ".join(["%13.1f ms" % ((seconds + size / rate) * 1000) for (link, rate) in LINKS])))
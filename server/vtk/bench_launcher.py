@@ -0,0 +1,268 @@
+r"""
+    Load test the launcher without VTK or MySQL.
+
+        $ python bench_launcher.py --cycles 200 --concurrency 16 --delay 0.2
+
+    Starts launcher.py with a generated configuration whose application is a
+    stub script: it prints the ready line after --delay seconds and then
+    idles until it is stopped. Every cycle launches a session (POST), reads
+    it back (GET) and deletes it (DELETE), --concurrency cycles at a time.
+
+    Reported are the cycles per second, the latency of every request type
+    and three leak checks once all cycles are done: every port is free again
+    (from the launcher /metrics page), the proxy mapping is empty and no
+    stub process is left running. No two live sessions may share a port.
+"""
+import argparse
+import io
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError, URLError
+
+from concurrent.futures import ThreadPoolExecutor
+
+STUB_SOURCE = """
+import sys
+import time
+
+# A pooled process gets its session on stdin before it loads anything
+if '--pooled' in sys.argv:
+    if not sys.stdin.readline():
+        sys.exit(0)
+
+time.sleep(%f)
+print("Starting factory")
+sys.stdout.flush()
+time.sleep(3600)
+"""
+
+# -----------------------------------------------------------------------------
+
+def freePort():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def writeSetup(workdir, args):
+    stub = os.path.join(workdir, "bench_stub.py")
+    with io.open(stub, "w", encoding="utf-8") as stub_file:
+        stub_file.write(STUB_SOURCE % args.delay)
+
+    logDir = os.path.join(workdir, "logs")
+    os.mkdir(logDir)
+
+    port = freePort()
+    app = { "cmd": [ sys.executable, stub, "--port", "${port}", "--content", "${uid}" ], "ready_line": "Starting factory" }
+    if args.pool_size:
+        app["pool_size"] = args.pool_size
+    config = {
+        "configuration": {
+            "host": "localhost", "port": port, "endpoint": "paraview",
+            "proxy_file": os.path.join(workdir, "proxy.txt"), "sessionURL": "ws://${host}:${port}/ws",
+            "timeout": 30, "log_dir": logDir, "fields": [], "load_interval": 0
+        },
+        "resources": [ { "host": "localhost", "port_range": [ 20000, 20000 + args.ports - 1 ] } ],
+        "properties": {},
+        "apps": { "stub": app }
+    }
+    configPath = os.path.join(workdir, "bench.config")
+    with io.open(configPath, "w", encoding="utf-8") as config_file:
+        config_file.write(json.dumps(config))
+
+    return config, configPath, stub
+
+def call(method, url, payload=None):
+    """
+    Return (status, parsed body, seconds) of one request
+    """
+    data = json.dumps(payload).encode('utf-8') if payload is not None else None
+    request = Request(url, data=data)
+    request.get_method = lambda: method
+    begin = time.time()
+    try:
+        response = urlopen(request, timeout=120)
+        status, body = response.getcode(), response.read()
+    except HTTPError as e:
+        status, body = e.code, e.read()
+    elapsed = time.time() - begin
+    try:
+        body = json.loads(body.decode('utf-8'))
+    except ValueError:
+        body = body.decode('utf-8', 'replace')
+    return (status, body, elapsed)
+
+def waitForLauncher(url, launcher, timeout=30):
+    end = time.time() + timeout
+    while time.time() < end:
+        if launcher.poll() is not None:
+            return False
+        try:
+            urlopen(url, timeout=1)
+            return True
+        except HTTPError:
+            return True
+        except (URLError, socket.error):
+            time.sleep(0.1)
+    return False
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def metrics(url):
+    values = {}
+    text = urlopen(url, timeout=10).read().decode('utf-8')
+    for line in text.splitlines():
+        match = re.match(r'^(\w+)(\{[^}]*\})? (\S+)$', line)
+        if match:
+            values[match.group(1) + (match.group(2) or '')] = float(match.group(3))
+    return values
+
+def stubProcesses(stub):
+    count = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with io.open("/proc/%s/cmdline" % pid, mode="rb") as cmdline:
+                if stub.encode('utf-8') in cmdline.read():
+                    count += 1
+        except (IOError, OSError):
+            pass
+    return count
+
+# -----------------------------------------------------------------------------
+
+class Cycles(object):
+    def __init__(self, base):
+        self.base = base
+        self.lock = threading.Lock()
+        self.latency = { 'POST': [], 'GET': [], 'DELETE': [] }
+        self.errors = {}
+        self.livePorts = set()
+        self.sharedPorts = 0
+
+    def error(self, what):
+        with self.lock:
+            self.errors[what] = self.errors.get(what, 0) + 1
+
+    def run(self, index):
+        status, session, elapsed = call('POST', self.base, { "application": "stub", "uid": "bench-%d" % index })
+        if status != 200:
+            self.error("POST %d" % status)
+            return
+        port = int(session['sessionURL'].rsplit(':', 1)[1].split('/')[0])
+        with self.lock:
+            self.latency['POST'].append(elapsed)
+            if port in self.livePorts:
+                self.sharedPorts += 1
+            self.livePorts.add(port)
+
+        url = "%s/%s" % (self.base, session['id'])
+        status, body, elapsed = call('GET', url)
+        if status != 200:
+            self.error("GET %d" % status)
+        with self.lock:
+            self.latency['GET'].append(elapsed)
+            # Leave the set before DELETE frees the port for the next launch
+            self.livePorts.discard(port)
+
+        status, body, elapsed = call('DELETE', url)
+        if status != 200:
+            self.error("DELETE %d" % status)
+        with self.lock:
+            self.latency['DELETE'].append(elapsed)
+
+# =============================================================================
+# Main
+# =============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Launcher load test with a stub render app")
+    parser.add_argument("--cycles", type=int, default=200, help="POST/GET/DELETE cycles to run")
+    parser.add_argument("--concurrency", type=int, default=16, help="cycles in flight at once")
+    parser.add_argument("--delay", type=float, default=0.2, help="seconds the stub app takes to print its ready line")
+    parser.add_argument("--ports", type=int, default=64, help="ports in the resource range")
+    parser.add_argument("--pool-size", type=int, default=0, help="pool_size of the stub app")
+    parser.add_argument("--keep", action="store_true", help="keep the working directory with the logs")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_launcher_")
+    launcher = None
+    try:
+        config, configPath, stub = writeSetup(workdir, args)
+        root = "http://localhost:%d" % config['configuration']['port']
+        here = os.path.dirname(os.path.abspath(__file__))
+        with io.open(os.path.join(workdir, "launcher.out"), "wb") as launcher_out:
+            launcher = subprocess.Popen([ sys.executable, os.path.join(here, "launcher.py"), configPath ],
+                                        cwd=here, stdout=launcher_out, stderr=subprocess.STDOUT)
+        if not waitForLauncher(root + "/metrics", launcher):
+            print("The launcher did not come up, see %s" % os.path.join(workdir, "launcher.out"))
+            args.keep = True
+            sys.exit(1)
+        # Let a pool fill up before timing
+        time.sleep(args.delay + 0.5 if args.pool_size else 0)
+
+        cycles = Cycles(root + "/paraview")
+        begin = time.time()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(cycles.run, range(args.cycles)))
+        elapsed = time.time() - begin
+
+        # DELETE stops processes asynchronously, give them a moment
+        time.sleep(0.5)
+        values = metrics(root + "/metrics")
+        free = values.get('launcher_ports_free{host="localhost"}', -1)
+        pooled = values.get('launcher_pool_idle{app="stub"}', 0)
+        with io.open(config['configuration']['proxy_file'], encoding="utf-8") as proxy_file:
+            mappings = len([line for line in proxy_file if line.strip()])
+        running = stubProcesses(stub) - int(pooled)
+
+        print("%d cycles, %d concurrent, stub ready after %.2fs, %d ports, pool %d" % (
+            args.cycles, args.concurrency, args.delay, args.ports, args.pool_size))
+        print("%.1f cycles/s (%.2fs)" % (args.cycles / elapsed, elapsed))
+        for method in ['POST', 'GET', 'DELETE']:
+            latency = cycles.latency[method]
+            print("%-7s %5d ok  p50 %8.1f ms  p99 %8.1f ms  max %8.1f ms" % (
+                method, len(latency), 1000 * percentile(latency, 0.5), 1000 * percentile(latency, 0.99),
+                1000 * (max(latency) if latency else float('nan'))))
+        for what in sorted(cycles.errors):
+            print("error   %s x %d" % (what, cycles.errors[what]))
+
+        leaks = []
+        if free != args.ports - pooled:
+            leaks.append("%d of %d ports free (%d pooled)" % (free, args.ports, pooled))
+        if mappings:
+            leaks.append("%d proxy mappings left" % mappings)
+        if running:
+            leaks.append("%d stub processes still running" % running)
+        if cycles.sharedPorts:
+            leaks.append("%d launches got the port of a live session" % cycles.sharedPorts)
+        print("leaks:  %s" % ('; '.join(leaks) if leaks else "none"))
+        if leaks or cycles.errors:
+            sys.exit(1)
+    finally:
+        if launcher and launcher.poll() is None:
+            launcher.terminate()
+            launcher.wait()
+        if args.keep:
+            print("Kept %s" % workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
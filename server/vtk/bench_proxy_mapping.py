@@ -0,0 +1,94 @@
+r"""
+    Measure what one session create or delete costs in the proxy mapping.
+
+        $ python bench_proxy_mapping.py --sessions 10 100 1000
+
+    For every mapping type the mapping is filled with N active sessions,
+    then sessions are created and deleted one at a time on top of them.
+    'full rewrite' is the former behaviour of rewriting the whole text file
+    in place on every change. The dbm figures depend on the backend Python
+    finds (gdbm, ndbm or the slow pure Python dbm.dumb).
+"""
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+import launcher
+
+# -----------------------------------------------------------------------------
+
+class FullRewriteTXT(launcher.ProxyMappingManager):
+    def __init__(self, file_path, pattern="%s %s:%d\n"):
+        self.file_path = file_path
+        self.pattern = pattern
+        self.sessions = {}
+
+    def add(self, id, host, port):
+        self.sessions[id] = { 'host': host, 'port': port }
+        self._write()
+
+    def remove(self, id):
+        del self.sessions[id]
+        self._write()
+
+    def update(self, sessions):
+        self.sessions = dict(sessions)
+        self._write()
+
+    def _write(self):
+        with io.open(self.file_path, "w", encoding="utf-8") as map_file:
+            for id in self.sessions:
+                map_file.write(self.pattern % (id, self.sessions[id]['host'], self.sessions[id]['port']))
+
+MAPPINGS = [
+    ('full rewrite', FullRewriteTXT),
+    ('txt', launcher.ProxyMappingManagerTXT),
+    ('dbm', launcher.ProxyMappingManagerDBM),
+    ('sqlite', launcher.ProxyMappingManagerSQLite),
+]
+
+def measure(mapping_class, workdir, active, repeat):
+    mapping = mapping_class(os.path.join(workdir, "proxy-%s" % uuid.uuid4().hex))
+    sessions = {}
+    for i in range(active):
+        id = str(uuid.uuid1())
+        sessions[id] = { 'host': 'localhost', 'port': 9000 + i }
+    mapping.update(sessions)
+
+    ids = [str(uuid.uuid1()) for i in range(repeat)]
+    begin = time.time()
+    for i, id in enumerate(ids):
+        mapping.add(id, 'localhost', 20000 + i)
+    created = time.time() - begin
+
+    begin = time.time()
+    for id in ids:
+        mapping.remove(id)
+    deleted = time.time() - begin
+
+    return 1e6 * created / repeat, 1e6 * deleted / repeat
+
+# =============================================================================
+# Main
+# =============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Proxy mapping update benchmark")
+    parser.add_argument("--sessions", type=int, nargs="*", default=[10, 100, 1000],
+                        help="number of concurrent sessions already in the mapping")
+    parser.add_argument("--repeat", type=int, default=200, help="creates and deletes measured per run")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_proxy_")
+    try:
+        print("%-14s %10s %16s %16s" % ("mapping", "sessions", "create [us]", "delete [us]"))
+        for active in args.sessions:
+            for name, mapping_class in MAPPINGS:
+                created, deleted = measure(mapping_class, workdir, active, args.repeat)
+                print("%-14s %10d %16.1f %16.1f" % (name, active, created, deleted))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,118 @@
+r"""
+    Memory of render processes on the same series, with and without shared
+    volumes.
+
+        $ vtkpython bench_shared_volumes.py --sessions 4 --slices 200
+
+    Starts --sessions processes one after the other that each load the same
+    synthetic series (int16, 512 x 512 x --slices) and read every voxel, as
+    a renderer would. 'private' processes each keep their own copy; 'shared'
+    ones go through shared_volumes, so only the first decodes and the others
+    map its pages. Reported is the memory of every process once it holds the
+    volume: RSS counts shared pages fully, PSS splits them between the
+    processes mapping them, USS is what the process owns alone. The cost of
+    an additional session is its USS.
+
+    Afterwards all processes exit and the registry must be empty again.
+    Memory figures come from /proc and need Linux; no DICOM files, MySQL or
+    vtkDICOM are needed.
+"""
+import argparse
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import bench_common
+
+CHILD_SOURCE = """
+import sys
+sys.path.insert(0, %(here)r)
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+import shared_volumes
+
+def load():
+    volume = numpy.empty((%(slices)d, 512, 512, 1), dtype=numpy.int16)
+    for z in range(volume.shape[0]):
+        volume[z] = z
+    image = vtk.vtkImageData()
+    image.SetExtent(0, 511, 0, 511, 0, volume.shape[0] - 1)
+    scalars = numpy_support.numpy_to_vtk(volume.reshape(-1, 1), deep=False, array_type=vtk.VTK_SHORT)
+    image.GetPointData().SetScalars(scalars)
+    return (image, None, None, None, "decoded")
+
+files = ["bench-%%d" %% i for i in range(%(slices)d)]
+if sys.argv[1] == "shared":
+    registry = shared_volumes.SharedVolumes(sys.argv[2])
+    image = registry.attach("bench", True, files, load)[0]
+else:
+    image = load()[0]
+
+# Touch every voxel like a first render would
+numpy_support.vtk_to_numpy(image.GetPointData().GetScalars()).sum()
+print("ready")
+sys.stdout.flush()
+sys.stdin.readline()
+"""
+
+# -----------------------------------------------------------------------------
+
+def run(script, mode, registry, sessions):
+    procs = []
+    try:
+        for i in range(sessions):
+            proc = subprocess.Popen([ sys.executable, script, mode, registry ],
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            if proc.stdout.readline().strip() != b"ready":
+                raise RuntimeError("%s session %d did not load the volume" % (mode, i))
+            procs.append(proc)
+        # Measure once all sessions hold the volume, PSS depends on the others
+        return [bench_common.memory(proc.pid) for proc in procs]
+    finally:
+        for proc in procs:
+            proc.stdin.close()
+        for proc in procs:
+            proc.wait()
+
+def report(mode, usage):
+    print("%s" % mode)
+    for i, (rss, pss, uss) in enumerate(usage):
+        print("  session %d  RSS %8d kB  PSS %8d kB  USS %8d kB" % (i, rss, pss, uss))
+    print("  total PSS %d kB" % sum(u[1] for u in usage))
+
+# =============================================================================
+# Main
+# =============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render process memory with and without shared volumes")
+    parser.add_argument("--sessions", type=int, default=4, help="processes opening the same series")
+    parser.add_argument("--slices", type=int, default=200, help="slices of 512 x 512 int16 in the series")
+    parser.add_argument("--directory", default="/dev/shm", help="where to create the registry")
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp(prefix="bench_shared_")
+    registry = tempfile.mkdtemp(prefix="bench_shared_volumes_", dir=args.directory)
+    try:
+        script = os.path.join(workdir, "bench_child.py")
+        with io.open(script, "w", encoding="utf-8") as child_file:
+            child_file.write(CHILD_SOURCE % { 'here': here, 'slices': args.slices })
+
+        print("%d sessions, volume %d kB" % (args.sessions, 512 * 512 * 2 * args.slices // 1024))
+        report("private", run(script, "private", registry, args.sessions))
+        report("shared", run(script, "shared", registry, args.sessions))
+
+        left = os.listdir(registry)
+        print("registry after exit: %s" % (', '.join(left) if left else "empty"))
+        if left:
+            sys.exit(1)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        shutil.rmtree(registry, ignore_errors=True)
@@ -0,0 +1,153 @@
+r"""
+    Compare session startup through the launcher zygote with a plain
+    subprocess.Popen of the same script.
+
+        $ vtkpython bench_zygote.py --sessions 8
+
+    Both paths run a generated app that imports the given modules, prints the
+    ready line and then idles. Reported are the time from spawn request to
+    ready line (as seen by the launcher) and the memory of every child: RSS counts shared pages fully,
+    PSS splits them between the processes sharing them (copy-on-write pages
+    of the zygote included), USS is what the child owns alone.
+    Memory figures come from /proc and need Linux.
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import bench_common
+import launcher
+from twisted.internet import defer, reactor
+
+APP_SOURCE = """
+import sys
+%s
+
+def main(argv=None):
+    print("Starting factory")
+    sys.stdout.flush()
+    time.sleep(%d)
+
+if __name__ == "__main__":
+    main()
+"""
+
+# -----------------------------------------------------------------------------
+
+def importable(modules):
+    found = []
+    for name in modules:
+        try:
+            __import__(name)
+            found.append(name)
+        except ImportError:
+            print("Skipping %s, not importable here" % name)
+    return found
+
+def writeSetup(workdir, modules, hold):
+    imports = '\n'.join(["import %s" % name for name in modules])
+    script = os.path.join(workdir, "bench_app.py")
+    with io.open(script, "w", encoding="utf-8") as app_file:
+        app_file.write(APP_SOURCE % (imports, hold))
+
+    config = {
+        "configuration": {
+            "host": "localhost", "port": 0, "endpoint": "paraview", "proxy_file": os.path.join(workdir, "proxy.txt"),
+            "sessionURL": "", "timeout": 0, "log_dir": workdir, "fields": [],
+            "zygote": { "preload": modules }
+        },
+        "resources": [],
+        "properties": {},
+        "apps": {
+            "popen": { "cmd": [ sys.executable, script ], "ready_line": "Starting factory" },
+            "zygote": { "cmd": [ sys.executable, script ], "ready_line": "Starting factory", "zygote": True }
+        }
+    }
+    configPath = os.path.join(workdir, "bench.config")
+    with io.open(configPath, "w", encoding="utf-8") as config_file:
+        config_file.write(json.dumps(config))
+
+    return config, configPath
+
+@defer.inlineCallbacks
+def run(manager, application, sessions, timeout):
+    startup = []
+    procs = []
+    for i in range(sessions):
+        session = { 'id': "%s-%d" % (application, i), 'application': application,
+                    'cmd': manager.config['apps'][application]['cmd'] }
+        proc = manager.startProcess(session)
+        d = proc.whenReady()
+        timer = reactor.callLater(timeout, d.cancel)
+        try:
+            ready = yield d
+        except defer.CancelledError:
+            ready = False
+        if timer.active():
+            timer.cancel()
+        if not ready:
+            print("%s session %d did not get ready" % (application, i))
+            continue
+        startup.append(proc.readyTime - proc.startTime)
+        procs.append(proc)
+
+    usage = [bench_common.memory(proc.pid) for proc in procs]
+    for proc in procs:
+        proc.terminate()
+
+    return (startup, usage)
+
+def report(name, startup, usage):
+    if not startup:
+        print("%-8s no session started" % name)
+        return
+    startup = sorted(startup)
+    count = float(len(usage))
+    print("%-8s %3d sessions  startup mean %7.1f ms  median %7.1f ms  max %7.1f ms  "
+          "RSS %8.0f kB  PSS %8.0f kB  USS %8.0f kB" % (
+          name, len(startup),
+          1000 * sum(startup) / len(startup), 1000 * startup[len(startup) // 2], 1000 * startup[-1],
+          sum(u[0] for u in usage) / count, sum(u[1] for u in usage) / count, sum(u[2] for u in usage) / count))
+
+# =============================================================================
+# Main
+# =============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Zygote vs Popen session startup benchmark")
+    parser.add_argument("--sessions", type=int, default=8, help="sessions started per mode")
+    parser.add_argument("--modules", nargs="*", default=launcher.DEFAULT_ZYGOTE_PRELOAD,
+                        help="modules imported by the benchmark app")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for a ready line")
+    args = parser.parse_args()
+
+    modules = importable(args.modules)
+    workdir = tempfile.mkdtemp(prefix="bench_zygote_")
+    try:
+        config, configPath = writeSetup(workdir, modules, int(args.timeout) + 30)
+        options = argparse.Namespace(config=[configPath])
+
+        zygote = launcher.ZygoteClient(options, config)
+        manager = launcher.ProcessManager(config, zygote)
+
+        @defer.inlineCallbacks
+        def benchmark():
+            try:
+                # Let the zygote finish its imports before timing forks
+                yield run(manager, "zygote", 1, args.timeout)
+
+                print("Modules: %s" % ', '.join(modules))
+                report("popen", *(yield run(manager, "popen", args.sessions, args.timeout)))
+                report("zygote", *(yield run(manager, "zygote", args.sessions, args.timeout)))
+            finally:
+                zygote.stop()
+                reactor.stop()
+
+        reactor.callWhenRunning(benchmark)
+        reactor.run()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,186 @@
+r"""
+    Out-of-core storage of very large series.
+
+    A thin-slice or full-body series of several GB does not fit the memory
+    of a shared render node once a few sessions hold one each. Such series
+    are stored in the series cache in bricks of BRICK_SIZE^3 voxels
+    (.bricks.raw, brick after brick with x fastest inside a brick and
+    bricks ordered by z, y, x; edge bricks are padded) next to the usual
+    JSON header (.bricks.json, see series_cache.makeHeader).
+
+    The raw file is memory-mapped, but only the bricks in a BrickCache are
+    resident: the least recently used ones are dropped from the mapping
+    once the cache is full. BrickedVolumeSource puts a bricked volume into
+    a VTK pipeline and only assembles the update extent it is asked for.
+    vtkImageReslice asks for the bounding box of the slice it cuts, so an
+    MPR pulls the bricks along the slice plane and nothing else. Oblique
+    planes pull the bricks of their bounding box.
+
+    Writing needs one slab of BRICK_SIZE slices in memory at a time, see
+    writeSlab() and series_loader.decodeBricked().
+"""
+import collections
+import mmap
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+from vtk.util.vtkAlgorithm import VTKPythonAlgorithmBase
+
+# Edge length of a brick in voxels. 64^3 int16 voxels are 512 kB, a whole
+# number of pages, so every brick can be dropped from the mapping alone.
+BRICK_SIZE = 64
+
+# Layout of the cache entries, see series_cache.SeriesCache.readHeader
+LAYOUT = ".bricks"
+
+# -----------------------------------------------------------------------------
+
+def bricks(count, size=BRICK_SIZE):
+    return -(-count // size)
+
+def writeSlab(raw_file, slab, size=BRICK_SIZE):
+    """
+    Append the bricks of one slab, at most size slices (z, y, x, components)
+    """
+    (depth, rows, columns, components) = slab.shape
+    (yBricks, xBricks) = (bricks(rows, size), bricks(columns, size))
+    padded = numpy.zeros((size, yBricks * size, xBricks * size, components), dtype=slab.dtype)
+    padded[:depth, :rows, :columns] = slab
+    # (z, by, y, bx, x, c) to (by, bx, z, y, x, c)
+    padded = padded.reshape(size, yBricks, size, xBricks, size, components).transpose(1, 3, 0, 2, 4, 5)
+    numpy.ascontiguousarray(padded).tofile(raw_file)
+
+# -----------------------------------------------------------------------------
+
+class BrickCache(object):
+    """
+    The resident bricks of all bricked volumes of a process, least recently
+    used first
+    """
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.bricks = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        """
+        Return the brick of key, load() returns (brick, release) on a miss:
+        release() is called when the brick leaves the cache
+        """
+        cached = self.bricks.pop(key, None)
+        if cached:
+            self.hits += 1
+        else:
+            self.misses += 1
+            cached = load()
+            self.size += cached[0].nbytes
+        self.bricks[key] = cached
+
+        # Keep the newest brick even if it alone is over the limit
+        while self.size > self.maxBytes and len(self.bricks) > 1:
+            (brick, release) = self.bricks.popitem(last=False)[1]
+            self.size -= brick.nbytes
+            release()
+        return cached[0]
+
+class BrickedVolume(object):
+    def __init__(self, path, header, cache):
+        self.path = path
+        self.header = header
+        self.cache = cache
+        self.size = header['brickSize']
+        (xMin, xMax, yMin, yMax, zMin, zMax) = header['extent']
+        self.origin = (xMin, yMin, zMin)
+        self.bricks = (bricks(xMax - xMin + 1, self.size), bricks(yMax - yMin + 1, self.size),
+                       bricks(zMax - zMin + 1, self.size))
+        self.dtype = numpy.dtype(numpy_support.get_numpy_array_type(header['scalarType']))
+        self.shape = (self.size, self.size, self.size, header['components'])
+        self.brickBytes = int(numpy.prod(self.shape)) * self.dtype.itemsize
+        with open(path, "rb") as raw_file:
+            self.map = mmap.mmap(raw_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def brick(self, bx, by, bz):
+        index = (bz * self.bricks[1] + by) * self.bricks[0] + bx
+        offset = index * self.brickBytes
+
+        def load():
+            brick = numpy.frombuffer(self.map, dtype=self.dtype, count=self.brickBytes // self.dtype.itemsize,
+                                     offset=offset).reshape(self.shape)
+            return (brick, lambda: self._drop(offset))
+        return self.cache.get((self.path, index), load)
+
+    def _drop(self, offset):
+        # The pages stay in the page cache, they just no longer count for
+        # this process. Without madvise (Windows, Python < 3.8) the OS trims
+        # them under memory pressure.
+        if hasattr(self.map, 'madvise'):
+            self.map.madvise(mmap.MADV_DONTNEED, offset, self.brickBytes)
+
+    def read(self, extent):
+        """
+        Return the voxels of an extent as a (z, y, x, components) array
+        """
+        (x0, x1, y0, y1, z0, z1) = [value - self.origin[i // 2] for i, value in enumerate(extent)]
+        size = self.size
+        region = numpy.empty((z1 - z0 + 1, y1 - y0 + 1, x1 - x0 + 1, self.shape[3]), dtype=self.dtype)
+        for bz in range(z0 // size, z1 // size + 1):
+            (zFirst, zLast) = (max(z0, bz * size), min(z1, bz * size + size - 1))
+            for by in range(y0 // size, y1 // size + 1):
+                (yFirst, yLast) = (max(y0, by * size), min(y1, by * size + size - 1))
+                for bx in range(x0 // size, x1 // size + 1):
+                    (xFirst, xLast) = (max(x0, bx * size), min(x1, bx * size + size - 1))
+                    region[zFirst - z0:zLast - z0 + 1, yFirst - y0:yLast - y0 + 1, xFirst - x0:xLast - x0 + 1] = \
+                        self.brick(bx, by, bz)[zFirst - bz * size:zLast - bz * size + 1,
+                                               yFirst - by * size:yLast - by * size + 1,
+                                               xFirst - bx * size:xLast - bx * size + 1]
+        return region
+
+def openVolume(seriesCache, uid, autoRescale, files, cache):
+    """
+    Return the BrickedVolume of a series from the series cache, or None
+    """
+    header = seriesCache.readHeader(uid, autoRescale, files, LAYOUT)
+    if not header or 'brickSize' not in header:
+        return None
+    try:
+        return BrickedVolume(seriesCache.path(uid, autoRescale, LAYOUT + ".raw"), header, cache)
+    except (IOError, OSError, ValueError):
+        return None
+
+# -----------------------------------------------------------------------------
+
+class BrickedVolumeSource(VTKPythonAlgorithmBase):
+    """
+    Image source of a bricked volume that produces any sub extent
+    """
+    def __init__(self, volume):
+        VTKPythonAlgorithmBase.__init__(self, nInputPorts=0, nOutputPorts=1, outputType='vtkImageData')
+        self.volume = volume
+
+    def RequestInformation(self, request, inInfo, outInfo):
+        header = self.volume.header
+        info = outInfo.GetInformationObject(0)
+        info.Set(vtk.vtkStreamingDemandDrivenPipeline.WHOLE_EXTENT(), header['extent'], 6)
+        info.Set(vtk.vtkDataObject.SPACING(), header['spacing'], 3)
+        info.Set(vtk.vtkDataObject.ORIGIN(), header['origin'], 3)
+        info.Set(vtk.vtkAlgorithm.CAN_PRODUCE_SUB_EXTENT(), 1)
+        vtk.vtkDataObject.SetPointDataActiveScalarInfo(info, header['scalarType'], header['components'])
+        return 1
+
+    def RequestData(self, request, inInfo, outInfo):
+        info = outInfo.GetInformationObject(0)
+        extent = info.Get(vtk.vtkStreamingDemandDrivenPipeline.UPDATE_EXTENT())
+        region = self.volume.read(extent)
+
+        output = vtk.vtkImageData.GetData(info)
+        output.SetExtent(extent)
+        output.SetSpacing(self.volume.header['spacing'])
+        output.SetOrigin(self.volume.header['origin'])
+        scalars = numpy_support.numpy_to_vtk(region.reshape(-1, region.shape[3]), deep=False,
+                                             array_type=self.volume.header['scalarType'])
+        scalars.SetName("PixelData")
+        output.GetPointData().SetScalars(scalars)
+        return 1
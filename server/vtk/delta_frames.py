@@ -0,0 +1,144 @@
+r"""
+    Frames that only carry the tiles that changed.
+
+    Scrolling one slice of the 4-view layout, or moving a cross hair,
+    changes a small part of the window, yet every frame is a full image. A
+    DeltaEncoder splits the framebuffer into TILE_SIZE tiles, keeps a hash
+    of every tile sent and encodes only the tiles whose hash changed. A run
+    of changed tiles in a row of tiles is encoded as one rectangle, one
+    image header for all of them. A keyframe, the whole frame as one
+    rectangle, is sent first, whenever the size changes, every
+    keyframeInterval frames, when forceKeyframe() is called and when so
+    many tiles changed that the pieces would be larger than one image.
+
+    A frame is one binary attachment, little endian:
+
+        uint8   version (1)
+        uint8   flags, 1 for a keyframe
+        uint16  frame width, height
+        uint16  number of rectangles
+        then per rectangle
+            uint16  x, y of the top left corner, top row is 0
+            uint16  width, height
+            uint32  size of the image
+            the image, in the format of the encoder
+
+    The encoder must not be called for two frames of a view at once, the
+    EncoderPool of frame_encoders never does. Frames it drops are never
+    encoded and so never counted as sent.
+"""
+import hashlib
+import struct
+
+import frame_encoders
+
+TILE_SIZE = 64
+
+KEYFRAME_INTERVAL = 100
+
+# Share of changed tiles from which a keyframe is sent instead
+KEYFRAME_CHANGED = 0.5
+
+VERSION = 1
+KEYFRAME = 1
+
+_header = struct.Struct("<BBHHH")
+_rectangle = struct.Struct("<HHHHI")
+
+# -----------------------------------------------------------------------------
+
+def tileHashes(pixels, size=TILE_SIZE):
+    """
+    Return the hashes of the tiles of (rows, columns, components) pixels,
+    one list per row of tiles
+    """
+    (rows, columns) = pixels.shape[:2]
+    return [[hashlib.blake2b(pixels[y:y + size, x:x + size].tobytes(), digest_size=16).digest()
+             for x in range(0, columns, size)]
+            for y in range(0, rows, size)]
+
+def changedRuns(hashes, previous):
+    """
+    Return (row, first, last) for every run of tiles in a row whose hashes
+    differ from previous
+    """
+    runs = []
+    for (row, (tiles, before)) in enumerate(zip(hashes, previous)):
+        first = None
+        for (column, (tile, old)) in enumerate(zip(tiles, before)):
+            if tile != old:
+                if first is None:
+                    first = column
+            elif first is not None:
+                runs.append((row, first, column - 1))
+                first = None
+        if first is not None:
+            runs.append((row, first, len(tiles) - 1))
+    return runs
+
+class DeltaEncoder(object):
+    def __init__(self, tileSize=TILE_SIZE, keyframeInterval=KEYFRAME_INTERVAL):
+        self.tileSize = tileSize
+        self.keyframeInterval = keyframeInterval
+        self.hashes = None
+        self.size = None
+        self.sinceKeyframe = 0
+        self.keyframe = True
+
+    def forceKeyframe(self):
+        self.keyframe = True
+
+    def encode(self, frame, encoder, quality):
+        """
+        Return (data, keyframe, rectangles) of an RGB vtkImageData, data is
+        None if no tile changed
+        """
+        pixels = frame_encoders.pixels(frame)
+        (rows, columns) = pixels.shape[:2]
+        hashes = tileHashes(pixels, self.tileSize)
+        # Taken right away, a keyframe forced meanwhile goes to the next frame
+        (forced, self.keyframe) = (self.keyframe, False)
+        keyframe = (forced or self.size != (columns, rows)
+                    or self.sinceKeyframe + 1 >= self.keyframeInterval)
+
+        size = self.tileSize
+        runs = [] if keyframe else changedRuns(hashes, self.hashes)
+        if not keyframe and not runs:
+            return (None, False, 0)
+        changed = sum([last - first + 1 for (row, first, last) in runs])
+        if keyframe or changed >= KEYFRAME_CHANGED * len(hashes) * len(hashes[0]):
+            keyframe = True
+            rectangles = [(0, 0, columns, rows)]
+        else:
+            rectangles = [(first * size, row * size, min(columns, (last + 1) * size) - first * size,
+                           min(rows, (row + 1) * size) - row * size)
+                          for (row, first, last) in runs]
+
+        parts = [_header.pack(VERSION, KEYFRAME if keyframe else 0, columns, rows, len(rectangles))]
+        for (x, y, width, height) in rectangles:
+            if keyframe:
+                image = encoder.encode(frame, quality)
+            else:
+                image = encoder.encode(frame_encoders.imageFromPixels(pixels[y:y + height, x:x + width]), quality)
+            parts.append(_rectangle.pack(x, y, width, height, len(image)))
+            parts.append(image)
+
+        self.hashes = hashes
+        self.size = (columns, rows)
+        self.sinceKeyframe = 0 if keyframe else self.sinceKeyframe + 1
+        return (b"".join(parts), keyframe, len(rectangles))
+
+def decode(data):
+    """
+    Return (keyframe, width, height, [(x, y, width, height, image)]) of a
+    frame, for tests and benchmarks; clients do the same in JavaScript
+    """
+    (version, flags, width, height, count) = _header.unpack_from(data, 0)
+    offset = _header.size
+    rectangles = []
+    for i in range(count):
+        (x, y, w, h, length) = _rectangle.unpack_from(data, offset)
+        offset += _rectangle.size
+        rectangles.append((x, y, w, h, data[offset:offset + length]))
+        offset += length
+    return (bool(flags & KEYFRAME), width, height, rectangles)
@@ -0,0 +1,294 @@
+r"""
+    Encoders of the frames vtkWebPublishImageDelivery publishes.
+
+    RGB JPEG stays the default ('jpeg'), other encoders are chosen per view
+    by the client through "viewport.image.push.encoder" (see
+    vtk_override_protocols.py). Pushed frames grab the framebuffer, hash it
+    to skip a frame that did not change and encode it here; only a still
+    render without a last frame to compare with takes the JPEG the web
+    application encodes in C++. The encoders:
+
+        png        lossless, for diagnostic stills
+        webp       lossless, needs Pillow
+        jpeg-gray  single channel JPEG, for grayscale views like the MPR
+                   where RGB carries the same value three times
+        rgb+lz4    raw RGB rows, top row first, in an LZ4 frame, for LAN
+                   clients; needs the lz4 package and a client that
+                   decompresses it
+
+    The format of an encoder is what the reply carries in "format", clients
+    build an image/<format> blob from it. Encoders whose module is missing
+    are not registered.
+
+    Rendering and reading the framebuffer need the reactor thread, encoding
+    does not: an EncoderPool encodes in a few threads and hands the frames
+    back to the reactor to publish. At most one frame per view waits for a
+    thread, a newer frame of the view replaces it.
+"""
+import collections
+import hashlib
+import io
+import sys
+import threading
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+DEFAULT_ENCODER = 'jpeg'
+
+# Threads of an EncoderPool
+ENCODE_WORKERS = 2
+
+# The encoders by name, in the order they are offered to the client
+_encoders = collections.OrderedDict()
+
+# -----------------------------------------------------------------------------
+
+def grabFrame(view):
+    """
+    Render a view and return its framebuffer as RGB vtkImageData
+    """
+    view.Render()
+    grabber = vtk.vtkWindowToImageFilter()
+    grabber.SetInput(view)
+    grabber.SetInputBufferTypeToRGB()
+    grabber.ReadFrontBufferOff()
+    grabber.ShouldRerenderOff()
+    grabber.Update()
+    return grabber.GetOutput()
+
+def framebuffer(image):
+    """
+    Return the (rows, columns, components) uint8 pixels of an image as they
+    are in memory, bottom row first
+    """
+    (columns, rows) = image.GetDimensions()[0:2]
+    scalars = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())
+    return scalars.reshape(rows, columns, -1)
+
+def pixels(image):
+    """
+    Return the (rows, columns, components) uint8 pixels of an image, top
+    row first like the browser wants them
+    """
+    return framebuffer(image)[::-1]
+
+def imageFromPixels(pixels):
+    """
+    The inverse of pixels(), a vtkImageData of (rows, columns, components)
+    uint8 pixels, top row first
+    """
+    (rows, columns, components) = pixels.shape
+    image = vtk.vtkImageData()
+    image.SetDimensions(columns, rows, 1)
+    scalars = numpy_support.numpy_to_vtk(numpy.ascontiguousarray(pixels[::-1]).reshape(-1, components), deep=True,
+                                         array_type=vtk.VTK_UNSIGNED_CHAR)
+    image.GetPointData().SetScalars(scalars)
+    return image
+
+def _writeToMemory(writer, image):
+    writer.SetInputData(image)
+    writer.WriteToMemoryOn()
+    writer.Write()
+    return memoryview(writer.GetResult()).tobytes()
+
+class LastFrame(object):
+    """
+    The hash of the last frame sent of a view, to skip identical ones.
+    unchanged() runs in the thread encoding the frames of the view, reset()
+    in the reactor: it only counts resets, a frame rendered after one is
+    sent whatever the hash, even if its job replaced the job of an earlier
+    frame.
+    """
+    def __init__(self):
+        self.digest = None
+        self.resets = 0
+        # The resets the digest was taken after
+        self.digestResets = 0
+
+    def unchanged(self, data, resets=0):
+        """
+        Return True if data, pixels or an encoded frame, is the same as the
+        last data; otherwise it becomes the last. resets is the count of
+        resets when the frame was rendered.
+        """
+        digest = hashlib.blake2b(data, digest_size=16)
+        if hasattr(data, 'shape'):
+            digest.update(str(data.shape).encode('ascii'))
+        digest = digest.digest()
+        if digest == self.digest and resets == self.digestResets:
+            return True
+        (self.digest, self.digestResets) = (digest, resets)
+        return False
+
+    def reset(self):
+        """
+        Send the next frame rendered even if it is the same
+        """
+        self.resets += 1
+
+# -----------------------------------------------------------------------------
+
+class Encoder(object):
+    name = None
+    format = None
+    lossless = False
+    # True for the JPEG the web application itself can encode
+    native = False
+
+    def encode(self, image, quality):
+        """
+        Return the bytes of an RGB vtkImageData, quality 0-100
+        """
+        raise NotImplementedError()
+
+    def describe(self):
+        return { 'name': self.name, 'format': self.format, 'lossless': self.lossless }
+
+class JpegEncoder(Encoder):
+    name = 'jpeg'
+    format = 'jpeg'
+    native = True
+
+    def encode(self, image, quality):
+        writer = vtk.vtkJPEGWriter()
+        writer.SetQuality(quality)
+        return _writeToMemory(writer, image)
+
+class GrayJpegEncoder(Encoder):
+    name = 'jpeg-gray'
+    format = 'jpeg'
+
+    def encode(self, image, quality):
+        luminance = vtk.vtkImageLuminance()
+        luminance.SetInputData(image)
+        luminance.Update()
+        writer = vtk.vtkJPEGWriter()
+        writer.SetQuality(quality)
+        return _writeToMemory(writer, luminance.GetOutput())
+
+class PngEncoder(Encoder):
+    name = 'png'
+    format = 'png'
+    lossless = True
+
+    def __init__(self, compressionLevel=1):
+        # Higher levels take several times as long for a few percent
+        self.compressionLevel = compressionLevel
+
+    def encode(self, image, quality):
+        writer = vtk.vtkPNGWriter()
+        writer.SetCompressionLevel(self.compressionLevel)
+        return _writeToMemory(writer, image)
+
+class WebpEncoder(Encoder):
+    name = 'webp'
+    format = 'webp'
+    lossless = True
+
+    def encode(self, image, quality):
+        output = io.BytesIO()
+        # For lossless WebP quality is the effort, not the fidelity
+        Image.fromarray(pixels(image)).save(output, 'WEBP', lossless=True, quality=quality, method=0)
+        return output.getvalue()
+
+class Lz4Encoder(Encoder):
+    name = 'rgb+lz4'
+    format = 'rgb+lz4'
+    lossless = True
+
+    def encode(self, image, quality):
+        return lz4.frame.compress(numpy.ascontiguousarray(pixels(image)).tobytes())
+
+# -----------------------------------------------------------------------------
+
+class EncoderPool(object):
+    def __init__(self, workers, schedule):
+        """
+        schedule(function, *args) must run function in the reactor thread,
+        like reactor.callFromThread
+        """
+        self.workers = workers
+        self.schedule = schedule
+        self.condition = threading.Condition()
+        # view -> (encode, done), waiting for a thread, oldest first
+        self.pending = collections.OrderedDict()
+        # Views with a frame in a thread, their next one waits to stay in order
+        self.busy = set()
+        self.threads = []
+
+    def submit(self, view, encode, done):
+        """
+        Run encode() in a thread, then done(result) in the reactor. Return
+        True if this replaced a frame of the view that was still waiting.
+        """
+        with self.condition:
+            replaced = self.pending.pop(view, None) is not None
+            self.pending[view] = (encode, done)
+            # Started on first use, not in processes forked before that
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            self.condition.notify()
+        return replaced
+
+    def _next(self):
+        for view in self.pending:
+            if view not in self.busy:
+                self.busy.add(view)
+                return (view,) + self.pending.pop(view)
+        return None
+
+    def _work(self):
+        while True:
+            with self.condition:
+                job = self._next()
+                while not job:
+                    self.condition.wait()
+                    job = self._next()
+            (view, encode, done) = job
+            try:
+                self.schedule(done, encode())
+            except Exception as e:
+                print("Encoding a frame of view %s failed: %s" % (view, e))
+                sys.stdout.flush()
+            finally:
+                with self.condition:
+                    self.busy.discard(view)
+                    # The next frame of the view may be waiting
+                    self.condition.notify()
+
+# -----------------------------------------------------------------------------
+
+def register(encoder):
+    _encoders[encoder.name] = encoder
+
+def get(name):
+    """
+    Return the encoder of a name, None if there is none
+    """
+    return _encoders.get(name)
+
+def available():
+    return list(_encoders.values())
+
+register(JpegEncoder())
+register(GrayJpegEncoder())
+register(PngEncoder())
+if Image is not None and features.check('webp'):
+    register(WebpEncoder())
+if lz4 is not None:
+    register(Lz4Encoder())
@@ -0,0 +1,243 @@
+r"""
+    Index of the DICOM headers of every image, kept in a local SQLite file.
+
+    Putting the files of a series in slice order takes the header of every
+    file, and so did every session start. The index stores what is needed
+    for it once per file: instance number, image position and orientation,
+    rows and columns, pixel spacing, frames, rescale and window/level. With
+    the index the image catalog (see image_catalog.py, "header_index") hands
+    out the paths already in slice order plus the series geometry, and the
+    loader decodes them without a header pass.
+
+    Index new images at ingest with HeaderIndex.indexSeries(uid, paths).
+    Existing series are backfilled from the command line, parsing headers on
+    all cores:
+
+        $ vtkpython header_index.py /.../headers.db
+        $ vtkpython header_index.py /.../headers.db --series 1.2.3 1.2.4 --workers 8
+        $ vtkpython header_index.py /.../headers.db --catalog /.../catalog.db
+
+    Series already indexed are skipped unless --reindex is given.
+"""
+import argparse
+import json
+import multiprocessing
+import sqlite3
+import sys
+import threading
+import time
+
+# The slice order of the index must be the one vtkDICOMReader uses: by
+# position along the normal of the image plane, then by instance number.
+# Positions closer than this (mm) count as the same slice.
+POSITION_TOLERANCE = 1e-4
+
+# -----------------------------------------------------------------------------
+
+def readHeader(path):
+    """
+    Return the index row of one file, None if it can not be parsed
+    """
+    # Only indexing needs VTK, the lookups done by the launcher do not
+    import vtk
+
+    meta = vtk.vtkDICOMMetaData()
+    parser = vtk.vtkDICOMParser()
+    parser.SetMetaData(meta)
+    parser.SetFileName(path)
+    parser.Update()
+    if parser.GetErrorCode():
+        return None
+
+    def values(group, element):
+        value = meta.Get(vtk.vtkDICOMTag(group, element))
+        return [value.GetDouble(i) for i in range(value.GetNumberOfValues())] if value.IsValid() else []
+
+    def number(group, element, default=None):
+        found = values(group, element)
+        return found[0] if found else default
+
+    return {
+        'path': path,
+        'instance': int(number(0x0020, 0x0013, 0)),
+        'position': values(0x0020, 0x0032),
+        'orientation': values(0x0020, 0x0037),
+        'rows': int(number(0x0028, 0x0010, 0)),
+        'columns': int(number(0x0028, 0x0011, 0)),
+        'spacing': values(0x0028, 0x0030),
+        'thickness': number(0x0018, 0x0050),
+        'frames': int(number(0x0028, 0x0008, 1)),
+        'slope': number(0x0028, 0x1053, 1.0),
+        'intercept': number(0x0028, 0x1052, 0.0),
+        'window_center': number(0x0028, 0x1050),
+        'window_width': number(0x0028, 0x1051),
+    }
+
+def _cross(a, b):
+    return [a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0]]
+
+def _dot(a, b):
+    return sum(x * y for x, y in zip(a, b))
+
+def sliceGeometry(headers):
+    """
+    Return (headers in slice order, geometry) of a series, or None if the
+    series does not stack into one volume of single-frame slices
+    """
+    first = headers[0]
+    if len(first['orientation']) != 6 or len(first['position']) != 3 or len(first['spacing']) != 2:
+        return None
+    for header in headers:
+        if (header['frames'] != 1 or header['rows'] != first['rows'] or header['columns'] != first['columns']
+            or header['orientation'] != first['orientation'] or len(header['position']) != 3):
+            return None
+
+    normal = _cross(first['orientation'][:3], first['orientation'][3:])
+    ordered = sorted(headers, key=lambda header: (_dot(header['position'], normal), header['instance']))
+    distances = [_dot(header['position'], normal) for header in ordered]
+    for i in range(1, len(distances)):
+        if distances[i] - distances[i - 1] < POSITION_TOLERANCE:
+            # Several images per position (time series, echoes), leave it to the reader
+            return None
+
+    if len(ordered) > 1:
+        sliceSpacing = (distances[-1] - distances[0]) / (len(ordered) - 1)
+    else:
+        sliceSpacing = first['thickness'] or 1.0
+
+    geometry = {
+        'extent': [0, first['columns'] - 1, 0, first['rows'] - 1, 0, len(ordered) - 1],
+        # DICOM pixel spacing is row (y) spacing first
+        'spacing': [first['spacing'][1], first['spacing'][0], sliceSpacing],
+        'position': ordered[0]['position'],
+        'orientation': first['orientation'],
+        'rescale': [first['slope'], first['intercept']],
+        'uniformRescale': len(set((header['slope'], header['intercept']) for header in headers)) == 1,
+        'window': [first['window_center'], first['window_width']],
+    }
+    return (ordered, geometry)
+
+# -----------------------------------------------------------------------------
+
+COLUMNS = ['path', 'seriesuid', 'instance', 'position', 'orientation', 'rows', 'columns', 'spacing',
+           'thickness', 'frames', 'slope', 'intercept', 'window_center', 'window_width']
+
+# Stored as JSON text
+LIST_COLUMNS = ['position', 'orientation', 'spacing']
+
+class HeaderIndex(object):
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS header (path TEXT PRIMARY KEY, seriesuid TEXT, instance INTEGER, "
+                            "position TEXT, orientation TEXT, rows INTEGER, columns INTEGER, spacing TEXT, thickness REAL, "
+                            "frames INTEGER, slope REAL, intercept REAL, window_center REAL, window_width REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS header_seriesuid ON header (seriesuid)")
+            self.db.commit()
+
+    def add(self, uid, headers):
+        rows = []
+        for header in headers:
+            row = dict(header, seriesuid=uid)
+            for column in LIST_COLUMNS:
+                row[column] = json.dumps(row[column])
+            rows.append([row[column] for column in COLUMNS])
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO header (%s) VALUES (%s)" % (
+                ', '.join(COLUMNS), ', '.join(['?'] * len(COLUMNS))), rows)
+            self.db.commit()
+
+    def remove(self, uid):
+        with self.lock:
+            self.db.execute("DELETE FROM header WHERE seriesuid = ?", (uid,))
+            self.db.commit()
+
+    def headers(self, uid):
+        with self.lock:
+            rows = self.db.execute("SELECT %s FROM header WHERE seriesuid = ?" % ', '.join(COLUMNS), (uid,)).fetchall()
+        headers = []
+        for row in rows:
+            header = dict(zip(COLUMNS, row))
+            for column in LIST_COLUMNS:
+                header[column] = json.loads(header[column])
+            headers.append(header)
+        return headers
+
+    def indexedSeries(self):
+        with self.lock:
+            return set(uid for (uid,) in self.db.execute("SELECT DISTINCT seriesuid FROM header"))
+
+    def order(self, uid, paths):
+        """
+        Return (paths in slice order, geometry) of a series, or None if the
+        index does not cover exactly these paths or the series does not
+        stack into one volume
+        """
+        headers = self.headers(uid)
+        if not headers or set(header['path'] for header in headers) != set(paths):
+            return None
+        stacked = sliceGeometry(headers)
+        if not stacked:
+            return None
+        return ([header['path'] for header in stacked[0]], stacked[1])
+
+    def indexSeries(self, uid, paths, pool=None):
+        """
+        Parse the headers of a series and store them, in the given
+        multiprocessing pool if any. Return the number of files indexed.
+        """
+        headers = (pool.map if pool else map)(readHeader, paths)
+        headers = [header for header in headers if header]
+        self.remove(uid)
+        self.add(uid, headers)
+        return len(headers)
+
+    def close(self):
+        self.db.close()
+
+# =============================================================================
+# Backfill the index from the image catalog
+# =============================================================================
+
+if __name__ == "__main__":
+    import image_catalog
+
+    parser = argparse.ArgumentParser(description="Index the DICOM headers of the series in the image catalog")
+    parser.add_argument("index", help="SQLite file of the header index, created if missing")
+    parser.add_argument("--series", nargs="*", default=None, help="series uids to index, default all in the catalog")
+    parser.add_argument("--catalog", default=None, help="SQLite image catalog to read, default the MySQL database")
+    parser.add_argument("--workers", type=int, default=0, help="processes parsing headers, default one per core")
+    parser.add_argument("--reindex", action="store_true", help="index series again that are already indexed")
+    args = parser.parse_args()
+
+    if args.catalog:
+        catalog = image_catalog.SQLiteCatalog(args.catalog)
+    else:
+        catalog = image_catalog.MySQLCatalog()
+    index = HeaderIndex(args.index)
+
+    series = args.series if args.series is not None else catalog.listSeries()
+    if not args.reindex:
+        indexed = index.indexedSeries()
+        series = [uid for uid in series if uid not in indexed]
+
+    pool = multiprocessing.Pool(args.workers or None)
+    begin = time.time()
+    files = 0
+    try:
+        for i, uid in enumerate(series):
+            paths = catalog.seriesPaths(uid)
+            count = index.indexSeries(uid, paths, pool)
+            files += count
+            print("%d/%d %s: %d of %d files indexed" % (i + 1, len(series), uid, count, len(paths)))
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+        index.close()
+        catalog.close()
+
+    elapsed = time.time() - begin
+    print("Indexed %d series, %d files in %.1fs (%.0f files/s)" % (len(series), files, elapsed, files / max(elapsed, 1e-6)))
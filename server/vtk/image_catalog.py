@@ -0,0 +1,264 @@
+r"""
+    Where the images of a series are.
+
+    A catalog maps a series uid to the paths of its DICOM files. Backends:
+
+        MySQLCatalog   the iqweb image table, pooled connections and a
+                       prepared statement; with pool_size 1 one plain
+                       connection, for render processes
+        SQLiteCatalog  a SQLite file or ":memory:", filled with addSeries(),
+                       for tests and benchmarks
+
+    CachedCatalog puts an LRU cache of SeriesEntry objects in front of a
+    backend. With a header index (see header_index.py) an entry starts with
+    the paths in slice order and the geometry of the series. Otherwise it
+    starts with the paths as stored; whoever sorts them or learns the
+    geometry (series_loader, after decoding) hands that back with
+    remember() so the next lookup gets it for free. Entries expire
+    after max_age seconds so images that arrive later are picked up.
+
+    The catalog is thread safe, the launcher queries it from its thread
+    pool to validate and size a series before starting a process. A render
+    process looks up a series or two, it calls release() once it has them
+    so the database does not keep a connection per open viewer.
+"""
+import collections
+import contextlib
+import sqlite3
+import threading
+import time
+
+SERIES_PATHS_SQL = "SELECT path FROM image WHERE seriesuid = %s"
+SERIES_LIST_SQL = "SELECT DISTINCT seriesuid FROM image"
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CACHE_SIZE = 256
+DEFAULT_MAX_AGE = 300
+
+# -----------------------------------------------------------------------------
+
+class Catalog(object):
+    def seriesPaths(self, uid):
+        """
+        Return the paths of the files of a series, empty if it is unknown
+        """
+        raise NotImplementedError()
+
+    def listSeries(self):
+        """
+        Return the uids of all series
+        """
+        raise NotImplementedError()
+
+    def release(self):
+        """
+        Give back database connections, the catalog reconnects when used again
+        """
+        pass
+
+    def close(self):
+        pass
+
+# -----------------------------------------------------------------------------
+
+class MySQLCatalog(Catalog):
+    def __init__(self, host="localhost", database="iqweb", user=None, password=None, pool_size=DEFAULT_POOL_SIZE):
+        # Only needed with this backend
+        import mysql.connector.pooling
+
+        if user is None:
+            from credentials import credentials
+            cred = credentials()
+            user, password = cred[0], cred[1]
+
+        self.settings = dict(host=host, user=user, password=password, database=database)
+        self.pool = None
+        if pool_size > 1:
+            self.pool = mysql.connector.pooling.MySQLConnectionPool(
+                pool_name="image_catalog", pool_size=pool_size, **self.settings)
+        # Without a pool, opened on first use and closed by release()
+        self.connection = None
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connect(self):
+        if self.pool:
+            connection = self.pool.get_connection()
+            try:
+                yield connection
+            finally:
+                # Back into the pool
+                connection.close()
+            return
+
+        import mysql.connector
+        with self.lock:
+            if self.connection is None:
+                self.connection = mysql.connector.connect(**self.settings)
+            yield self.connection
+
+    def seriesPaths(self, uid):
+        with self.connect() as connection:
+            cursor = connection.cursor(prepared=True)
+            try:
+                cursor.execute(SERIES_PATHS_SQL, (uid,))
+                # Older connectors return bytearrays from prepared statements
+                return [path.decode('utf-8') if isinstance(path, (bytes, bytearray)) else path
+                        for (path,) in cursor.fetchall()]
+            finally:
+                cursor.close()
+
+    def listSeries(self):
+        with self.connect() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(SERIES_LIST_SQL)
+                return [uid for (uid,) in cursor.fetchall()]
+            finally:
+                cursor.close()
+
+    def release(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def close(self):
+        self.release()
+
+# -----------------------------------------------------------------------------
+
+class SQLiteCatalog(Catalog):
+    def __init__(self, path=":memory:"):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS image (seriesuid TEXT, path TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS image_seriesuid ON image (seriesuid)")
+        self.db.commit()
+
+    def addSeries(self, uid, paths):
+        with self.lock:
+            self.db.executemany("INSERT INTO image (seriesuid, path) VALUES (?, ?)", [(uid, path) for path in paths])
+            self.db.commit()
+
+    def seriesPaths(self, uid):
+        with self.lock:
+            return [path for (path,) in self.db.execute(SERIES_PATHS_SQL.replace("%s", "?"), (uid,))]
+
+    def listSeries(self):
+        with self.lock:
+            return [uid for (uid,) in self.db.execute(SERIES_LIST_SQL)]
+
+    def close(self):
+        self.db.close()
+
+# -----------------------------------------------------------------------------
+
+class SeriesEntry(object):
+    def __init__(self, uid, paths):
+        self.uid = uid
+        self.paths = paths
+        # True once the paths are in slice order
+        self.ordered = False
+        # From the header index or the loader, extent and spacing at least
+        self.geometry = None
+        self.time = time.time()
+
+class CachedCatalog(Catalog):
+    def __init__(self, catalog, size=DEFAULT_CACHE_SIZE, max_age=DEFAULT_MAX_AGE, index=None):
+        self.catalog = catalog
+        self.index = index
+        self.size = size
+        self.max_age = max_age
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, uid):
+        """
+        Return the SeriesEntry of a series, None if it is unknown
+        """
+        with self.lock:
+            entry = self.entries.pop(uid, None)
+            if entry and time.time() - entry.time <= self.max_age:
+                self.entries[uid] = entry
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        # Query outside the lock, other lookups need not wait for the database
+        paths = self.catalog.seriesPaths(uid)
+        if not paths:
+            # Not cached, the images may still be arriving
+            return None
+
+        entry = SeriesEntry(uid, paths)
+        ordered = self.index.order(uid, paths) if self.index else None
+        if ordered:
+            (entry.paths, entry.geometry) = ordered
+            entry.ordered = True
+
+        with self.lock:
+            self.entries[uid] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def seriesPaths(self, uid):
+        entry = self.lookup(uid)
+        return entry.paths if entry else []
+
+    def listSeries(self):
+        return self.catalog.listSeries()
+
+    def remember(self, uid, paths=None, geometry=None):
+        """
+        Store what was learned about a cached series: its paths in slice
+        order and its geometry
+        """
+        with self.lock:
+            entry = self.entries.get(uid)
+            if not entry:
+                return
+            if paths is not None:
+                entry.paths = paths
+                entry.ordered = True
+            if geometry is not None:
+                entry.geometry = geometry
+
+    def release(self):
+        self.catalog.release()
+
+    def close(self):
+        self.catalog.close()
+        if self.index:
+            self.index.close()
+
+# =============================================================================
+# Create the cached catalog described by a configuration dict:
+#   { "type": "mysql", "host": ..., "database": ..., "pool_size": ...,
+#     "cache_size": ..., "max_age": ... }
+#   { "type": "sqlite", "path": ..., "cache_size": ..., "max_age": ... }
+# and optionally "header_index": path of the SQLite file of header_index.py
+# =============================================================================
+
+def createCatalog(config=None):
+    config = config or {}
+    kind = config.get('type', 'mysql')
+    if kind == 'mysql':
+        catalog = MySQLCatalog(host=config.get('host', "localhost"), database=config.get('database', "iqweb"),
+                               user=config.get('user'), password=config.get('password'),
+                               pool_size=int(config.get('pool_size', DEFAULT_POOL_SIZE)))
+    elif kind == 'sqlite':
+        catalog = SQLiteCatalog(config.get('path', ":memory:"))
+    else:
+        raise ValueError("Unknown catalog type %s" % kind)
+
+    index = None
+    if config.get('header_index'):
+        import header_index
+        index = header_index.HeaderIndex(config['header_index'])
+
+    return CachedCatalog(catalog, int(config.get('cache_size', DEFAULT_CACHE_SIZE)),
+                         float(config.get('max_age', DEFAULT_MAX_AGE)), index)
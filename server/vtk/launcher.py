@@ -1,17 +1,27 @@
+import bisect
+import collections
+import heapq
+import importlib
 import json
 import logging
 import io
 import os
 import re
+import signal
 import string
 import subprocess
 import sys
 import time
+import traceback
 import uuid
 
 from random import choice
 
-from twisted.internet import reactor, defer
+# A zygote forks every session from the same process. It never installs a
+# reactor, every session installs its own after the fork, see runZygote().
+if '--zygote' not in sys.argv:
+    from twisted.internet import reactor
+from twisted.internet import defer, error, fdesc, protocol, task, threads
 from twisted.internet.task import deferLater
 from twisted.internet.defer import CancelledError
 from twisted.python import log
@@ -22,6 +32,8 @@ from twisted.web.static import File
 
 from wslink import upload
 
+import image_catalog
+
 try:
     import argparse
 except ImportError:
@@ -41,11 +53,39 @@ Here is a sample of what a configuration file could look like:
             "port" : 8080,
             "endpoint": "paraview",                   // SessionManager Endpoint
             "content": "/.../www",                    // Optional: Directory shared over HTTP
-            "proxy_file" : "/.../proxy-mapping.txt",  // Proxy-Mapping file for Apache
+            "proxy_file" : "/.../proxy-mapping.txt",  // Proxy-Mapping file for Apache (see -t for the type)
             "sessionURL" : "ws://${host}:${port}/ws", // ws url used by the client to connect to the started process
             "timeout" : 25,                           // Wait time in second after process start
             "log_dir" : "/.../viz-logs",              // Directory for log files
             "upload_dir" : "/.../data",               // If launcher should act as upload server, where to put files
+            "placement" : "most_free_ports",          // Host choice: most_free_ports, least_loaded or uid_affinity
+            "load_interval" : 5,                      // Seconds between CPU/RSS samples of the sessions (Linux)
+            "reap_interval" : 5,                      // Seconds between sweeps for ended and idle sessions
+            "metrics" : "metrics",                    // Path of the Prometheus metrics page, "" to disable
+            "queue" : {                               // Optional: hold launches open while all resources are taken
+                "size" : 50,                          // Most launches waiting at once (0: answer 503 right away)
+                "max_wait" : 120,                     // Seconds a launch waits before it gets a 503
+                "policy" : "fair",                    // fifo, or fair: users take turns
+                "user_field" : "user"                 // Launch variable naming the user, default the client address
+            },                                        // Clients may send a unique "ticket" and GET queue/<ticket> for
+                                                      // their queue position
+            "idle_timeout" : 1800,                    // Optional: stop sessions without client interaction for that
+                                                      // many seconds (0: never). Apps can override it, see session_control.py
+            "zygote" : {                              // Optional: fork apps with "zygote": true from a preloaded parent (POSIX only)
+                "cmd": ["${vtkpython}", "./launcher.py", "--zygote", "./launcher.config"], // Default: this launcher and config
+                "preload": ["vtk", "vtk.web.wslink", "mysql.connector"]  // Modules imported once before forking, they must not
+                                                      // import the Twisted reactor
+            },
+            "catalog" : {                             // Optional: refuse launches of series without images (404) before
+                "type" : "mysql",                     // starting anything, and pass the file count on as ${series_files}.
+                "host" : "localhost",                 // mysql (credentials.py) or sqlite with "path", see image_catalog.py
+                "database" : "iqweb",
+                "header_index" : "/.../headers.db",   // Optional: with the header index also ${series_voxels}, see header_index.py
+                "pool_size" : 4,                      // Pooled database connections
+                "cache_size" : 256,                   // Series kept in the LRU cache
+                "max_age" : 300,                      // Seconds before a cached series is looked up again
+                "uid_field" : "uid"                   // Launch variable holding the series uid
+            },
             "fields" : ["file", "host", "port", "updir"]     // List of fields that should be send back to client
                                                              // include "secret" if you provide it as an --authKey to the app
             "sanitize": {                             // Check information coming from the client
@@ -87,7 +127,8 @@ Here is a sample of what a configuration file could look like:
             "vtk_python_path": "/.../VTK/build/Wrapping/Python/vtk/web",
             "pv_python_path": "/.../ParaView/build/lib/site-packages/paraview/web",
             "plugins_path": "/.../ParaView/build/lib",
-            "dataDir": "/.../path/to/data/directory"
+            "dataDir": "/.../path/to/data/directory",
+            "seriesCache": "/.../path/to/series/cache"
         },
 
         // ===============================
@@ -150,7 +191,48 @@ Here is a sample of what a configuration file could look like:
                     "your_shell_script.sh", "--resource-host", "${host}", "--resource-port", "${port}",
                     "--session-id", "${id}", "--generated-password", "${secret}",
                     "--application-key", "${application}" ],
-                "ready_line": "Output line from your shell script indicating process is ready"
+                "ready_line": "Output line from your shell script indicating process is ready",
+                "reports_interaction": false           // Never stopped by idle_timeout, for apps that do not print
+                                                      // interaction reports (see session_control.py)
+            },
+            "pooled_app": {
+                "cmd": [
+                    "${vtkpython}", "./pv_vtk_vrt.py", "--port", "${port}", "--authKey", "${secret}",
+                    "--content", "${uid}" ],
+                "ready_line" : "Starting factory",
+                "pool_size" : 2,                      // Number of idle processes kept started ahead of launches.
+                                                      // The app must accept --pooled (see session_control.py)
+                "pool_fields" : ["uid", "orientation"] // Variables handed over on stdin when a launch takes a process
+            },
+            "forked_app": {
+                "cmd": [
+                    "${vtkpython}", "./vtk_4view.py", "--port", "${port}", "--authKey", "${secret}",
+                    "--content", "${uid}" ],
+                "ready_line" : "Starting factory",
+                "zygote" : true                       // Fork from the zygote, the script must provide main(argv)
+            },
+            "shared_app": {
+                "cmd": [
+                    "${vtkpython}", "./vtk_vrt.py", "--port", "${port}", "--authKey", "${secret}",
+                    "--content", "${uid}" ],
+                "ready_line" : "Starting factory",
+                "share" : true,                       // Launches of the same series join one process, each client
+                                                      // with its own secret. The app must accept --shared (see session_control.py)
+                "share_fields" : ["uid", "orientation"] // Variables that, with the application, identify the series
+            },
+            "cached_app": {
+                "cmd": [
+                    "${vtkpython}", "./vtk_mpr.py", "--port", "${port}", "--authKey", "${secret}",
+                    "--content", "${uid}", "--upload-directory", "${orientation}",
+                    "--cache-dir", "${seriesCache}", "--cache-size", "20480", // Keep up to 20 GB of decoded series (see series_cache.py)
+                    "--shared-volumes",                  // Map one copy of every open series into all processes on
+                                                         // the host (see shared_volumes.py, POSIX only)
+                    "--out-of-core-size", "2048",        // MPR of series above 2 GB reads bricks, at most
+                    "--brick-cache-size", "256",         // 256 MB of them in memory (see bricked_volume.py)
+                    "--compact-storage",                 // Keep 16 bit stored values, rescale in the lookup tables
+                    "--decode-processes", "0" ],         // Decode compressed series in one process per core
+                "ready_line" : "Starting factory"
+            }
         }
     }
 """
@@ -249,59 +331,251 @@ def filterResponse(obj, public_keys):
 # -----------------------------------------------------------------------------
 
 def extractSessionId(request):
-    path = request.path.split('/')
+    # twisted hands the path over as bytes on Python 3
+    path = request.path
+    if isinstance(path, bytes):
+        path = path.decode('utf-8')
+    path = path.split('/')
     if len(path) < 3:
        return None
     return str(path[2])
 
+# Queued launches are asked for under their own path, <endpoint>/queue/<ticket>,
+# apart from the session ids
+QUEUE_PATH = 'queue'
+
+def extractQueueTicket(request):
+    path = request.path
+    if isinstance(path, bytes):
+        path = path.decode('utf-8')
+    path = path.split('/')
+    if len(path) < 4 or path[2] != QUEUE_PATH:
+       return None
+    return str(path[3])
+
 def jsonResponse(payload):
     return json.dumps(payload, ensure_ascii = False).encode('utf8')
+
+# =============================================================================
+# Metrics
+# =============================================================================
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+def observe(histograms, key, value):
+    if not key in histograms:
+        histograms[key] = Histogram()
+    histograms[key].observe(value)
+
+class MetricsText(object):
+    """
+    Build a page in the Prometheus text exposition format. Tables map a
+    tuple of label values to a number, or to a Histogram.
+    """
+    def __init__(self):
+        self.lines = []
+
+    def _labels(self, names, values, extra=()):
+        pairs = list(zip(names, values)) + list(extra)
+        if not pairs:
+            return ''
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{%s}' % ','.join(['%s="%s"' % (name, escape(value)) for name, value in pairs])
+
+    def add(self, name, kind, help, names, table):
+        self.lines.append("# HELP %s %s" % (name, help))
+        self.lines.append("# TYPE %s %s" % (name, kind))
+        for key in sorted(table):
+            value = table[key]
+            if kind != 'histogram':
+                self.lines.append("%s%s %s" % (name, self._labels(names, key), repr(float(value))))
+                continue
+            cumulative = 0
+            for bound, count in zip(list(value.buckets) + ['+Inf'], value.counts):
+                cumulative += count
+                self.lines.append("%s_bucket%s %d" % (name, self._labels(names, key, [('le', bound)]), cumulative))
+            self.lines.append("%s_sum%s %s" % (name, self._labels(names, key), repr(value.sum)))
+            self.lines.append("%s_count%s %d" % (name, self._labels(names, key), value.count))
+
+    def render(self):
+        return ('\n'.join(self.lines) + '\n').encode('utf-8')
 # =============================================================================
 # Session manager
 # =============================================================================
 
+# Variables a pooled process receives over stdin once a launch takes it
+DEFAULT_POOL_FIELDS = ["uid", "orientation"]
+
+# Variables that, with the application, tell which launches may share a process
+DEFAULT_SHARE_FIELDS = ["uid", "orientation"]
+
+def processId(session):
+    """
+    Id the process of a session is registered under. Clients that joined a
+    shared session point to the session that started the process.
+    """
+    return session.get('process', session['id'])
+
 class SessionManager(object):
 
     def __init__(self, config, mapping):
         self.sessions = {}
+        self.shared = {}
+        self.clients = {}
         self.config = config
-        self.resources = ResourceManager(config["resources"])
+        self.resources = ResourceManager(config["resources"], config["configuration"].get("placement", "most_free_ports"))
         self.mapping = mapping
         self.sanitize = config["configuration"]["sanitize"]
 
-    def createSession(self, options):
-        # Assign id and store options
-        id = str(uuid.uuid1())
+    def createSession(self, options, reserved=None):
+        # Assign id and store options, a pooled process keeps the one it got
+        id = reserved['id'] if reserved else str(uuid.uuid1())
 
         # Assign resource to session
-        host, port = self.resources.getNextResource()
+        if reserved:
+            host, port = reserved['host'], reserved['port']
+        else:
+            host, port = self.resources.getNextResource(options)
 
         # Do we have resources
         if host:
             options['id'] = id
             options['host'] = host
             options['port'] = port
-            if not 'secret' in options:
+            if reserved:
+                # The pooled process already runs with its own secret
+                options['secret'] = reserved['secret']
+            elif not 'secret' in options:
                 options['secret'] = generatePassword()
             options['sessionURL'] = replaceVariables(self.config['configuration']['sessionURL'], [options, self.config['properties']], self.sanitize)
-            options['cmd'] = replaceList(self.config['apps'][options['application']]['cmd'], [options, self.config['properties']], self.sanitize)
+            if reserved:
+                options['cmd'] = reserved['cmd']
+            else:
+                options['cmd'] = replaceList(self.config['apps'][options['application']]['cmd'], [options, self.config['properties']], self.sanitize)
+                if self.isShared(options['application']):
+                    options['cmd'].append('--shared')
 
             if 'sessionData' in self.config :
                 for key in self.config['sessionData'] :
                     options[key] = replaceVariables(self.config['sessionData'][key], [options, self.config['properties']], self.sanitize)
 
             self.sessions[id] = options
-            self.mapping.update(self.sessions)
+            self.mapping.add(id, host, port)
+
+            key = self.shareKey(options)
+            if key:
+                self.shared[key] = id
+                self.clients[id] = set([id])
+
             return options
 
         return None
 
+    def isShared(self, application):
+        return self.config['apps'][application].get('share', False)
+
+    def shareKey(self, options):
+        if not self.isShared(options['application']):
+            return None
+        fields = self.config['apps'][options['application']].get('share_fields', DEFAULT_SHARE_FIELDS)
+        return (options['application'],) + tuple(str(options.get(key, '')) for key in fields)
+
+    def attachSession(self, options):
+        """
+        Add a client to the running session of the same application and
+        series, if the application shares them. The client gets its own id
+        and secret but the host, port and process of that session.
+        """
+        key = self.shareKey(options)
+        if not key in self.shared:
+            return None
+
+        process = self.shared[key]
+        running = self.sessions[next(iter(self.clients[process]))]
+        id = str(uuid.uuid1())
+        options['id'] = id
+        options['process'] = process
+        options['host'] = running['host']
+        options['port'] = running['port']
+        if not 'secret' in options:
+            options['secret'] = generatePassword()
+        options['sessionURL'] = replaceVariables(self.config['configuration']['sessionURL'], [options, self.config['properties']], self.sanitize)
+        options['cmd'] = running['cmd']
+
+        if 'sessionData' in self.config :
+            for key in self.config['sessionData'] :
+                options[key] = replaceVariables(self.config['sessionData'][key], [options, self.config['properties']], self.sanitize)
+
+        self.sessions[id] = options
+        self.clients[process].add(id)
+        self.mapping.add(id, options['host'], options['port'])
+        return options
+
+    def reserveSession(self, application):
+        """
+        Assign id, host, port and secret for a process that is started ahead
+        of any launch request. The variables listed in 'pool_fields' are not
+        known yet and are left empty on the command line.
+        """
+        host, port = self.resources.getNextResource({ 'application': application })
+        if not host:
+            return None
+
+        app = self.config['apps'][application]
+        reserved = { 'application': application, 'id': str(uuid.uuid1()), 'host': host, 'port': port, 'secret': generatePassword() }
+        for key in app.get('pool_fields', DEFAULT_POOL_FIELDS):
+            reserved[key] = ''
+        reserved['cmd'] = replaceList(app['cmd'], [reserved, self.config['properties']], self.sanitize) + ['--pooled']
+        if self.isShared(application):
+            reserved['cmd'].append('--shared')
+        return reserved
+
+    def releaseReservation(self, reserved):
+        self.resources.freeResource(reserved['host'], reserved['port'])
+
     def deleteSession(self, id):
-        host = self.sessions[id]['host']
-        port = self.sessions[id]['port']
-        self.resources.freeResource(host, port)
-        del self.sessions[id]
-        self.mapping.update(self.sessions)
+        """
+        Remove a session. Return True if its process has no client left and
+        the resource was freed, False if other clients still share it.
+        """
+        session = self.sessions.pop(id)
+        self.mapping.remove(id)
+
+        process = processId(session)
+        if process in self.clients:
+            self.clients[process].discard(id)
+            if self.clients[process]:
+                return False
+            del self.clients[process]
+            key = self.shareKey(session)
+            if self.shared.get(key) == process:
+                del self.shared[key]
+
+        self.resources.freeResource(session['host'], session['port'])
+        return True
+
+    def releaseProcess(self, process):
+        """
+        Remove every session served by the process registered under that id.
+        """
+        for id in list(self.clients.get(process, [process])):
+            if id in self.sessions:
+                self.deleteSession(id)
 
     def getSession(self, id):
         if id in self.sessions:
@@ -314,53 +588,258 @@ class SessionManager(object):
 
 class ProxyMappingManager(object):
 
-    def update(sessions):
+    def update(self, sessions):
         pass
 
-class ProxyMappingManagerTXT(ProxyMappingManager):
+    def add(self, id, host, port):
+        pass
 
+    def remove(self, id):
+        pass
+
+class ProxyMappingManagerTXT(ProxyMappingManager):
+    """
+    Text mapping, one "id host:port" line per session. The whole file is
+    written to a temporary file which then replaces the mapping, so the
+    proxy never reads a half written file.
+    """
     def __init__(self, file_path, pattern="%s %s:%d\n"):
         self.file_path = file_path
         self.pattern = pattern
+        self.entries = collections.OrderedDict()
+
+    def update(self, sessions):
+        self.entries = collections.OrderedDict()
+        for id in sessions:
+            self.entries[id] = (sessions[id]['host'], sessions[id]['port'])
+        self._write()
+
+    def add(self, id, host, port):
+        self.entries[id] = (host, port)
+        self._write()
+
+    def remove(self, id):
+        if id in self.entries:
+            del self.entries[id]
+            self._write()
+
+    def _write(self):
+        content = ''.join([self.pattern % (id, host, port) for id, (host, port) in self.entries.items()])
+        tmp_path = self.file_path + ".tmp"
+        with io.open(tmp_path, "w", encoding="utf-8") as map_file:
+            map_file.write(content)
+        try:
+            os.replace(tmp_path, self.file_path)
+        except OSError:
+            # Windows refuses to replace a file the proxy holds open
+            logging.warning("Unable to replace %s, rewriting it in place" % self.file_path)
+            with io.open(self.file_path, "w", encoding="utf-8") as map_file:
+                map_file.write(content)
+
+class ProxyMappingManagerDBM(ProxyMappingManager):
+    """
+    dbm mapping (id -> host:port, e.g. for an Apache RewriteMap of type
+    dbm). Creating or deleting a session only writes its own key.
+    """
+    def __init__(self, file_path, pattern="%s:%d"):
+        import dbm
+        self.pattern = pattern
+        self.db = dbm.open(file_path, 'n')
+        if dbm.whichdb(file_path) == 'dbm.dumb':
+            logging.warning("Only dbm.dumb is available, it rewrites its whole index on every change")
+
+    def update(self, sessions):
+        for key in list(self.db.keys()):
+            del self.db[key]
+        for id in sessions:
+            self.db[id.encode('utf-8')] = (self.pattern % (sessions[id]['host'], sessions[id]['port'])).encode('utf-8')
+        self._sync()
+
+    def add(self, id, host, port):
+        self.db[id.encode('utf-8')] = (self.pattern % (host, port)).encode('utf-8')
+        self._sync()
+
+    def remove(self, id):
+        try:
+            del self.db[id.encode('utf-8')]
+        except KeyError:
+            return
+        self._sync()
+
+    def _sync(self):
+        if hasattr(self.db, 'sync'):
+            self.db.sync()
+
+class ProxyMappingManagerSQLite(ProxyMappingManager):
+    """
+    SQLite mapping, table proxy(id, target) with target as host:port. The
+    database runs in WAL mode so a reading proxy never blocks the launcher.
+    """
+    def __init__(self, file_path, pattern="%s:%d"):
+        import sqlite3
+        self.pattern = pattern
+        self.db = sqlite3.connect(file_path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS proxy (id TEXT PRIMARY KEY, target TEXT NOT NULL)")
+        self.db.execute("DELETE FROM proxy")
+        self.db.commit()
 
     def update(self, sessions):
-        with io.open(self.file_path, "w", encoding="utf-8") as map_file:
-            for id in sessions:
-                map_file.write(self.pattern % (id, sessions[id]['host'], sessions[id]['port']))
+        with self.db:
+            self.db.execute("DELETE FROM proxy")
+            self.db.executemany("INSERT INTO proxy (id, target) VALUES (?, ?)",
+                [(id, self.pattern % (sessions[id]['host'], sessions[id]['port'])) for id in sessions])
+
+    def add(self, id, host, port):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO proxy (id, target) VALUES (?, ?)", (id, self.pattern % (host, port)))
+
+    def remove(self, id):
+        with self.db:
+            self.db.execute("DELETE FROM proxy WHERE id = ?", (id,))
+
+PROXY_MAPPING_MANAGERS = {
+    'txt': ProxyMappingManagerTXT,
+    'dbm': ProxyMappingManagerDBM,
+    'sqlite': ProxyMappingManagerSQLite,
+}
 
 # =============================================================================
 # Resource manager
 # =============================================================================
 
+class PlacementPolicy(object):
+    """
+    Decide which host gets the next session. The resource manager calls
+    hostChanged() whenever the free ports or the load of a host change,
+    selectHost() must only return a host with free ports.
+    """
+    def __init__(self, resources):
+        self.resources = resources
+        self.heap = []
+        for host in resources.hosts():
+            self.hostChanged(host)
+
+    def key(self, host):
+        raise NotImplementedError
+
+    def hostChanged(self, host):
+        # Entries are never updated in place, stale ones are dropped when
+        # they reach the top of the heap.
+        heapq.heappush(self.heap, (self.key(host), host))
+        if len(self.heap) > 4 * len(self.resources.resources) + 16:
+            self.heap = [(self.key(h), h) for h in self.resources.hosts()]
+            heapq.heapify(self.heap)
+
+    def selectHost(self, options):
+        while len(self.heap) > 0:
+            key, host = self.heap[0]
+            if key == self.key(host) and self.resources.freeCount(host) > 0:
+                return host
+            heapq.heappop(self.heap)
+        return None
+
+    def acquired(self, host, options):
+        pass
+
+class MostFreePortsPolicy(PlacementPolicy):
+    def key(self, host):
+        return -self.resources.freeCount(host)
+
+class LeastLoadedPolicy(PlacementPolicy):
+    """
+    Prefer the host with the lowest reported CPU usage, then RSS.
+    """
+    def key(self, host):
+        cpu, rss = self.resources.load[host]
+        return (cpu, rss, -self.resources.freeCount(host))
+
+class UidAffinityPolicy(MostFreePortsPolicy):
+    """
+    Send sessions of a series to the host that opened it last, where its
+    files are likely still in the page cache. Other series go to the host
+    with the most free ports.
+    """
+    def __init__(self, resources, size=1024):
+        self.affinity = collections.OrderedDict()
+        self.size = size
+        super(UidAffinityPolicy, self).__init__(resources)
+
+    def selectHost(self, options):
+        uid = options.get('uid') if options else None
+        host = self.affinity.get(uid)
+        if host and self.resources.freeCount(host) > 0:
+            return host
+        return super(UidAffinityPolicy, self).selectHost(options)
+
+    def acquired(self, host, options):
+        uid = options.get('uid') if options else None
+        if not uid:
+            return
+        self.affinity.pop(uid, None)
+        self.affinity[uid] = host
+        if len(self.affinity) > self.size:
+            self.affinity.popitem(last=False)
+
+PLACEMENT_POLICIES = {
+    'most_free_ports': MostFreePortsPolicy,
+    'least_loaded': LeastLoadedPolicy,
+    'uid_affinity': UidAffinityPolicy,
+}
+
 class ResourceManager(object):
     """
     Class that provides methods to keep track on available resources (host/port)
+
+    Free ports of a host are kept in a heap and used ones in a set, so
+    acquiring and releasing a port is O(log n).
     """
-    def __init__(self, resourceList):
+    def __init__(self, resourceList, placement='most_free_ports'):
         self.resources = {}
+        self.load = {}
         for resource in resourceList:
             host = resource['host']
             portList = list(range(resource['port_range'][0],resource['port_range'][1]+1))
             if host in self.resources:
                 self.resources[host]['available'].extend(portList)
             else:
-                self.resources[host] = { 'available': portList, 'used': []}
+                self.resources[host] = { 'available': portList, 'used': set()}
+                self.load[host] = (0.0, 0)
+        for host in self.resources:
+            heapq.heapify(self.resources[host]['available'])
+
+        if not placement in PLACEMENT_POLICIES:
+            logging.error("Unknown placement %s, using most_free_ports" % placement)
+            placement = 'most_free_ports'
+        self.policy = PLACEMENT_POLICIES[placement](self)
 
-    def getNextResource(self):
+    def hosts(self):
+        return list(self.resources.keys())
+
+    def freeCount(self, host):
+        return len(self.resources[host]['available'])
+
+    def portCount(self, host):
+        return len(self.resources[host]['available']) + len(self.resources[host]['used'])
+
+    def hasFree(self):
+        for host in self.resources:
+            if self.resources[host]['available']:
+                return True
+        return False
+
+    def getNextResource(self, options=None):
         """
         Return a (host, port) pair if any available otherwise will return None
         """
-        # find host with max availibility
-        winner = None
-        availibilityCount = 0
-        for host in self.resources:
-            if availibilityCount < len(self.resources[host]['available']):
-                availibilityCount = len(self.resources[host]['available'])
-                winner = host
+        winner = self.policy.selectHost(options)
 
         if winner:
-            port = self.resources[winner]['available'].pop()
-            self.resources[winner]['used'].append(port)
+            port = heapq.heappop(self.resources[winner]['available'])
+            self.resources[winner]['used'].add(port)
+            self.policy.acquired(winner, options)
+            self.policy.hostChanged(winner)
             return (winner, port)
 
         return (None, None)
@@ -371,18 +850,252 @@ class ResourceManager(object):
         """
         if host in self.resources and port in self.resources[host]['used']:
             self.resources[host]['used'].remove(port)
-            self.resources[host]['available'].append(port)
+            heapq.heappush(self.resources[host]['available'], port)
+            self.policy.hostChanged(host)
+
+    def reportLoad(self, host, cpu, rss):
+        """
+        Record the CPU usage (in cores) and resident memory (in bytes) of
+        the sessions running on host.
+        """
+        if host in self.load and self.load[host] != (cpu, rss):
+            self.load[host] = (cpu, rss)
+            self.policy.hostChanged(host)
+
+# =============================================================================
+# Process handles
+# =============================================================================
+
+# Seconds between log reads when the output of a process is not piped to us,
+# before and after the process got ready
+LOG_POLL_INTERVAL = 0.1
+LOG_POLL_READY_INTERVAL = 1.0
+
+# Render processes report client activity with this prefix (see session_control.py)
+INTERACTION_PREFIX = b"Last interaction "
+
+# Longest partial output line kept while waiting for its end
+MAX_LINE_LENGTH = 4096
+
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = 4096
+
+class ReadyLineScanner(object):
+    """
+    Look for the ready line in process output as it arrives. The Deferreds
+    returned by whenReady() fire with True once the line shows up, or with
+    False if the process ended before. The ones from whenEnded() fire when
+    the output ends. Interaction reports update lastInteraction.
+    """
+    def __init__(self, logFilePath, ready_line):
+        self.logFilePath = logFilePath
+        self.ready_line = ready_line.encode('utf-8') if ready_line else None
+        self.ready = False
+        self.readyResult = None
+        self.waiting = []
+        self.ending = []
+        self.ended = False
+        self.tail = b''
+        self.line = b''
+        self.startTime = time.time()
+        self.readyTime = None
+        self.lastInteraction = None
+
+    def scan(self, data):
+        self._scanInteraction(data)
+        if self.ready or not self.ready_line:
+            return
+
+        # Keep enough of the previous chunk to find a line split across reads
+        window = self.tail + data
+        if self.ready_line in window:
+            self.ready = True
+            self.readyTime = time.time()
+            self.tail = b''
+            self._fireReady(True)
+        else:
+            keep = len(self.ready_line) - 1
+            self.tail = window[-keep:] if keep > 0 else b''
+
+    def _scanInteraction(self, data):
+        if not INTERACTION_PREFIX in data and not self.line:
+            return
+
+        lines = (self.line + data).split(b'\n')
+        self.line = lines.pop()
+        if not INTERACTION_PREFIX in self.line or len(self.line) > MAX_LINE_LENGTH:
+            self.line = b''
+
+        for line in lines:
+            index = line.find(INTERACTION_PREFIX)
+            if index < 0:
+                continue
+            try:
+                reported = float(line[index + len(INTERACTION_PREFIX):].strip())
+            except ValueError:
+                continue
+            # Never trust a clock ahead of ours
+            self.lastInteraction = min(reported, time.time())
+
+    def idleTime(self, now):
+        """
+        Seconds since the last reported interaction, or since the process
+        got ready if it never reported one: a client that never connected or
+        only watched is idle too.
+        """
+        # startTime is reset when a pooled process is handed over
+        since = max(self.startTime, self.readyTime or self.startTime)
+        if self.lastInteraction is not None:
+            since = max(since, self.lastInteraction)
+        return now - since
+
+    def outputEnded(self):
+        self.ended = True
+        self._fireReady(False)
+        ending, self.ending = self.ending, []
+        for d in ending:
+            d.callback(self)
+
+    def whenEnded(self):
+        d = defer.Deferred()
+        if self.ended:
+            d.callback(self)
+        else:
+            self.ending.append(d)
+        return d
+
+    def whenReady(self):
+        d = defer.Deferred()
+        if self.readyResult is None:
+            self.waiting.append(d)
+        else:
+            d.callback(self.readyResult)
+        return d
+
+    def _fireReady(self, result):
+        if self.readyResult is not None:
+            return
+        self.readyResult = result
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(result)
+
+class SessionProcess(protocol.ProcessProtocol, ReadyLineScanner):
+    """
+    Process spawned through the reactor. Its output is written to the
+    session log and scanned for the ready line as it arrives.
+    """
+    def __init__(self, logFilePath, ready_line):
+        ReadyLineScanner.__init__(self, logFilePath, ready_line)
+        self.log_file = io.open(logFilePath, mode="ab")
+        self.exitCode = None
+
+    @property
+    def pid(self):
+        return self.transport.pid
+
+    def outReceived(self, data):
+        self.log_file.write(data)
+        self.log_file.flush()
+        self.scan(data)
+
+    errReceived = outReceived
+
+    def processEnded(self, reason):
+        self.exitCode = getattr(reason.value, 'exitCode', None)
+        if self.exitCode is None:
+            self.exitCode = -1
+        self.log_file.close()
+        self.outputEnded()
+
+    def poll(self):
+        return self.exitCode if self.ended else None
 
+    def write(self, data):
+        self.transport.write(data)
+
+    def terminate(self):
+        try:
+            self.transport.signalProcess('TERM')
+        except error.ProcessExitedAlready:
+            pass
+
+class PolledProcess(ReadyLineScanner):
+    """
+    subprocess.Popen fallback for platforms where the reactor cannot spawn
+    processes (Windows without pywin32). New bytes of the session log are
+    scanned every LOG_POLL_INTERVAL seconds, less often once ready.
+    """
+    def __init__(self, cmd, logFilePath, ready_line, stdin=None):
+        ReadyLineScanner.__init__(self, logFilePath, ready_line)
+        with io.open(logFilePath, mode="ab") as log_file:
+            self.offset = log_file.tell()
+            self.proc = subprocess.Popen(cmd, stdin=stdin, stdout=log_file, stderr=log_file)
+        self.pid = self.proc.pid
+        self.watcher = task.LoopingCall(self._readLog)
+        self.watcher.start(LOG_POLL_INTERVAL, now=False)
+
+    def _readLog(self):
+        running = self.proc.poll() is None
+        with io.open(self.logFilePath, mode="rb") as log_file:
+            log_file.seek(self.offset)
+            data = log_file.read()
+        self.offset += len(data)
+        self.scan(data)
+
+        if not running:
+            self.watcher.stop()
+            self.outputEnded()
+        elif self.ready and self.watcher.interval == LOG_POLL_INTERVAL:
+            self.watcher.stop()
+            self.watcher = task.LoopingCall(self._readLog)
+            self.watcher.start(LOG_POLL_READY_INTERVAL, now=False)
+
+    def poll(self):
+        return self.proc.poll()
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+        self.proc.stdin.flush()
+
+    def terminate(self):
+        self.proc.terminate()
+
+def processUsage(pid):
+    """
+    Return (cpu seconds, resident bytes) of a process or None. Reads /proc,
+    so only available on Linux.
+    """
+    try:
+        with io.open("/proc/%d/stat" % pid, mode="rb") as stat_file:
+            fields = stat_file.read().rsplit(b')', 1)[1].split()
+        with io.open("/proc/%d/statm" % pid, mode="rb") as statm_file:
+            pages = int(statm_file.read().split()[1])
+        cpu = (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+    return (cpu, pages * PAGE_SIZE)
 
 # =============================================================================
 # Process manager
 # =============================================================================
 
 class ProcessManager(object):
-    def __init__(self, configuration):
+    def __init__(self, configuration, zygote=None):
         self.config = configuration
         self.log_dir = configuration['configuration']['log_dir']
         self.processes = {}
+        self.zygote = zygote
+        self.readyLatency = {}
+        self.spawnLatency = {}
+        self.reaped = collections.Counter()
+        self.failed = collections.Counter()
+        self.lastCpu = {}
+        self.applications = {}
+        # Called with the session id as soon as a session process ends
+        self.onProcessEnded = None
 
     def __del__(self):
         for id in self.processes:
@@ -391,25 +1104,133 @@ class ProcessManager(object):
     def _getLogFilePath(self, id):
         return "%s%s%s.txt" % (self.log_dir, os.sep, id)
 
-    def startProcess(self, session):
+    def startProcess(self, session, pooled=False):
+        begin = time.time()
+        proc = self._spawn(session, pooled)
+        if proc:
+            observe(self.spawnLatency, (session['application'],), time.time() - begin)
+        else:
+            self.failed[(session['application'], 'spawn')] += 1
+        return proc
+
+    def _spawn(self, session, pooled):
         proc = None
 
         # Create output log file
         logFilePath = self._getLogFilePath(session['id'])
-        with io.open(logFilePath, mode="a+", buffering=1, encoding="utf-8") as log_file:
+        ready_line = self.config['apps'][session['application']].get('ready_line', None)
+
+        # A pooled process waits for its session variables on stdin and a
+        # shared one for the secrets of further clients
+        app = self.config['apps'][session['application']]
+        keepStdin = pooled or app.get('share', False)
+
+        # Fork from the zygote when the application allows it
+        if self.zygote and not keepStdin and app.get('zygote', False):
+            proc = self.zygote.spawn(session['cmd'], logFilePath, ready_line)
+            if proc:
+                self._register(session, proc)
+                return proc
+            logging.warning("Zygote could not start session %s, starting a new process" % session['id'])
+
+        try:
+            proc = SessionProcess(logFilePath, ready_line)
             try:
-                proc = subprocess.Popen(session['cmd'], stdout=log_file, stderr=log_file)
-                self.processes[session['id']] = proc
-            except:
-                logging.error("The command line failed")
-                logging.error(' '.join(map(str, session['cmd'])))
-                return None
+                reactor.spawnProcess(proc, session['cmd'][0], session['cmd'], env=os.environ)
+            except (ImportError, NotImplementedError):
+                proc.log_file.close()
+                stdin = subprocess.PIPE if keepStdin else None
+                proc = PolledProcess(session['cmd'], logFilePath, ready_line, stdin)
+            else:
+                if not keepStdin:
+                    proc.transport.closeStdin()
+        except:
+            logging.error("The command line failed")
+            logging.error(' '.join(map(str, session['cmd'])))
+            return None
+
+        # A pooled process only belongs to us once a launch takes it
+        if not pooled:
+            self._register(session, proc)
 
         return proc
 
-    def stopProcess(self, id):
+    def adoptProcess(self, session, proc):
+        """
+        Take over a pooled process for session and hand it the session
+        variables it has been waiting for.
+        """
+        fields = self.config['apps'][session['application']].get('pool_fields', DEFAULT_POOL_FIELDS)
+        assignment = dict((key, session.get(key, '')) for key in fields)
+        try:
+            proc.write((json.dumps(assignment) + '\n').encode('utf-8'))
+        except:
+            logging.error("Unable to hand session %s over to pooled process" % session['id'])
+            return False
+
+        # Time to ready counts from the hand over, not from the pool start
+        proc.startTime = time.time()
+        self._register(session, proc)
+        return True
+
+    def grantSecret(self, session):
+        """
+        Let a client that joined a shared session in with its own secret.
+        """
+        if not self._sendControl(processId(session), { 'secret': session['secret'] }):
+            return False
+        # The joining client gets the full idle_timeout to connect
+        self.processes[processId(session)].lastInteraction = time.time()
+        return True
+
+    def revokeSecret(self, session):
+        return self._sendControl(processId(session), { 'revoke': session['secret'] })
+
+    def _sendControl(self, id, message):
+        if not id in self.processes:
+            return False
+        try:
+            self.processes[id].write((json.dumps(message) + '\n').encode('utf-8'))
+        except:
+            logging.error("Unable to write to the process of session %s" % id)
+            return False
+        return True
+
+    def _register(self, session, proc):
+        self.processes[session['id']] = proc
+        self.applications[session['id']] = session['application']
+        self._reportReady(session, proc)
+        proc.whenEnded().addCallback(self._processEnded, session['id'])
+
+    def _processEnded(self, proc, id):
+        # Ignore processes that were stopped or replaced in the meantime
+        if self.processes.get(id) is proc and self.onProcessEnded:
+            self.onProcessEnded(id)
+
+    def _reportReady(self, session, proc):
+        def report(ready):
+            if not ready:
+                return
+            application = session['application']
+            latency = proc.readyTime - proc.startTime
+            observe(self.readyLatency, (application,), latency)
+            histogram = self.readyLatency[(application,)]
+            logging.info("Session %s (%s) ready after %.3fs, mean %.3fs max %.3fs over %d launches" %
+                (session['id'], application, latency, histogram.sum / histogram.count, histogram.max, histogram.count))
+        proc.whenReady().addCallback(report)
+
+    def stopProcess(self, id, reaped=None, failed=None):
+        """
+        Stop the process of a session. reaped or failed give the reason when
+        the launcher stops it on its own, for the metrics.
+        """
         proc = self.processes[id]
+        if reaped:
+            self.reaped[(self.applications[id], reaped)] += 1
+        if failed:
+            self.failed[(self.applications[id], failed)] += 1
         del self.processes[id]
+        del self.applications[id]
         try:
             proc.terminate()
         except:
@@ -422,45 +1243,501 @@ class ProcessManager(object):
                 session_to_release.append(id)
         return session_to_release
 
+    def listIdleProcess(self):
+        """
+        Return the ids of the ready sessions whose last reported interaction
+        is older than their idle_timeout. Apps with "reports_interaction"
+        false are left alone.
+        """
+        now = time.time()
+        default = float(self.config['configuration'].get('idle_timeout', 0))
+        session_to_evict = []
+        for id in self.processes:
+            if not self.processes[id].ready:
+                continue
+            app = self.config['apps'][self.applications[id]]
+            if not app.get('reports_interaction', True):
+                continue
+            timeout = float(app.get('idle_timeout', default))
+            if timeout > 0 and self.processes[id].idleTime(now) > timeout:
+                session_to_evict.append(id)
+        return session_to_evict
+
     def isRunning(self, id):
         return self.processes[id].poll() is None
 
+    def sampleUsage(self):
+        """
+        Return { id: (cpu, rss) } for the running session processes, with the
+        cores used since the previous call and the resident bytes.
+        """
+        now = time.time()
+        usage = {}
+        for id in self.processes:
+            pid = self.processes[id].pid
+            sample = processUsage(pid) if pid else None
+            if not sample:
+                continue
+            cpuTime, rss = sample
+            cpu = 0.0
+            if id in self.lastCpu:
+                lastCpuTime, lastTime = self.lastCpu[id]
+                cpu = (cpuTime - lastCpuTime) / max(now - lastTime, 0.001)
+            self.lastCpu[id] = (cpuTime, now)
+            usage[id] = (cpu, rss)
+
+        for id in list(self.lastCpu.keys()):
+            if not id in self.processes:
+                del self.lastCpu[id]
+
+        return usage
+
     # ========================================================================
-    # Look for ready line in process output. Return True if found, False
-    # otherwise. If no ready_line is configured and process is running return
-    # False. This will then rely on the timout time.
+    # Return True once the ready line has shown up in the process output.
+    # If no ready_line is configured this stays False and the launch relies
+    # on the timeout.
     # ========================================================================
 
-    def isReady(self, session, count = 0):
-      id = session['id']
+    def isReady(self, session):
+        id = processId(session)
+        if not id in self.processes:
+            return False
+        return self.processes[id].ready
 
-      # The process has to be running to be ready!
-      if not self.isRunning(id) and count < 60:
-        return False
+    def whenReady(self, session):
+        return self.processes[processId(session)].whenReady()
 
-      # Give up after 60 seconds if still not running
-      if not self.isRunning(id):
-        return True
+# =============================================================================
+# Zygote
+# =============================================================================
+
+DEFAULT_ZYGOTE_PRELOAD = ["vtk", "vtk.web.wslink", "mysql.connector"]
+
+def usesZygote(config):
+    for application in config['apps']:
+        if config['apps'][application].get('zygote', False):
+            return True
+    return False
+
+def findScript(cmd):
+    """
+    Return the index of the python script in a command line, or None
+    """
+    for index, item in enumerate(cmd):
+        if item.endswith('.py'):
+            return index
+    return None
+
+def loadScriptModule(script):
+    directory, filename = os.path.split(os.path.abspath(script))
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    return importlib.import_module(os.path.splitext(filename)[0])
+
+class ZygoteProcess(ReadyLineScanner):
+    """
+    Handle on a session forked by the zygote. Its output comes back through
+    a fifo, is written to the session log and scanned for the ready line.
+    The zygote lets the system reap its children, so the end of the output
+    or a pid that is gone means the session ended.
+    """
+    def __init__(self, pid, logFilePath, ready_line):
+        ReadyLineScanner.__init__(self, logFilePath, ready_line)
+        self.pid = pid
+        self.terminated = False
+        self.log_file = io.open(logFilePath, mode="ab")
+
+    def childDataReceived(self, name, data):
+        self.log_file.write(data)
+        self.log_file.flush()
+        self.scan(data)
+
+    def childConnectionLost(self, name, reason):
+        self.log_file.close()
+        self.outputEnded()
+
+    def poll(self):
+        if self.ended:
+            return 0
+        if self.pid is None:
+            return None # the zygote did not answer yet
+        try:
+            os.kill(self.pid, 0)
+        except OSError:
+            return 0
+        return None
+
+    def started(self, pid, fifoFd):
+        """
+        The zygote forked the session, read its output from the fifo
+        """
+        from twisted.internet.process import ProcessReader
+
+        self.pid = pid
+        ProcessReader(reactor, self, 'out', fifoFd)
+        if self.terminated:
+            self.terminate()
+
+    def failed(self):
+        self.log_file.close()
+        self.outputEnded()
+
+    def terminate(self):
+        self.terminated = True
+        if self.pid is None:
+            return # terminated once the zygote answers
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except OSError:
+            pass # already gone
+
+class ZygoteProtocol(protocol.ProcessProtocol):
+    """
+    Talk to the zygote through its stdin and stdout without blocking: one
+    JSON line per request, the replies come back in the same order.
+    """
+    def __init__(self):
+        self.line = b''
+        self.replies = collections.deque()
+        self.running = True
+
+    def request(self, message):
+        """
+        Return a Deferred that fires with the reply to message
+        """
+        d = defer.Deferred()
+        self.replies.append(d)
+        self.transport.write((json.dumps(message) + '\n').encode('utf-8'))
+        return d
+
+    def outReceived(self, data):
+        lines = (self.line + data).split(b'\n')
+        self.line = lines.pop()
+        for line in lines:
+            if not self.replies:
+                logging.error("Unexpected output of the zygote: %r" % line)
+                continue
+            try:
+                reply = json.loads(line.decode('utf-8'))
+            except ValueError:
+                reply = { 'error': "Unreadable reply %r" % line }
+            self.replies.popleft().callback(reply)
+
+    def processEnded(self, reason):
+        self.running = False
+        replies, self.replies = self.replies, collections.deque()
+        for d in replies:
+            d.callback({ 'error': "The zygote ended" })
+
+class ZygoteClient(object):
+    """
+    Start a 'launcher.py --zygote' process and ask it to fork sessions.
+    """
+    def __init__(self, options, config):
+        zygote = config['configuration'].get('zygote', {})
+        cmd = zygote.get('cmd', [sys.executable, os.path.abspath(__file__), '--zygote', options.config[0]])
+        cmd = replaceList(cmd, [config['properties']], {})
+
+        logFilePath = "%s%szygote.txt" % (config['configuration']['log_dir'], os.sep)
+        self.protocol = ZygoteProtocol()
+        with io.open(logFilePath, mode="ab") as log_file:
+            reactor.spawnProcess(self.protocol, cmd[0], cmd, env=os.environ,
+                                 childFDs={ 0: 'w', 1: 'r', 2: log_file.fileno() })
+
+    def fork(self, cmd, outputPath):
+        """
+        Return a Deferred that fires with the pid of a session forked for
+        cmd, its output going to the fifo at outputPath, or fails with the
+        error of the zygote. The first request waits for the zygote to
+        finish its imports.
+        """
+        def forked(reply):
+            if 'error' in reply:
+                raise RuntimeError(reply['error'])
+            return reply['pid']
+        return self.protocol.request({ 'cmd': cmd, 'output': outputPath }).addCallback(forked)
+
+    def spawn(self, cmd, logFilePath, ready_line=None):
+        """
+        Return a ZygoteProcess for cmd, or None if the zygote is not running.
+        Its pid is known once the zygote answers; if it fails the process
+        ends like a session that exited.
+        """
+        if not self.protocol.running:
+            logging.error("Zygote is not running anymore")
+            return None
+
+        # The zygote opens the writing end before it forks, so the child
+        # holds it by the time we get the pid back.
+        fifoPath = os.path.splitext(logFilePath)[0] + ".fifo"
+        os.mkfifo(fifoPath)
+        fifoFd = os.open(fifoPath, os.O_RDONLY | os.O_NONBLOCK)
+        proc = ZygoteProcess(None, logFilePath, ready_line)
+
+        def started(pid):
+            os.unlink(fifoPath)
+            proc.started(pid, fifoFd)
+
+        def failed(failure):
+            os.unlink(fifoPath)
+            os.close(fifoFd)
+            logging.error("Zygote failed to fork: %s" % failure.getErrorMessage())
+            proc.failed()
+
+        self.fork(cmd, fifoPath).addCallbacks(started, failed)
+        return proc
+
+    def stop(self):
+        try:
+            self.protocol.transport.signalProcess('TERM')
+        except:
+            pass # we tried
 
-      application = self.config['apps'][session['application']]
-      ready_line  = application.get('ready_line', None)
+def forkSession(cmd, outputPath):
+    """
+    Fork a child running the main(argv) of the script in cmd with its output
+    going to the fifo at outputPath. Return the pid of the child.
+    """
+    index = findScript(cmd)
+    if index is None:
+        raise ValueError("No python script in %s" % ' '.join(cmd))
+
+    outputFd = os.open(outputPath, os.O_WRONLY | os.O_NONBLOCK)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid != 0:
+        os.close(outputFd)
+        return pid
+
+    exitCode = 1
+    try:
+        # Detach from the zygote and write blocking to the launcher
+        os.setsid()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        fdesc.setBlocking(outputFd)
+        nullFd = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(nullFd, 0)
+        os.dup2(outputFd, 1)
+        os.dup2(outputFd, 2)
+        os.close(outputFd)
+        sys.stdout = os.fdopen(1, 'w', 1)
+        sys.stderr = os.fdopen(2, 'w', 1)
+
+        module = loadScriptModule(cmd[index])
+        sys.argv = cmd[index:]
+        module.main(cmd[index + 1:])
+        exitCode = 0
+    except SystemExit as e:
+        exitCode = e.code if isinstance(e.code, int) else 0
+    except:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exitCode)
+
+def runZygote(config):
+    """
+    Import the render modules once, then fork a session for each request
+    read from stdin. A request is a JSON line { "cmd": [...], "output": fifo },
+    the reply a JSON line { "pid": pid } or { "error": message }.
+    """
+    # Children are reaped by the system, the launcher watches them by pid
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    # The scripts themselves import the Twisted reactor, they are loaded by
+    # each session after the fork. Their directories are on the path, so
+    # preload can name the modules next to them.
+    for application in config['apps']:
+        if not config['apps'][application].get('zygote', False):
+            continue
+        cmd = [string.Template(item).safe_substitute(config['properties']) for item in config['apps'][application]['cmd']]
+        index = findScript(cmd)
+        if index is None:
+            continue
+        directory = os.path.dirname(os.path.abspath(cmd[index]))
+        if directory not in sys.path:
+            sys.path.insert(0, directory)
+
+    zygote = config['configuration'].get('zygote', {})
+    for name in zygote.get('preload', DEFAULT_ZYGOTE_PRELOAD):
+        try:
+            importlib.import_module(name)
+        except:
+            traceback.print_exc()
+
+    # The sessions would share its waker pipe and file descriptors. Exiting
+    # lets the launcher start the sessions as processes of their own.
+    if 'twisted.internet.reactor' in sys.modules:
+        sys.stderr.write("A preloaded module imports the Twisted reactor, remove it from the zygote preload\n")
+        sys.exit(1)
 
-      # If no ready_line is configured and the process is running then thats
-      # enough.
-      if not ready_line:
-          return False
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break # launcher went away
 
-      ready = False
+        try:
+            request = json.loads(line)
+            reply = { 'pid': forkSession(request['cmd'], request['output']) }
+        except:
+            reply = { 'error': str(sys.exc_info()[1]) }
+
+        sys.stdout.write(json.dumps(reply) + '\n')
+        sys.stdout.flush()
 
-      # Check the output for ready_line
-      logFilePath = self._getLogFilePath(session['id'])
-      with io.open(logFilePath, "r", 1, encoding="utf-8") as log_file:
-          for line in log_file.readlines():
-              if ready_line in line:
-                  ready = True
-                  break
+# =============================================================================
+# Process pool
+# =============================================================================
 
-      return ready
+class ProcessPool(object):
+    """
+    Keep 'pool_size' idle processes started per application, so a launch
+    only pays for loading its data instead of interpreter and VTK startup.
+    """
+    def __init__(self, config, session_manager, process_manager):
+        self.config = config
+        self.session_manager = session_manager
+        self.process_manager = process_manager
+        self.idle = {}
+        for application in config['apps']:
+            if int(config['apps'][application].get('pool_size', 0)) > 0:
+                if config['apps'][application].get('zygote', False):
+                    logging.warning("Ignoring pool_size of %s, it is forked from the zygote" % application)
+                    continue
+                self.idle[application] = collections.deque()
+
+    def hasPool(self, application):
+        return application in self.idle
+
+    def fill(self, application):
+        size = int(self.config['apps'][application]['pool_size'])
+        while len(self.idle[application]) < size:
+            reserved = self.session_manager.reserveSession(application)
+            if not reserved:
+                # Out of ports, launches get a fresh process instead
+                return
+
+            proc = self.process_manager.startProcess(reserved, pooled=True)
+            if not proc:
+                self.session_manager.releaseReservation(reserved)
+                return
+
+            self.idle[application].append((reserved, proc))
+
+    def fillAll(self):
+        for application in self.idle:
+            self.fill(application)
+
+    def take(self, application):
+        """
+        Return a (reserved, proc) pair of a running idle process, or
+        (None, None) when the pool is empty.
+        """
+        idle = self.idle[application]
+        while len(idle) > 0:
+            reserved, proc = idle.popleft()
+            if proc.poll() is None:
+                return (reserved, proc)
+            logging.warning("Pooled process %s for %s died while idle" % (reserved['id'], application))
+            self.session_manager.releaseReservation(reserved)
+
+        return (None, None)
+
+    def refill(self, application):
+        # Start replacements once the current request has been handled
+        reactor.callLater(0, self.fill, application)
+
+    def shutdown(self):
+        for application in self.idle:
+            idle = self.idle[application]
+            while len(idle) > 0:
+                reserved, proc = idle.popleft()
+                try:
+                    proc.terminate()
+                except:
+                    pass # we tried
+                self.session_manager.releaseReservation(reserved)
+
+# =============================================================================
+# Launch queue
+# =============================================================================
+
+NO_RESOURCE_MESSAGE = "All the resources are currently taken"
+
+class LaunchQueue(object):
+    """
+    Bounded queue of launch requests waiting for a free resource. With the
+    'fifo' policy they are served in arrival order. With 'fair' every user
+    has a queue of their own and the users take turns, so a user opening
+    many views cannot hold everybody else back.
+    """
+    def __init__(self, size, policy='fifo'):
+        self.size = size
+        self.fair = (policy == 'fair')
+        self.users = collections.OrderedDict()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def push(self, entry, front=False):
+        if self.count >= self.size and not front:
+            return False
+        user = entry['user'] if self.fair else None
+        if not user in self.users:
+            self.users[user] = collections.deque()
+        if front:
+            # The user's turn comes first too, whether they had entries or not
+            self.users.move_to_end(user, last=False)
+            self.users[user].appendleft(entry)
+        else:
+            self.users[user].append(entry)
+        self.count += 1
+        return True
+
+    def pop(self):
+        user = next(iter(self.users))
+        entries = self.users[user]
+        entry = entries.popleft()
+        if entries:
+            # Next turn goes to the user after this one
+            self.users.move_to_end(user)
+        else:
+            del self.users[user]
+        self.count -= 1
+        return entry
+
+    def remove(self, entry):
+        user = entry['user'] if self.fair else None
+        if user in self.users and entry in self.users[user]:
+            self.users[user].remove(entry)
+            if not self.users[user]:
+                del self.users[user]
+            self.count -= 1
+
+    def position(self, ticket):
+        """
+        Return the 1-based place of the entry with that ticket in the order
+        the queue will be served, or None if it is not queued.
+        """
+        turns = [list(entries) for entries in self.users.values()]
+        position = 0
+        for turn in range(max([len(entries) for entries in turns] or [0])):
+            for entries in turns:
+                if turn < len(entries):
+                    position += 1
+                    if entries[turn]['ticket'] == ticket:
+                        return position
+        return None
+
+    def find(self, ticket):
+        for entries in self.users.values():
+            for entry in entries:
+                if entry['ticket'] == ticket:
+                    return entry
+        return None
 
 # ===========================================================================
 # Class to implement requests to POST, GET and DELETE methods
@@ -473,13 +1750,81 @@ class LauncherResource(resource.Resource, object):
         self._config = config
         self.time_to_wait = int(config['configuration']['timeout'])
         self.field_filter = config['configuration']['fields']
-        self.session_manager = SessionManager(config,ProxyMappingManagerTXT(config['configuration']['proxy_file']))
-        self.process_manager = ProcessManager(config)
+        mapping = PROXY_MAPPING_MANAGERS[options.proxyFileType](config['configuration']['proxy_file'])
+        self.session_manager = SessionManager(config, mapping)
+        zygote = None
+        if usesZygote(config):
+            zygote = ZygoteClient(options, config)
+            reactor.addSystemEventTrigger('before', 'shutdown', zygote.stop)
+        self.process_manager = ProcessManager(config, zygote)
+        self.process_pool = ProcessPool(config, self.session_manager, self.process_manager)
+        reactor.callWhenRunning(self.process_pool.fillAll)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.process_pool.shutdown)
+
+        # Release sessions as soon as their process ends, and sweep for ended
+        # or idle ones every reap_interval seconds
+        self.process_manager.onProcessEnded = self._releaseSession
+        reap_interval = float(config['configuration'].get('reap_interval', 5))
+        if reap_interval > 0:
+            self.reaper = task.LoopingCall(self._reapSessions)
+            reactor.callWhenRunning(self.reaper.start, reap_interval, False)
+
+        # Launches that find no free resource wait in a queue if configured
+        queue = config['configuration'].get('queue', {})
+        self.launch_queue = LaunchQueue(int(queue.get('size', 0)), queue.get('policy', 'fifo'))
+        self.queue_wait = float(queue.get('max_wait', 60))
+        self.queue_user = queue.get('user_field', 'user')
+        self.admission = None
+
+        # Series are looked up in the image catalog before launching if configured
+        catalog = config['configuration'].get('catalog')
+        self.catalog = image_catalog.createCatalog(catalog) if catalog else None
+        self.catalog_field = (catalog or {}).get('uid_field', 'uid')
+
+        # Launch metrics, see MetricsResource
+        self.launchLatency = {}
+        self.launchTimeouts = collections.Counter()
+
+        # Feed the CPU/RSS of the sessions to the placement policy
+        load_interval = float(config['configuration'].get('load_interval', 5))
+        if load_interval > 0 and os.path.isdir('/proc'):
+            self.load_sampler = task.LoopingCall(self._reportLoad)
+            reactor.callWhenRunning(self.load_sampler.start, load_interval, False)
 
 
     def getChild(self, path, request):
         return self
 
+    def _releaseSession(self, id):
+        logging.info("Session %s ended, releasing its resource" % id)
+        self.session_manager.releaseProcess(id)
+        self.process_manager.stopProcess(id, reaped='ended')
+        self._resourceFreed()
+
+    def _reapSessions(self):
+        for id in self.process_manager.listEndedProcess():
+            self._releaseSession(id)
+
+        for id in self.process_manager.listIdleProcess():
+            logging.info("Session %s idle for too long, evicting it" % id)
+            self.session_manager.releaseProcess(id)
+            self.process_manager.stopProcess(id, reaped='idle')
+
+        self._resourceFreed()
+
+    def _reportLoad(self):
+        resources = self.session_manager.resources
+        load = dict((host, [0.0, 0]) for host in resources.hosts())
+        usage = self.process_manager.sampleUsage()
+        for id in usage:
+            session = self.session_manager.getSession(id)
+            if session and session['host'] in load:
+                load[session['host']][0] += usage[id][0]
+                load[session['host']][1] += usage[id][1]
+
+        for host in load:
+            resources.reportLoad(host, load[host][0], load[host][1])
+
     def __del__(self):
         try:
             # causes an exception when server is killed with Ctrl-C
@@ -500,26 +1845,101 @@ class LauncherResource(resource.Resource, object):
             request.setResponseCode(http.BAD_REQUEST)
             return jsonResponse({"error": "The request is not complete"})
 
-        # Try to free any available resource
-        id_to_free = self.process_manager.listEndedProcess()
-        for id in id_to_free:
-            self.session_manager.deleteSession(id)
-            self.process_manager.stopProcess(id)
+        # Time the launch until the response is out, queueing included
+        request.notifyFinish().addBoth(self._launchFinished, request, self._applicationLabel(payload), time.time())
 
-        # Create new session
-        session = self.session_manager.createSession(payload)
+        # Try to free any available resource the reaper has not seen yet
+        for id in self.process_manager.listEndedProcess():
+            self._releaseSession(id)
 
-        # No resource available
-        if not session:
-            request.setResponseCode(http.SERVICE_UNAVAILABLE)
-            return jsonResponse({"error": "All the resources are currently taken"})
+        if self.catalog and payload.get(self.catalog_field):
+            self._checkSeries(request, payload)
+            return NOT_DONE_YET
 
-        # Start process
-        proc = self.process_manager.startProcess(session)
+        return self._launch(request, payload)
 
-        if not proc:
+    def _applicationLabel(self, payload):
+        # Only configured names, clients must not be able to add label values
+        return payload['application'] if payload['application'] in self._config['apps'] else 'unknown'
+
+    def _launchFinished(self, result, request, application, begin):
+        observe(self.launchLatency, (application, str(request.code)), time.time() - begin)
+
+    # ========================================================================
+    # Look the series of a launch up in the image catalog, in a thread so the
+    # database does not hold up the reactor, and only launch a known series.
+    # If the catalog itself fails the launch goes ahead unchecked.
+    # ========================================================================
+
+    def _checkSeries(self, request, payload):
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+        d = threads.deferToThread(self.catalog.lookup, payload[self.catalog_field])
+        d.addCallbacks(self._seriesChecked, self._catalogFailed,
+                       callbackArgs=(request, payload, finished), errbackArgs=(request, payload, finished))
+        d.addErrback(log.err)
+
+    def _seriesChecked(self, entry, request, payload, finished):
+        if not entry and not finished:
+            request.setResponseCode(http.NOT_FOUND)
+            request.write(jsonResponse({"error": "Series %s has no images" % payload[self.catalog_field]}))
+            request.finish()
+            return
+
+        if entry:
+            payload['series_files'] = len(entry.paths)
+            if entry.geometry:
+                (xMin, xMax, yMin, yMax, zMin, zMax) = entry.geometry['extent']
+                payload['series_voxels'] = (xMax - xMin + 1) * (yMax - yMin + 1) * (zMax - zMin + 1)
+        self._launchChecked(request, payload, finished)
+
+    def _catalogFailed(self, failure, request, payload, finished):
+        logging.warning("Image catalog lookup failed, launching unchecked: %s" % failure.getErrorMessage())
+        self._launchChecked(request, payload, finished)
+
+    def _launchChecked(self, request, payload, finished):
+        if finished:
+            # The client went away meanwhile
+            return
+
+        result = self._launch(request, payload)
+        if result is not NOT_DONE_YET:
+            request.write(result)
+            request.finish()
+
+    # ========================================================================
+    # Attach or start the session of a launch request. A launch that finds
+    # no free resource, or other launches still waiting, joins the queue and
+    # keeps its request open. queued is the queue entry of an admitted one.
+    # ========================================================================
+
+    def _launch(self, request, payload, queued=None):
+        # Join the running session on the same series if the application
+        # shares them, start a new one otherwise
+        session = self.session_manager.attachSession(payload)
+        if session:
+            logging.info("Session %s joins the process of session %s" % (session['id'], session['process']))
+            error = None
+            if not self.process_manager.grantSecret(session):
+                self.session_manager.deleteSession(session['id'])
+                error = "Unable to join the running session"
+        elif not queued and len(self.launch_queue) > 0:
+            # Do not overtake the launches already waiting
+            session, error = (None, NO_RESOURCE_MESSAGE)
+        else:
+            session, error = self._startSession(payload)
+
+        if error == NO_RESOURCE_MESSAGE and not queued and payload.get('ticket') \
+                and self.launch_queue.find(str(payload['ticket'])):
+            request.setResponseCode(http.CONFLICT)
+            return jsonResponse({"error": "Ticket %s is already in the queue" % payload['ticket']})
+
+        if error == NO_RESOURCE_MESSAGE and self._enqueue(request, payload, queued):
+            return NOT_DONE_YET
+
+        if error:
             request.setResponseCode(http.SERVICE_UNAVAILABLE)
-            return jsonResponse({"error": "The process did not properly start. %s" % str(session['cmd'])})
+            return jsonResponse({"error": error})
 
         # local function to act as errback for Deferred objects.
         def errback(error):
@@ -546,22 +1966,98 @@ class LauncherResource(resource.Resource, object):
         return NOT_DONE_YET
 
 
-    # ========================================================================
-    # Wait for session to be ready. Rather than blocking keep using callLater(...)
-    # to schedule self in reactor. Return a Deferred object whose callback will
-    # be triggered when the session is ready
-    # ========================================================================
+    def _startSession(self, payload):
+        # Take an already started process if the application is pooled
+        reserved, proc = (None, None)
+        if self.process_pool.hasPool(payload['application']):
+            reserved, proc = self.process_pool.take(payload['application'])
+            self.process_pool.refill(payload['application'])
 
-    def _waitForReady(self, session, request, count=0, d=None):
-        if not d:
-            d = defer.Deferred()
+        # Create new session
+        session = self.session_manager.createSession(payload, reserved)
 
-        if not 'startTimedOut' in session and \
-            not self.process_manager.isReady(session, count + 1):
-            reactor.callLater(1, self._waitForReady, session, request, count + 1, d)
+        # No resource available
+        if not session:
+            return (None, NO_RESOURCE_MESSAGE)
+
+        # Hand the session over to the pooled process or start a new one
+        if proc:
+            if not self.process_manager.adoptProcess(session, proc):
+                proc.terminate()
+                proc = None
         else:
-            d.callback(request)
+            proc = self.process_manager.startProcess(session)
+
+        if not proc:
+            self.session_manager.deleteSession(session['id'])
+            self._resourceFreed()
+            return (None, "The process did not properly start. %s" % str(session['cmd']))
+
+        return (session, None)
+
+    def _enqueue(self, request, payload, entry=None):
+        if entry:
+            # Admitted but beaten to the resource, keep the place in line
+            entry['queued'] = self.launch_queue.push(entry, front=True)
+            return True
+
+        user = payload.get(self.queue_user) or request.getClientAddress().host
+        entry = { 'ticket': str(payload.get('ticket') or uuid.uuid1()), 'user': str(user),
+                  'request': request, 'payload': payload, 'time': time.time() }
+        if not self.launch_queue.push(entry):
+            return False
+
+        entry['queued'] = True
+        entry['timer'] = reactor.callLater(self.queue_wait, self._queueTimeout, entry)
+        request.notifyFinish().addErrback(lambda reason: self._leaveQueue(entry))
+        logging.info("Launch of %s for %s queued with ticket %s at position %d" %
+            (payload['application'], entry['user'], entry['ticket'], self.launch_queue.position(entry['ticket'])))
+        return True
+
+    def _leaveQueue(self, entry):
+        if entry['queued']:
+            self.launch_queue.remove(entry)
+            entry['queued'] = False
+        if entry['timer'].active():
+            entry['timer'].cancel()
+
+    def _queueTimeout(self, entry):
+        self._leaveQueue(entry)
+        self.launchTimeouts[(self._applicationLabel(entry['payload']), 'queue')] += 1
+        request = entry['request']
+        request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        request.write(jsonResponse({"error": "No resource became available within %d seconds" % self.queue_wait}))
+        request.finish()
 
+    def _resourceFreed(self):
+        # Admit waiting launches once the current call is done
+        if len(self.launch_queue) > 0 and not (self.admission and self.admission.active()):
+            self.admission = reactor.callLater(0, self._admitQueued)
+
+    def _admitQueued(self):
+        while len(self.launch_queue) > 0 and self.session_manager.resources.hasFree():
+            entry = self.launch_queue.pop()
+            entry['queued'] = False
+            logging.info("Admitting launch with ticket %s after %.1fs" % (entry['ticket'], time.time() - entry['time']))
+
+            result = self._launch(entry['request'], entry['payload'], entry)
+            if entry['queued']:
+                # The free resource went to someone else
+                return
+            entry['timer'].cancel()
+            if result is not NOT_DONE_YET:
+                entry['request'].write(result)
+                entry['request'].finish()
+
+    # ========================================================================
+    # Wait for session to be ready. Return a Deferred object whose callback
+    # will be triggered as soon as the ready line shows up in the process
+    # output, or the process ended before that.
+    # ========================================================================
+
+    def _waitForReady(self, session, request):
+        d = self.process_manager.whenReady(session)
+        d.addCallback(lambda ready: request)
         return d
 
     # ========================================================================
@@ -570,40 +2066,75 @@ class LauncherResource(resource.Resource, object):
     # ========================================================================
 
     def _delayedRenderTimeout(self, request, session):
-        ready = self.process_manager.isReady(session, 0)
+        ready = self.process_manager.isReady(session)
 
         if ready:
             request.write(jsonResponse(filterResponse(session, self.field_filter)))
             request.setResponseCode(http.OK)
         else:
-            request.write(jsonResponse({"error": "Session did not start before timeout expired. Check session logs."}))
-            # Mark the session as timed out and clean up the process
-            session['startTimedOut'] = True
-            self.session_manager.deleteSession(session['id'])
-            self.process_manager.stopProcess(session['id'])
-            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+            self.launchTimeouts[(session['application'], 'ready')] += 1
+            self._startFailed(request, session, "Session did not start before timeout expired. Check session logs.", 'timeout')
+            return
 
         request.finish()
 
     # ========================================================================
     # Called when the process is ready ( the ready line has been read from the
-    # process output).
+    # process output) or ended without getting ready.
     # ========================================================================
 
     def _delayedRenderReady(self, request, session):
+        if not self.process_manager.isReady(session):
+            self._startFailed(request, session, "Session ended before it was ready. Check session logs.", 'exited')
+            return
+
         filterkeys = self.field_filter
-        if session['secret'] in session['cmd']:
+        if session['secret'] in session['cmd'] or 'process' in session:
             filterkeys = self.field_filter + [ 'secret' ]
         request.write(jsonResponse(filterResponse(session, filterkeys)))
         request.setResponseCode(http.OK)
 
         request.finish()
 
+    def _startFailed(self, request, session, message, reason):
+        request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        request.write(jsonResponse({"error": message}))
+        # Mark the session as timed out and clean up the process, unless the
+        # reaper already released it or other clients still wait for it
+        session['startTimedOut'] = True
+        self._removeSession(session, reason)
+        self._resourceFreed()
+        request.finish()
+
+    def _removeSession(self, session, failed=None):
+        released = True
+        if self.session_manager.getSession(session['id']):
+            released = self.session_manager.deleteSession(session['id'])
+
+        process = processId(session)
+        if not process in self.process_manager.processes:
+            return
+        if released:
+            self.process_manager.stopProcess(process, failed=failed)
+        else:
+            self.process_manager.revokeSecret(session)
+
     # =========================================================================
     # Handle GET request
     # =========================================================================
 
     def render_GET(self, request):
+        # A launch still waiting for a resource, asked for by its ticket
+        ticket = extractQueueTicket(request)
+        if ticket:
+            entry = self.launch_queue.find(ticket)
+            if not entry:
+                request.setResponseCode(http.NOT_FOUND)
+                return jsonResponse({"error": "No queued launch with ticket: %s" % ticket})
+            request.setResponseCode(http.OK)
+            return jsonResponse({ "ticket": ticket, "position": self.launch_queue.position(ticket),
+                                  "queued": len(self.launch_queue), "waited": round(time.time() - entry['time'], 1) })
+
         id = extractSessionId(request)
 
         if not id:
@@ -647,15 +2178,73 @@ class LauncherResource(resource.Resource, object):
            request.setResponseCode(http.NOT_FOUND)
            return jsonResponse({"error":message})
 
-        # Remove session
-        self.session_manager.deleteSession(id)
-        self.process_manager.stopProcess(id)
+        # Remove session, a shared process stops with its last client
+        self._removeSession(session)
+        self._resourceFreed()
 
         message = "Deleted session with id: %s" % id
         logging.info(message)
 
         request.setResponseCode(http.OK)
-        return session
+        return jsonResponse(filterResponse(session, self.field_filter))
+
+# =============================================================================
+# Prometheus metrics of a launcher
+# =============================================================================
+
+class MetricsResource(resource.Resource, object):
+    isLeaf = True
+
+    def __init__(self, launcher):
+        super(MetricsResource, self).__init__()
+        self.launcher = launcher
+
+    def render_GET(self, request):
+        sessions = self.launcher.session_manager
+        resources = sessions.resources
+        processes = self.launcher.process_manager
+        pool = self.launcher.process_pool
+
+        active = collections.Counter()
+        for id in sessions.sessions:
+            active[(sessions.sessions[id]['application'],)] += 1
+        running = collections.Counter()
+        for id in processes.applications:
+            running[(processes.applications[id],)] += 1
+        for application in self.launcher._config['apps']:
+            active[(application,)] += 0
+            running[(application,)] += 0
+
+        metrics = MetricsText()
+        metrics.add("launcher_spawn_seconds", "histogram", "Time to spawn or fork a session process.",
+            ["app"], processes.spawnLatency)
+        metrics.add("launcher_ready_seconds", "histogram", "Time from process start, or pool hand over, to its ready line.",
+            ["app"], processes.readyLatency)
+        metrics.add("launcher_launch_seconds", "histogram", "Time from launch request to response, queueing included.",
+            ["app", "code"], self.launcher.launchLatency)
+        metrics.add("launcher_sessions_active", "gauge", "Sessions known to the launcher, shared clients included.",
+            ["app"], active)
+        metrics.add("launcher_processes_running", "gauge", "Session processes owned by the launcher.",
+            ["app"], running)
+        metrics.add("launcher_ports_free", "gauge", "Free ports per host.",
+            ["host"], dict(((host,), resources.freeCount(host)) for host in resources.hosts()))
+        metrics.add("launcher_ports_total", "gauge", "Configured ports per host.",
+            ["host"], dict(((host,), resources.portCount(host)) for host in resources.hosts()))
+        metrics.add("launcher_pool_idle", "gauge", "Idle pooled processes ready to be taken.",
+            ["app"], dict(((application,), len(pool.idle[application])) for application in pool.idle))
+        metrics.add("launcher_pool_size", "gauge", "Configured pool size.",
+            ["app"], dict(((application,), int(self.launcher._config['apps'][application]['pool_size'])) for application in pool.idle))
+        metrics.add("launcher_queue_waiting", "gauge", "Launches waiting for a free resource.",
+            [], { (): len(self.launcher.launch_queue) })
+        metrics.add("launcher_launch_timeouts_total", "counter", "Launches that timed out waiting for the ready line or in the queue.",
+            ["app", "stage"], self.launcher.launchTimeouts)
+        metrics.add("launcher_processes_reaped_total", "counter", "Processes released by the launcher because they ended or sat idle.",
+            ["app", "reason"], processes.reaped)
+        metrics.add("launcher_processes_failed_total", "counter", "Processes that failed to spawn, exited before ready or timed out.",
+            ["app", "reason"], processes.failed)
+
+        request.setHeader(b"Content-Type", b"text/plain; version=0.0.4; charset=utf-8")
+        return metrics.render()
 
 # =============================================================================
 # Start the web server
@@ -689,7 +2278,13 @@ def startWebServer(options, config):
     web_resource = File(content) if (len(content) > 0) else resource.Resource()
 
     # Attach launcher
-    web_resource.putChild(endpoint, LauncherResource(options, config))
+    launcher = LauncherResource(options, config)
+    web_resource.putChild(endpoint, launcher)
+
+    # Prometheus metrics next to it
+    metrics = str(config["configuration"].get("metrics", "metrics")).encode('utf-8')
+    if metrics:
+        web_resource.putChild(metrics, MetricsResource(launcher))
 
     # Check if launcher should act as a file upload server as well
     if "upload_dir" in config["configuration"]:
@@ -738,7 +2333,8 @@ def parseConfig(options):
 # =============================================================================
 # Setup default arguments to be parsed
 #   -d, --debug
-#   -t, --proxyFileType  Type of proxy file (txt, dbm)
+#   --zygote             Preload render modules and fork sessions on request
+#   -t, --proxyFileType  Type of proxy file (txt, dbm, sqlite)
 # =============================================================================
 
 def add_arguments(parser):
@@ -747,6 +2343,12 @@ def add_arguments(parser):
     parser.add_argument("-d", "--debug",
         help="log debugging messages to stdout",
         action="store_true")
+    parser.add_argument("-t", "--proxyFileType", default="txt",
+        choices=sorted(PROXY_MAPPING_MANAGERS.keys()),
+        help="Type of proxy file (txt, dbm, sqlite)")
+    parser.add_argument("--zygote",
+        help="run as zygote: preload the render modules and fork sessions requested on stdin",
+        action="store_true")
 
     return parser
 
@@ -763,7 +2365,10 @@ def start(argv=None,
     add_arguments(parser)
     args = parser.parse_args(argv)
     config = parseConfig(args)
-    startWebServer(args, config)
+    if args.zygote:
+        runZygote(config)
+    else:
+        startWebServer(args, config)
 
 # =============================================================================
 # Main
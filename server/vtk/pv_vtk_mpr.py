@@ -28,8 +28,11 @@ r"""
 import sys
 import os
 
-import mysql.connector
-from credentials import credentials
+import session_control
+import series_loader
+
+# import Twisted reactor for later callback
+from twisted.internet import reactor
 
 # import vtk modules.
 import vtk
@@ -61,8 +64,8 @@ class _WebCone(vtk_wslink.ServerProtocol):
         global renderer, renderWindow, renderWindowInteractor, cone, mapper, actor
 
         # Bring used components
-        self.registerVtkWebProtocol(protocols.vtkWebMouseHandler())
-        self.registerVtkWebProtocol(protocols.vtkWebViewPort())
+        self.registerVtkWebProtocol(session_control.interactive(protocols.vtkWebMouseHandler)())
+        self.registerVtkWebProtocol(session_control.interactive(protocols.vtkWebViewPort)())
         self.registerVtkWebProtocol(protocols.vtkWebViewPortImageDelivery())
         self.registerVtkWebProtocol(protocols.vtkWebViewPortGeometryDelivery())
 
@@ -105,41 +108,12 @@ class _WebCone(vtk_wslink.ServerProtocol):
                 interactorStyle = vtk.vtkInteractorStyleImage()
                 iren.SetInteractorStyle(interactorStyle)
                 
-                cred = credentials()
-
-                mydb = mysql.connector.connect(
-                  host="localhost",
-                  user=cred[0],
-                  password=cred[1],
-                  database="iqweb"
-                )
-
-                mycursor = mydb.cursor()
-                sql = "SELECT path FROM image WHERE seriesuid = %s"
-                params = (self.uid,)
-                mycursor.execute(sql, params)
-
-                files = mycursor.fetchall()
-                fileset = vtk.vtkStringArray()
-                for file in files:
-                    fileset.InsertNextValue(file[0])
-
-                sorter = vtk.vtkDICOMFileSorter()
-                sorter.SetInputFileNames(fileset)
-                sorter.Update()
-
-                sortedFiles = vtk.vtkStringArray()
-                sortedFiles = sorter.GetFileNamesForSeries(0)
-
-                reader = vtk.vtkDICOMReader()
-                reader.SetFileNames(sortedFiles);
-                reader.Update()
+                series = series_loader.loadSeries(self.uid, schedule=reactor.callFromThread, outOfCore=True)
 
                 # Calculate the center of the volume
-                reader.Update()
-                (xMin, xMax, yMin, yMax, zMin, zMax) = reader.GetExecutive().GetWholeExtent(reader.GetOutputInformation(0))
-                (xSpacing, ySpacing, zSpacing) = reader.GetOutput().GetSpacing()
-                (x0, y0, z0) = reader.GetOutput().GetOrigin()
+                (xMin, xMax, yMin, yMax, zMin, zMax) = series.GetOutput().GetExtent()
+                (xSpacing, ySpacing, zSpacing) = series.GetOutput().GetSpacing()
+                (x0, y0, z0) = series.GetOutput().GetOrigin()
                 
                 origin = [x0, y0, z0]
                 spacing = [xSpacing, ySpacing, zSpacing]
@@ -174,7 +148,7 @@ class _WebCone(vtk_wslink.ServerProtocol):
 
                 # Extract a slice in the desired orientation
                 reslice = vtk.vtkImageReslice()
-                reslice.SetInputConnection(reader.GetOutputPort())
+                reslice.SetInputConnection(series.GetOutputPort())
                 reslice.SetOutputDimensionality(2)
                 #reslice.SetOutputOrigin(origin)
                 reslice.SetResliceAxes(axial)
@@ -184,7 +158,7 @@ class _WebCone(vtk_wslink.ServerProtocol):
                     reslice.SetResliceAxes(sagittal)
                 reslice.SetInterpolationModeToLinear()
 
-                meta = reader.GetMetaData();
+                meta = series.GetMetaData();
 
                 level = meta.Get(vtk.vtkDICOMTag(0x0028,0x1050)).AsUTF8String().split("\\")[0]
                 window = meta.Get(vtk.vtkDICOMTag(0x0028,0x1051)).AsUTF8String().split("\\")[0]
@@ -194,7 +168,7 @@ class _WebCone(vtk_wslink.ServerProtocol):
 
                 # Create a greyscale lookup table
                 table = vtk.vtkLookupTable()
-                table.SetRange(range1, range2) # image intensity range
+                table.SetRange(*series.storedRange(range1, range2)) # image intensity range, in voxel values
                 table.SetValueRange(0.0, 1.0) # from black to white
                 table.SetSaturationRange(0.0, 0.0) # no color saturation
                 table.SetRampToLinear()
@@ -261,6 +235,7 @@ class _WebCone(vtk_wslink.ServerProtocol):
                 #camera.SetPosition(xc, yc, d)
                 
                 #setupCamera(renWin, ren, 320, 240)
+                series.refreshWhileLoading(self.getApplication(), renWin)
                 renWin.Render()
                 
                 # vtkweb
@@ -273,21 +248,28 @@ class _WebCone(vtk_wslink.ServerProtocol):
 # Main: Parse args and start server
 # =============================================================================
 
-if __name__ == "__main__":
+def main(argv=None):
     # Create argument parser
     parser = argparse.ArgumentParser(description="VTK/Web Cone web-application")
 
     # Add default arguments
     server.add_arguments(parser)
+    session_control.add_arguments(parser)
+    series_loader.add_arguments(parser)
 
     # Extract arguments
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    session_control.waitForAssignment(args, uid="content", orientation="uploadPath")
+    series_loader.configure(args)
 
     # Configure our current application
-    _WebCone.authKey = args.authKey
+    _WebCone.authKey = session_control.clientSecrets(args)
     
     _WebCone.uid = args.content
     _WebCone.orientation = args.uploadPath
 
     # Start server
-    server.start_webserver(options=args, protocol=_WebCone)
\ No newline at end of file
+    server.start_webserver(options=args, protocol=_WebCone)
+
+if __name__ == "__main__":
+    main()
@@ -28,8 +28,12 @@ r"""
 import sys
 import os
 
-import mysql.connector
-from credentials import credentials
+import session_control
+import series_loader
+import volume_pyramid
+
+# import Twisted reactor for later callback
+from twisted.internet import reactor
 
 # import vtk modules.
 import vtk
@@ -37,6 +41,8 @@ from vtk.web import protocols
 from vtk.web import wslink as vtk_wslink
 from wslink import server
 
+from vtk_protocol import VtkPyramid
+
 try:
     import argparse
 except ImportError:
@@ -60,8 +66,8 @@ class _WebCone(vtk_wslink.ServerProtocol):
         global renderer, renderWindow, renderWindowInteractor, cone, mapper, actor
 
         # Bring used components
-        self.registerVtkWebProtocol(protocols.vtkWebMouseHandler())
-        self.registerVtkWebProtocol(protocols.vtkWebViewPort())
+        self.registerVtkWebProtocol(session_control.interactive(protocols.vtkWebMouseHandler)())
+        self.registerVtkWebProtocol(session_control.interactive(protocols.vtkWebViewPort)())
         self.registerVtkWebProtocol(protocols.vtkWebViewPortImageDelivery())
         self.registerVtkWebProtocol(protocols.vtkWebViewPortGeometryDelivery())
 
@@ -82,58 +88,28 @@ class _WebCone(vtk_wslink.ServerProtocol):
                 iren.SetRenderWindow(renWin)
                 iren.GetInteractorStyle().SetCurrentStyleToTrackballCamera()
 
-                cred = credentials()
-
-                mydb = mysql.connector.connect(
-                  host="localhost",
-                  user=cred[0],
-                  password=cred[1],
-                  database="iqweb"
-                )
-
-                mycursor = mydb.cursor()
-                sql = "SELECT path FROM image WHERE seriesuid = %s"
-                params = (self.uid,)
-                mycursor.execute(sql, params)
-
-                files = mycursor.fetchall()
-                fileset = vtk.vtkStringArray()
-                for file in files:
-                    fileset.InsertNextValue(file[0])
-
-                sorter = vtk.vtkDICOMFileSorter()
-                sorter.SetInputFileNames(fileset)
-                sorter.Update()
-
-                sortedFiles = vtk.vtkStringArray()
-                sortedFiles = sorter.GetFileNamesForSeries(0)
-
-                reader = vtk.vtkDICOMReader()
-                reader.AutoRescaleOff() #only because our preset is shifted
-                reader.SetFileNames(sortedFiles);
-                reader.Update()
+                series = series_loader.loadSeries(self.uid, autoRescale=False, schedule=reactor.callFromThread) # stored values, the preset is converted below
 
                 # The volume will be displayed by ray-cast alpha compositing.
                 # A ray-cast mapper is needed to do the ray-casting, and a
                 # compositing function is needed to do the compositing along the ray.
-                volumeMapper = vtk.vtkGPUVolumeRayCastMapper()
-                volumeMapper.SetInputConnection(reader.GetOutputPort())
-                volumeMapper.SetBlendModeToComposite()
-                volumeMapper.AutoAdjustSampleDistancesOff()
-                volumeMapper.UseJitteringOn()
+                volumeMapper = volume_pyramid.createVolumeMapper(series.GetOutputPort())
+
+                # The preset below is in HU + 1024, storedValue() maps HU to the voxels
+                offset = -1024
 
                 # The color transfer function maps voxel intensities to colors.
                 # It is modality-specific, and often anatomy-specific as well.
                 # The goal is to one color for flesh (between 500 and 1000)
                 # and another color for bone (1150 and over).
                 volumeColor = vtk.vtkColorTransferFunction()
-                volumeColor.AddRGBPoint(1024, 0.53125, 0.171875, 0.0507813)
-                volumeColor.AddRGBPoint(1031, 0.488281, 0.148438, 0.0351563)
-                volumeColor.AddRGBPoint(1000, 0.589844, 0.0257813, 0.0148438)
-                volumeColor.AddRGBPoint(1170, 0.589844, 0.0257813, 0.0148438)
-                volumeColor.AddRGBPoint(1181, 0.957031, 0.996094, 0.878906)
-                volumeColor.AddRGBPoint(2024, 0.976563, 0.996094, 0.929688)
-                volumeColor.AddRGBPoint(3014, 0.488281, 0.488281, 0.488281)
+                volumeColor.AddRGBPoint(series.storedValue(1024 + offset), 0.53125, 0.171875, 0.0507813)
+                volumeColor.AddRGBPoint(series.storedValue(1031 + offset), 0.488281, 0.148438, 0.0351563)
+                volumeColor.AddRGBPoint(series.storedValue(1000 + offset), 0.589844, 0.0257813, 0.0148438)
+                volumeColor.AddRGBPoint(series.storedValue(1170 + offset), 0.589844, 0.0257813, 0.0148438)
+                volumeColor.AddRGBPoint(series.storedValue(1181 + offset), 0.957031, 0.996094, 0.878906)
+                volumeColor.AddRGBPoint(series.storedValue(2024 + offset), 0.976563, 0.996094, 0.929688)
+                volumeColor.AddRGBPoint(series.storedValue(3014 + offset), 0.488281, 0.488281, 0.488281)
 
                 # The opacity transfer function is used to control the opacity
                 # of different tissue types.
@@ -143,9 +119,9 @@ class _WebCone(vtk_wslink.ServerProtocol):
                 #volumeScalarOpacity.AddPoint(1000, 0.15)
                 #volumeScalarOpacity.AddPoint(1150, 0.85)
 
-                volumeScalarOpacity.AddPoint(1131,  0)
-                volumeScalarOpacity.AddPoint(1463,  1)
-                volumeScalarOpacity.AddPoint(3135, 1)
+                volumeScalarOpacity.AddPoint(series.storedValue(1131 + offset),  0)
+                volumeScalarOpacity.AddPoint(series.storedValue(1463 + offset),  1)
+                volumeScalarOpacity.AddPoint(series.storedValue(3135 + offset), 1)
 
                 # The gradient opacity function is used to decrease the opacity
                 # in the "flat" regions of the volume while maintaining the opacity
@@ -153,9 +129,9 @@ class _WebCone(vtk_wslink.ServerProtocol):
                 # as the amount by which the intensity changes over unit distance.
                 # For most medical data, the unit distance is 1mm.
                 volumeGradientOpacity = vtk.vtkPiecewiseFunction()
-                volumeGradientOpacity.AddPoint(0,   0.0)
-                volumeGradientOpacity.AddPoint(90,  0.9)
-                volumeGradientOpacity.AddPoint(100, 1.0)
+                volumeGradientOpacity.AddPoint(series.storedDelta(0),   0.0)
+                volumeGradientOpacity.AddPoint(series.storedDelta(90),  0.9)
+                volumeGradientOpacity.AddPoint(series.storedDelta(100), 1.0)
 
                 # The VolumeProperty attaches the color and opacity functions to the
                 # volume, and sets other volume properties.  The interpolation should
@@ -204,6 +180,12 @@ class _WebCone(vtk_wslink.ServerProtocol):
 
                 # Interact with the data.
                 #iren.Initialize()
+                series.refreshWhileLoading(self.getApplication(), renWin)
+
+                # Rotate a downsampled copy, render the full resolution when the user lets go
+                pyramid = volume_pyramid.VolumePyramid(series, self.getApplication(), renWin, reactor.callFromThread)
+                pyramid.addVolume(volume, volume_pyramid.createVolumeMapper)
+                self.registerVtkWebProtocol(session_control.interactive(VtkPyramid)(pyramid))
                 renWin.Render()
                 
                 # vtkweb
@@ -215,20 +197,27 @@ class _WebCone(vtk_wslink.ServerProtocol):
 # Main: Parse args and start server
 # =============================================================================
 
-if __name__ == "__main__":
+def main(argv=None):
     # Create argument parser
     parser = argparse.ArgumentParser(description="VTK/Web Cone web-application")
 
     # Add default arguments
     server.add_arguments(parser)
+    session_control.add_arguments(parser)
+    series_loader.add_arguments(parser)
 
     # Extract arguments
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    session_control.waitForAssignment(args, uid="content")
+    series_loader.configure(args)
 
     # Configure our current application
-    _WebCone.authKey = args.authKey
+    _WebCone.authKey = session_control.clientSecrets(args)
     
     _WebCone.uid = args.content
 
     # Start server
-    server.start_webserver(options=args, protocol=_WebCone)
\ No newline at end of file
+    server.start_webserver(options=args, protocol=_WebCone)
+
+if __name__ == "__main__":
+    main()
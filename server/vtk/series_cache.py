@@ -0,0 +1,258 @@
+r"""
+    On-disk cache of decoded series volumes.
+
+    Every entry is two files named after the sha1 of the series uid: the raw
+    voxels (.raw) and a JSON header (.json) with the geometry, the scalar
+    type, the patient matrix and the DICOM values the viewers read from the
+    meta data (window/level, rescale). Those are the values of the first
+    file; whether all files share its rescale is kept as well, as
+    "uniformRescale". The header is written last, so an entry without one
+    is incomplete and ignored.
+
+    A hit is memory-mapped copy-on-write straight into the scalar array of a
+    vtkImageData: nothing is decoded and the pages are shared with every
+    other process that opened the same series. The header also records a
+    digest of the file paths, so a series that gained or lost images is
+    decoded again.
+
+    Series too large to hold in memory are stored bricked instead, in
+    .bricks.raw/.bricks.json entries of the same cache (see bricked_volume).
+
+    The cache is bounded in size. The modification time of a header is its
+    last use; the least recently used entries are removed once a new entry
+    pushes the total over the limit. Files of writers that died, temporary
+    files and raw files without a header, are removed first once they are
+    older than STALE_AFTER.
+"""
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+# Meta data kept in the header, the viewers read nothing else
+CACHED_TAGS = [
+    (0x0028, 0x1050),   # Window Center
+    (0x0028, 0x1051),   # Window Width
+    (0x0028, 0x1052),   # Rescale Intercept
+    (0x0028, 0x1053),   # Rescale Slope
+]
+
+# Bump when the file layout changes, older entries are then misses
+CACHE_VERSION = 2
+
+# Seconds after which a temporary or headerless raw file is left over from a
+# writer that died, not one still writing
+STALE_AFTER = 600
+
+# os.rename() does not overwrite on Windows
+replace = getattr(os, 'replace', os.rename)
+
+# -----------------------------------------------------------------------------
+
+def filesDigest(files):
+    return hashlib.sha1('\n'.join(sorted(files)).encode('utf-8')).hexdigest()
+
+def _tagKey(tag):
+    return "%04x,%04x" % tag
+
+def makeHeader(uid, files, extent, spacing, origin, scalarType, components, metaData, patientMatrix,
+               uniformRescale=None):
+    tags = None
+    if metaData is not None:
+        tags = {}
+        for tag in CACHED_TAGS:
+            value = metaData.Get(vtk.vtkDICOMTag(*tag))
+            if value.IsValid():
+                tags[_tagKey(tag)] = value.AsUTF8String()
+    return {
+        'version': CACHE_VERSION,
+        'uid': uid,
+        'files': filesDigest(files),
+        'extent': list(extent),
+        'spacing': list(spacing),
+        'origin': list(origin),
+        'scalarType': scalarType,
+        'components': components,
+        'patientMatrix': [patientMatrix.GetElement(i // 4, i % 4) for i in range(16)] if patientMatrix else None,
+        'tags': tags,
+        # None if unknown
+        'uniformRescale': uniformRescale
+    }
+
+def restoreMetaData(header):
+    metaData = None
+    if header['tags'] is not None:
+        metaData = vtk.vtkDICOMMetaData()
+        for tag in CACHED_TAGS:
+            value = header['tags'].get(_tagKey(tag))
+            if value is not None:
+                metaData.Set(vtk.vtkDICOMTag(*tag), value)
+    return metaData
+
+def restorePatientMatrix(header):
+    patientMatrix = None
+    if header.get('patientMatrix'):
+        patientMatrix = vtk.vtkMatrix4x4()
+        patientMatrix.DeepCopy(header['patientMatrix'])
+    return patientMatrix
+
+# -----------------------------------------------------------------------------
+
+class SeriesCache(object):
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by another render process meanwhile
+            if not os.path.isdir(directory):
+                raise
+
+    def path(self, uid, autoRescale, extension):
+        key = hashlib.sha1(uid.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, "%s-%s%s" % (key, 'r' if autoRescale else 's', extension))
+
+    def readHeader(self, uid, autoRescale, files, layout=""):
+        """
+        Return the header of a cached series if it is still valid, and mark
+        the entry as used. layout tells entries of other formats apart, see
+        bricked_volume.py.
+        """
+        headerPath = self.path(uid, autoRescale, layout + ".json")
+        try:
+            with io.open(headerPath, encoding="utf-8") as header_file:
+                header = json.load(header_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if header.get('version') != CACHE_VERSION or header.get('uid') != uid or header.get('files') != filesDigest(files):
+            return None
+
+        # Mark the entry as used for the eviction order
+        try:
+            os.utime(headerPath, None)
+        except OSError:
+            pass
+        return header
+
+    def writeEntry(self, uid, autoRescale, writeRaw, layout=""):
+        """
+        Store an entry, writeRaw(file) writes the voxels and returns the
+        header (see makeHeader)
+        """
+        # Drop the old header first so it never describes the new voxels, then
+        # write to temporary files and rename: readers never see half an entry
+        headerPath = self.path(uid, autoRescale, layout + ".json")
+        try:
+            os.remove(headerPath)
+        except OSError:
+            pass
+        header = self._replace(self.path(uid, autoRescale, layout + ".raw"), writeRaw)
+        self._replace(headerPath, lambda header_file: header_file.write(json.dumps(header).encode('utf-8')))
+
+        self.evict(keep=headerPath)
+
+    def lookup(self, uid, autoRescale, files):
+        """
+        Return (image, metaData, patientMatrix, uniformRescale) of a cached
+        series or None
+        """
+        header = self.readHeader(uid, autoRescale, files)
+        if not header:
+            return None
+
+        (xMin, xMax, yMin, yMax, zMin, zMax) = header['extent']
+        shape = (zMax - zMin + 1, yMax - yMin + 1, xMax - xMin + 1, header['components'])
+        try:
+            # Copy-on-write, VTK wants a writable buffer but the file stays untouched
+            volume = numpy.memmap(self.path(uid, autoRescale, ".raw"), mode='c', shape=shape,
+                                  dtype=numpy_support.get_numpy_array_type(header['scalarType']))
+        except (IOError, OSError, ValueError):
+            return None
+
+        image = vtk.vtkImageData()
+        image.SetExtent(header['extent'])
+        image.SetSpacing(header['spacing'])
+        image.SetOrigin(header['origin'])
+        scalars = numpy_support.numpy_to_vtk(volume.reshape(-1, shape[3]), deep=False, array_type=header['scalarType'])
+        scalars.SetName("PixelData")
+        image.GetPointData().SetScalars(scalars)
+
+        return (image, restoreMetaData(header), restorePatientMatrix(header), header.get('uniformRescale'))
+
+    def store(self, uid, autoRescale, files, image, metaData, patientMatrix, uniformRescale=None):
+        scalars = image.GetPointData().GetScalars()
+        header = makeHeader(uid, files, image.GetExtent(), image.GetSpacing(), image.GetOrigin(),
+                            scalars.GetDataType(), scalars.GetNumberOfComponents(), metaData, patientMatrix,
+                            uniformRescale)
+        def writeRaw(raw_file):
+            numpy_support.vtk_to_numpy(scalars).tofile(raw_file)
+            return header
+        self.writeEntry(uid, autoRescale, writeRaw)
+
+    def _replace(self, path, write):
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as temporary_file:
+                result = write(temporary_file)
+            replace(temporary, path)
+            return result
+        except:
+            os.remove(temporary)
+            raise
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache fits its size
+        """
+        entries = []
+        total = 0
+        names = set(os.listdir(self.directory))
+        for name in names:
+            if name.endswith(".tmp") or (name.endswith(".raw") and not name[:-len(".raw")] + ".json" in names):
+                total += self._removeStale(os.path.join(self.directory, name))
+                continue
+            if not name.endswith(".json"):
+                continue
+            headerPath = os.path.join(self.directory, name)
+            rawPath = headerPath[:-len(".json")] + ".raw"
+            try:
+                size = os.path.getsize(headerPath) + os.path.getsize(rawPath)
+                entries.append((os.path.getmtime(headerPath), headerPath, rawPath, size))
+                total += size
+            except OSError:
+                pass
+
+        for (used, headerPath, rawPath, size) in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            if headerPath == keep:
+                continue
+            # Header first, a raw file without one is never read. Processes
+            # that mapped the raw file keep their pages until they unmap it.
+            for path in (headerPath, rawPath):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+    def _removeStale(self, path):
+        """
+        Remove a file no entry owns if it is stale, return the bytes it
+        still takes otherwise
+        """
+        try:
+            stat = os.stat(path)
+            if time.time() - stat.st_mtime < STALE_AFTER:
+                return stat.st_size
+            os.remove(path)
+        except OSError:
+            pass
+        return 0
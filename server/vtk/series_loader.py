@@ -0,0 +1,910 @@
+r"""
+    Load a DICOM series for the render servers.
+
+    loadSeries() runs the steps every viewer used to repeat inline: look up
+    the file paths of the series in the image catalog, sort them with
+    vtkDICOMFileSorter and decode the pixel data. If the catalog already
+    knows the slice order (from the header index or an earlier load) the
+    sorting and the header pass are skipped.
+
+    Decoding is split into chunks of consecutive slices. Each chunk is read
+    by its own vtkDICOMReader in a thread pool and copied straight into its
+    slab of one preallocated volume. VTK releases the GIL while a reader
+    runs, so the chunks decode in parallel. Geometry and meta data come from
+    one header pass over the whole series, so the result matches what a
+    single vtkDICOMReader would produce.
+
+    Compressed series (JPEG, JPEG-LS, JPEG 2000, RLE) spend their time in
+    the codecs, which do not scale in threads. Their chunks are decoded by
+    processes forked for the load (--decode-processes) that write into the
+    volume allocated in shared memory. Platforms without fork, and the
+    background part of progressive loading, stay with threads.
+
+    With --cache-dir the decoded volumes are kept on disk (see series_cache)
+    and a series opened again is memory-mapped instead of decoded. With
+    --shared-volumes all render processes on the host map one copy of every
+    open series (see shared_volumes). Viewers that only cut slices can ask
+    for series above --out-of-core-size to be kept out of core instead: they
+    are decoded slab by slab into bricks in the cache directory and only the
+    bricks a slice needs are read back (see bricked_volume).
+
+    With --compact-storage series are always kept in their stored values,
+    usually 16 bit, instead of letting the rescale to modality values (HU)
+    widen the voxel type. Series.rescale carries slope and intercept and the
+    viewers convert their window and transfer functions to stored values
+    with Series.storedValue(). Compact series share cache entries and shared
+    volumes with the VRT, which always loads stored values.
+
+    The time spent in every stage (query, sort, decode, assemble) is kept
+    with the series and printed to the session log.
+"""
+import collections
+import mmap
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+import bricked_volume
+import image_catalog
+import series_cache
+import shared_volumes
+
+# Threads decoding a series, 0 means one per core
+DECODE_WORKERS = 0
+
+# Chunks per thread, several so one slow chunk does not hold the others back
+CHUNKS_PER_WORKER = 4
+
+# Processes decoding a compressed series, 0 means one per core
+DECODE_PROCESSES = 0
+
+# Transfer syntaxes whose decoding is worth a process per core
+COMPRESSED_SYNTAXES = {
+    '1.2.840.10008.1.2.4.50': "JPEG baseline",
+    '1.2.840.10008.1.2.4.51': "JPEG extended",
+    '1.2.840.10008.1.2.4.57': "JPEG lossless",
+    '1.2.840.10008.1.2.4.70': "JPEG lossless SV1",
+    '1.2.840.10008.1.2.4.80': "JPEG-LS lossless",
+    '1.2.840.10008.1.2.4.81': "JPEG-LS near-lossless",
+    '1.2.840.10008.1.2.4.90': "JPEG 2000 lossless",
+    '1.2.840.10008.1.2.4.91': "JPEG 2000",
+    '1.2.840.10008.1.2.5': "RLE lossless",
+}
+
+# Default size limit of the volume cache
+DEFAULT_CACHE_SIZE_MB = 10240
+
+# Progressive loading decodes every PREVIEW_STRIDE-th slice for the first
+# image, then refreshes the view at most every PROGRESS_INTERVAL seconds
+# while the other slices come in
+PREVIEW_STRIDE = 4
+PROGRESS_INTERVAL = 0.5
+
+# Series above this size are kept out of core when the viewer allows it,
+# with this much of them resident
+DEFAULT_OUT_OF_CORE_SIZE_MB = 2048
+DEFAULT_BRICK_CACHE_SIZE_MB = 256
+
+# Set by configure() when --cache-dir, --shared-volumes or --progressive is given
+_cache = [None]
+_shared = [None]
+_progressive = [False]
+_bricks = [None]
+_outOfCoreSize = [None]
+_compact = [False]
+_decodeProcesses = [DECODE_PROCESSES]
+
+# The volume forked decode processes write into, see ForkedDecoder
+_forkedVolume = [None]
+
+RESCALE_SLOPE = (0x0028, 0x1053)
+RESCALE_INTERCEPT = (0x0028, 0x1052)
+
+# The MySQL iqweb catalog unless --catalog or setCatalog() says otherwise
+_catalog = [None]
+
+# A render process opens a series or two, one connection is plenty and is
+# given back once the series is loaded
+CATALOG_CONNECTIONS = 1
+
+# -----------------------------------------------------------------------------
+
+def add_arguments(parser):
+    parser.add_argument("--catalog", default=None,
+        help="look series up in this SQLite catalog instead of the MySQL database")
+    parser.add_argument("--header-index", default=None,
+        help="take the slice order of series from this header index (see header_index.py)")
+    parser.add_argument("--cache-dir", default=None,
+        help="keep decoded series in this directory and memory-map them when opened again")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE_MB,
+        help="size limit of the series cache in MB, least recently used series are removed first")
+    parser.add_argument("--shared-volumes", nargs="?", default=None, const=shared_volumes.DEFAULT_DIRECTORY,
+        help="share decoded series with the other render processes on this host through this directory "
+             "(default %s)" % shared_volumes.DEFAULT_DIRECTORY)
+    parser.add_argument("--progressive", action="store_true",
+        help="show a preview from every %dth slice first and load the others in the background" % PREVIEW_STRIDE)
+    parser.add_argument("--out-of-core-size", type=int, default=DEFAULT_OUT_OF_CORE_SIZE_MB,
+        help="keep series above this size in MB bricked in the cache directory instead of in memory, "
+             "for viewers that only cut slices (needs --cache-dir)")
+    parser.add_argument("--brick-cache-size", type=int, default=DEFAULT_BRICK_CACHE_SIZE_MB,
+        help="memory in MB for the bricks of out-of-core series")
+    parser.add_argument("--compact-storage", action="store_true",
+        help="keep the stored voxel values and rescale in lookup tables and transfer functions")
+    parser.add_argument("--decode-processes", type=int, default=None,
+        help="processes decoding compressed series, default one per core, -1 decodes them in threads")
+
+def configure(args):
+    catalog = { 'pool_size': CATALOG_CONNECTIONS }
+    if args.catalog:
+        catalog.update(type='sqlite', path=args.catalog)
+    if args.header_index:
+        catalog['header_index'] = args.header_index
+    if args.catalog or args.header_index:
+        setCatalog(image_catalog.createCatalog(catalog))
+    if args.cache_dir:
+        _cache[0] = series_cache.SeriesCache(args.cache_dir, args.cache_size * 1024 * 1024)
+        _bricks[0] = bricked_volume.BrickCache(args.brick_cache_size * 1024 * 1024)
+        _outOfCoreSize[0] = args.out_of_core_size * 1024 * 1024
+    if args.shared_volumes:
+        _shared[0] = shared_volumes.SharedVolumes(args.shared_volumes)
+    _progressive[0] = args.progressive
+    _compact[0] = args.compact_storage
+    if args.decode_processes is not None:
+        _decodeProcesses[0] = args.decode_processes
+
+def setCatalog(catalog):
+    _catalog[0] = catalog
+
+def catalog():
+    if not _catalog[0]:
+        _catalog[0] = image_catalog.createCatalog({ 'pool_size': CATALOG_CONNECTIONS })
+    return _catalog[0]
+
+# -----------------------------------------------------------------------------
+
+class Series(object):
+    """
+    A decoded series. It stands in for the vtkDICOMReader the viewers used:
+    GetOutputPort() connects pipelines, GetOutput() is the vtkImageData and
+    GetMetaData() the DICOM meta data of the whole series.
+
+    An out-of-core series is produced by a BrickedVolumeSource, its
+    GetOutput() only has the extent, spacing and origin.
+    """
+    def __init__(self, uid, image, metaData, patientMatrix, timings, producer=None, uniformRescale=None):
+        self.uid = uid
+        self.image = image
+        self.metaData = metaData
+        self.patientMatrix = patientMatrix
+        self.timings = timings
+        # Whether all files share one rescale, None if unknown. The meta data
+        # of a cached or ordered load only has the first files.
+        self.uniformRescale = uniformRescale
+        if producer is None:
+            producer = vtk.vtkTrivialProducer()
+            producer.SetOutput(image)
+        self.producer = producer
+        # Slope and intercept from the voxels to modality values, identity
+        # if the voxels were rescaled while decoding
+        self.rescale = (1.0, 0.0)
+        # False while the slices skipped by a progressive load come in
+        self.complete = True
+        self.observers = []
+        self.lastUpdate = 0
+
+    def onUpdate(self, callback):
+        """
+        Call callback in the main thread whenever more slices of a
+        progressively loaded series are in
+        """
+        self.observers.append(callback)
+
+    def refreshWhileLoading(self, application, renderWindow):
+        """
+        Render the window again and push the image to the clients whenever
+        more slices are in
+        """
+        def refresh():
+            renderWindow.Render()
+            application.InvalidateCache(renderWindow)
+            application.InvokeEvent('UpdateEvent')
+        self.onUpdate(refresh)
+
+    def _slicesLanded(self, complete=False):
+        self.complete = complete
+        now = time.time()
+        if not complete and now - self.lastUpdate < PROGRESS_INTERVAL:
+            return
+        self.lastUpdate = now
+        self.image.GetPointData().GetScalars().Modified()
+        self.image.Modified()
+        for callback in self.observers:
+            callback()
+
+    def storedValue(self, value):
+        """
+        Voxel value of a modality value, like a window bound in HU
+        """
+        (slope, intercept) = self.rescale
+        return (value - intercept) / slope
+
+    def storedRange(self, low, high):
+        return tuple(sorted((self.storedValue(low), self.storedValue(high))))
+
+    def storedDelta(self, delta):
+        """
+        Voxel difference of a modality difference, like a gradient
+        """
+        return delta / abs(self.rescale[0])
+
+    def GetOutputPort(self):
+        return self.producer.GetOutputPort()
+
+    def GetOutput(self):
+        return self.image
+
+    def GetMetaData(self):
+        return self.metaData
+
+# -----------------------------------------------------------------------------
+# Stages
+# -----------------------------------------------------------------------------
+
+def stringArray(values):
+    array = vtk.vtkStringArray()
+    for value in values:
+        array.InsertNextValue(value)
+    return array
+
+def sortFiles(files):
+    sorter = vtk.vtkDICOMFileSorter()
+    sorter.SetInputFileNames(stringArray(files))
+    sorter.Update()
+
+    sortedFiles = sorter.GetFileNamesForSeries(0)
+    return [sortedFiles.GetValue(i) for i in range(sortedFiles.GetNumberOfValues())]
+
+def readHeaders(files, autoRescale):
+    """
+    Read the headers of the whole series and return the reader with the
+    output information filled in, but no pixel data.
+    """
+    reader = vtk.vtkDICOMReader()
+    reader.SetAutoRescale(autoRescale)
+    reader.SetFileNames(stringArray(files))
+    reader.UpdateInformation()
+    return reader
+
+def sliceOrder(header, files):
+    """
+    Return the file of every output slice in order, or None if the series
+    does not map one file to one slice (multi-frame files, several samples
+    per slice) and has to be read by a single reader.
+    """
+    fileIndex = header.GetFileIndexArray()
+    frameIndex = header.GetFrameIndexArray()
+    if fileIndex.GetNumberOfComponents() != 1 or fileIndex.GetNumberOfTuples() != len(files):
+        return None
+    for i in range(frameIndex.GetNumberOfValues()):
+        if frameIndex.GetValue(i) != 0:
+            return None
+    return [files[fileIndex.GetValue(i)] for i in range(fileIndex.GetNumberOfTuples())]
+
+def readChunk(files, autoRescale):
+    reader = vtk.vtkDICOMReader()
+    reader.SetAutoRescale(autoRescale)
+    # The files already are in slice order, keep it
+    reader.SortingOff()
+    reader.SetFileNames(stringArray(files))
+    reader.Update()
+    return reader
+
+def copyChunk(reader, first, volume):
+    count = reader.GetOutput().GetDimensions()[2]
+    scalars = numpy_support.vtk_to_numpy(reader.GetOutput().GetPointData().GetScalars())
+    volume[first:first + count] = scalars.reshape((count,) + volume.shape[1:])
+
+def decodeChunk(files, first, volume, autoRescale):
+    """
+    Return the rescales of the files, see rescalesOf()
+    """
+    reader = readChunk(files, autoRescale)
+    copyChunk(reader, first, volume)
+    return rescalesOf(reader.GetMetaData())
+
+def copySlices(reader, indices, volume):
+    scalars = numpy_support.vtk_to_numpy(reader.GetOutput().GetPointData().GetScalars())
+    volume[indices] = scalars.reshape((len(indices),) + volume.shape[1:])
+
+def decodeSlicesAt(files, indices, volume, autoRescale):
+    """
+    Decode the slices at the given, not necessarily consecutive, indices.
+    Return their rescales.
+    """
+    reader = readChunk([files[i] for i in indices], autoRescale)
+    copySlices(reader, indices, volume)
+    return rescalesOf(reader.GetMetaData())
+
+def chunking(count, workers):
+    """
+    Return (workers, slices per chunk)
+    """
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return (workers, max(1, -(-count // (workers * CHUNKS_PER_WORKER))))
+
+def decodeChunks(order, start, size, volume, autoRescale, workers, decoder=None):
+    """
+    Return the rescales of the files decoded
+    """
+    if decoder:
+        return decoder.decode(order, start, size, autoRescale)
+    rescales = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        chunks = [executor.submit(decodeChunk, order[first:first + size], first, volume, autoRescale)
+                  for first in range(start, len(order), size)]
+        for chunk in chunks:
+            rescales |= chunk.result()
+    return rescales
+
+def decodeSlices(header, order, workers):
+    """
+    Decode the slices in order into one preallocated (z, y, x, components)
+    array using a pool of readers.
+    """
+    info = header.GetOutputInformation(0)
+    (xMin, xMax, yMin, yMax, zMin, zMax) = info.Get(vtk.vtkStreamingDemandDrivenPipeline.WHOLE_EXTENT())
+    scalarType = vtk.vtkImageData.GetScalarType(info)
+    components = vtk.vtkImageData.GetNumberOfScalarComponents(info)
+    processes = decodeProcesses(header.GetMetaData())
+    volume = allocateVolume((zMax - zMin + 1, yMax - yMin + 1, xMax - xMin + 1, components),
+                            numpy_support.get_numpy_array_type(scalarType), shared=processes > 0)
+
+    if processes:
+        processes, size = chunking(len(order), processes)
+        with ForkedDecoder(volume, processes) as decoder:
+            decodeChunks(order, 0, size, volume, header.GetAutoRescale(), processes, decoder)
+    else:
+        workers, size = chunking(len(order), workers)
+        decodeChunks(order, 0, size, volume, header.GetAutoRescale(), workers)
+
+    return volume, scalarType
+
+# -----------------------------------------------------------------------------
+# Compressed series
+# -----------------------------------------------------------------------------
+
+def transferSyntax(metaData):
+    value = metaData.Get(vtk.vtkDICOMTag(0x0002, 0x0010)) if metaData is not None else None
+    return value.AsString() if value and value.IsValid() else ""
+
+def decodeProcesses(metaData):
+    """
+    Return the number of processes to decode a series with, 0 for threads
+    """
+    if _decodeProcesses[0] < 0 or not hasattr(os, 'fork'):
+        return 0
+    if transferSyntax(metaData) not in COMPRESSED_SYNTAXES:
+        return 0
+    return _decodeProcesses[0] or os.cpu_count() or 1
+
+def allocateVolume(shape, dtype, shared=False):
+    """
+    Return an empty (z, y, x, components) array. A shared one is anonymous
+    shared memory, processes forked afterwards write to the same pages.
+    """
+    if not shared:
+        return numpy.empty(shape, dtype=dtype)
+    count = int(numpy.prod(shape))
+    # The array keeps the mapping alive and unmaps it when it goes
+    buffer = mmap.mmap(-1, max(1, count * numpy.dtype(dtype).itemsize))
+    return numpy.frombuffer(buffer, dtype=dtype, count=count).reshape(shape)
+
+def _decodeForked(chunk):
+    (files, first, autoRescale) = chunk
+    return decodeChunk(files, first, _forkedVolume[0], autoRescale)
+
+class ForkedDecoder(object):
+    """
+    Processes forked to decode chunks into a volume from allocateVolume(
+    shared=True). Fork from the main thread only, with no other thread
+    holding locks the children would inherit.
+    """
+    def __init__(self, volume, processes):
+        _forkedVolume[0] = volume
+        self.pool = multiprocessing.get_context('fork').Pool(processes)
+
+    def decode(self, order, start, size, autoRescale):
+        chunks = [(order[first:first + size], first, autoRescale) for first in range(start, len(order), size)]
+        rescales = set()
+        for decoded in self.pool.imap_unordered(_decodeForked, chunks):
+            rescales |= decoded
+        return rescales
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        _forkedVolume[0] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def imageFromVolume(extent, spacing, origin, volume, scalarType):
+    image = vtk.vtkImageData()
+    image.SetExtent(extent)
+    image.SetSpacing(spacing)
+    image.SetOrigin(origin)
+
+    # The array keeps a reference to the numpy buffer, no copy is made
+    scalars = numpy_support.numpy_to_vtk(volume.reshape(-1, volume.shape[3]), deep=False, array_type=scalarType)
+    scalars.SetName("PixelData")
+    image.GetPointData().SetScalars(scalars)
+    return image
+
+def assembleImage(header, volume, scalarType):
+    info = header.GetOutputInformation(0)
+    return imageFromVolume(info.Get(vtk.vtkStreamingDemandDrivenPipeline.WHOLE_EXTENT()),
+                           info.Get(vtk.vtkDataObject.SPACING()), info.Get(vtk.vtkDataObject.ORIGIN()),
+                           volume, scalarType)
+
+def decodeOrdered(files, geometry, autoRescale, workers):
+    """
+    Decode files known to be in slice order without a header pass over the
+    whole series. The first chunk is read on its own and gives the scalar
+    type, the in-plane geometry, the meta data and the patient matrix, the
+    other chunks are then decoded in parallel. Return the image, meta data,
+    patient matrix and whether all files share one rescale.
+    """
+    workers, size = chunking(len(files), workers)
+    first = readChunk(files[:size], autoRescale)
+    output = first.GetOutput()
+    (xMin, xMax, yMin, yMax, zMin, zMax) = output.GetExtent()
+    scalarType = output.GetScalarType()
+    processes = decodeProcesses(first.GetMetaData())
+    volume = allocateVolume((len(files), yMax - yMin + 1, xMax - xMin + 1, output.GetNumberOfScalarComponents()),
+                            numpy_support.get_numpy_array_type(scalarType), shared=processes > 0)
+
+    copyChunk(first, 0, volume)
+    rescales = rescalesOf(first.GetMetaData())
+    if processes:
+        with ForkedDecoder(volume, processes) as decoder:
+            rescales |= decodeChunks(files, size, size, volume, autoRescale, processes, decoder)
+    else:
+        rescales |= decodeChunks(files, size, size, volume, autoRescale, workers)
+
+    spacing = list(output.GetSpacing())
+    if size < 2:
+        # A single slice has no slice spacing of its own
+        spacing[2] = geometry['spacing'][2]
+    image = imageFromVolume((xMin, xMax, yMin, yMax, 0, len(files) - 1), spacing, output.GetOrigin(), volume, scalarType)
+    return (image, first.GetMetaData(), first.GetPatientMatrix(), len(rescales) == 1)
+
+# -----------------------------------------------------------------------------
+# Progressive loading
+# -----------------------------------------------------------------------------
+
+def decodePreview(files, header, zSpacing, autoRescale, workers):
+    """
+    Decode every PREVIEW_STRIDE-th slice into a full size volume and fill
+    every other slice with the decoded one below it. Return the image, meta
+    data and patient matrix, the volume and the indices still to decode.
+    """
+    preview = list(range(0, len(files), PREVIEW_STRIDE))
+    workers, size = chunking(len(preview), workers)
+
+    # The first chunk gives the scalar type and in-plane geometry
+    first = readChunk([files[i] for i in preview[:size]], autoRescale)
+    output = first.GetOutput()
+    (xMin, xMax, yMin, yMax, zMin, zMax) = output.GetExtent()
+    scalarType = output.GetScalarType()
+    volume = numpy.empty((len(files), yMax - yMin + 1, xMax - xMin + 1, output.GetNumberOfScalarComponents()),
+                         dtype=numpy_support.get_numpy_array_type(scalarType))
+    copySlices(first, preview[:size], volume)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        chunks = [executor.submit(decodeSlicesAt, files, preview[start:start + size], volume, autoRescale)
+                  for start in range(size, len(preview), size)]
+        for chunk in chunks:
+            chunk.result()
+
+    for offset in range(1, PREVIEW_STRIDE):
+        skipped = volume[offset::PREVIEW_STRIDE]
+        skipped[:] = volume[0::PREVIEW_STRIDE][:len(skipped)]
+
+    spacing = list(output.GetSpacing())
+    spacing[2] = zSpacing
+    image = imageFromVolume((xMin, xMax, yMin, yMax, 0, len(files) - 1), spacing, output.GetOrigin(), volume, scalarType)
+    if header:
+        (metaData, patientMatrix) = (header.GetMetaData(), header.GetPatientMatrix())
+    else:
+        (metaData, patientMatrix) = (first.GetMetaData(), first.GetPatientMatrix())
+
+    remaining = [i for i in range(len(files)) if i % PREVIEW_STRIDE]
+    return (image, metaData, patientMatrix, volume, remaining)
+
+def refineInBackground(series, files, remaining, volume, autoRescale, workers, schedule, finished):
+    """
+    Decode the remaining slices in a thread. schedule(function, *args) must
+    run function in the main thread, VTK objects are only touched there.
+    finished() is scheduled the same way once all slices are in.
+    """
+    def refine():
+        begin = time.time()
+        try:
+            pool, size = chunking(len(remaining), workers)
+            with ThreadPoolExecutor(max_workers=pool) as executor:
+                chunks = [executor.submit(decodeSlicesAt, files, remaining[start:start + size], volume, autoRescale)
+                          for start in range(0, len(remaining), size)]
+                for chunk in as_completed(chunks):
+                    chunk.result()
+                    schedule(series._slicesLanded)
+            series.timings['refine'] = time.time() - begin
+            schedule(finished)
+        except Exception as e:
+            print("Loading the rest of series %s failed, keeping the preview: %s" % (series.uid, e))
+            sys.stdout.flush()
+        schedule(series._slicesLanded, True)
+
+    thread = threading.Thread(target=refine)
+    thread.daemon = True
+    thread.start()
+
+def loadProgressive(uid, entry, autoRescale, workers, timings, schedule):
+    """
+    Return a Series holding a preview while the other slices load, or None
+    if the series can not be loaded by slice (multi-frame), or it is to keep
+    its stored values and whether all files share one rescale is unknown
+    """
+    begin = time.time()
+    header = None
+    files = entry.paths
+    if entry.ordered:
+        zSpacing = entry.geometry['spacing'][2]
+        uniformRescale = entry.geometry.get('uniformRescale')
+        if uniformRescale is None and not autoRescale:
+            # The preview would not tell, loadSeries() needs to know now
+            return None
+    else:
+        files = sortFiles(files)
+        header = readHeaders(files, autoRescale)
+        files = sliceOrder(header, files)
+        if not files:
+            return None
+        zSpacing = header.GetOutputInformation(0).Get(vtk.vtkDataObject.SPACING())[2]
+        uniformRescale = rescaleOf(header.GetMetaData())[1]
+    timings['sort'] = time.time() - begin
+
+    begin = time.time()
+    (image, metaData, patientMatrix, volume, remaining) = decodePreview(files, header, zSpacing, autoRescale, workers)
+    timings['preview'] = time.time() - begin
+
+    series = Series(uid, image, metaData, patientMatrix, timings, uniformRescale=uniformRescale)
+    series.complete = not remaining
+
+    def finished():
+        cache = _cache[0]
+        if cache:
+            begin = time.time()
+            try:
+                cache.store(uid, autoRescale, files, image, metaData, patientMatrix, uniformRescale)
+            except (IOError, OSError) as e:
+                print("Could not cache series %s: %s" % (uid, e))
+            timings['store'] = time.time() - begin
+        catalog().remember(uid, files, imageGeometry(image, uniformRescale))
+        printTimings(uid, files, timings, "completed")
+
+    if remaining:
+        refineInBackground(series, files, remaining, volume, autoRescale, workers, schedule, finished)
+    else:
+        finished()
+    return series
+
+# -----------------------------------------------------------------------------
+# Out-of-core loading
+# -----------------------------------------------------------------------------
+
+def volumeBytes(geometry):
+    (xMin, xMax, yMin, yMax, zMin, zMax) = geometry['extent']
+    itemSize = numpy.dtype(numpy_support.get_numpy_array_type(geometry['scalarType'])).itemsize
+    return (xMax - xMin + 1) * (yMax - yMin + 1) * (zMax - zMin + 1) * geometry['components'] * itemSize
+
+def sliceLayout(uid, entry, autoRescale):
+    """
+    Return (files in slice order, geometry with scalar type and components)
+    of a series, or None if the series can not be decoded by slice
+    """
+    if entry.ordered:
+        geometry = dict(entry.geometry)
+        if 'scalarType' not in geometry:
+            # The header index does not know the pixel format, the first slice does
+            output = readChunk(entry.paths[:1], autoRescale).GetOutput()
+            geometry['scalarType'] = output.GetScalarType()
+            geometry['components'] = output.GetNumberOfScalarComponents()
+        return (entry.paths, geometry)
+
+    files = sortFiles(entry.paths)
+    header = readHeaders(files, autoRescale)
+    order = sliceOrder(header, files)
+    if not order:
+        return None
+    info = header.GetOutputInformation(0)
+    geometry = { 'extent': list(info.Get(vtk.vtkStreamingDemandDrivenPipeline.WHOLE_EXTENT())),
+                 'spacing': list(info.Get(vtk.vtkDataObject.SPACING())),
+                 'origin': list(info.Get(vtk.vtkDataObject.ORIGIN())),
+                 'scalarType': vtk.vtkImageData.GetScalarType(info),
+                 'components': vtk.vtkImageData.GetNumberOfScalarComponents(info),
+                 'uniformRescale': rescaleOf(header.GetMetaData())[1] }
+    # Whatever loads the series next skips the sorting
+    catalog().remember(uid, order, geometry)
+    return (order, geometry)
+
+def decodeBricked(uid, files, geometry, autoRescale, workers):
+    """
+    Decode a series slab by slab into the bricked format of the cache,
+    holding one slab of bricked_volume.BRICK_SIZE slices at a time
+    """
+    size = bricked_volume.BRICK_SIZE
+    workers, chunk = chunking(size, workers)
+
+    def writeRaw(raw_file):
+        # The first chunk gives the scalar type, geometry and meta data
+        first = readChunk(files[:chunk], autoRescale)
+        output = first.GetOutput()
+        (xMin, xMax, yMin, yMax, zMin, zMax) = output.GetExtent()
+        processes = decodeProcesses(first.GetMetaData())
+        slab = allocateVolume((size, yMax - yMin + 1, xMax - xMin + 1, output.GetNumberOfScalarComponents()),
+                              numpy_support.get_numpy_array_type(output.GetScalarType()), shared=processes > 0)
+        copyChunk(first, 0, slab)
+        rescales = rescalesOf(first.GetMetaData())
+        # One set of processes for all slabs, they keep writing into the same one
+        decoder = ForkedDecoder(slab, processes) if processes else None
+        try:
+            start = chunk
+            for begin in range(0, len(files), size):
+                slabFiles = files[begin:begin + size]
+                rescales |= decodeChunks(slabFiles, start, chunk, slab, autoRescale, workers, decoder)
+                bricked_volume.writeSlab(raw_file, slab[:len(slabFiles)], size)
+                start = 0
+        finally:
+            if decoder:
+                decoder.close()
+
+        spacing = list(output.GetSpacing())
+        if chunk < 2:
+            spacing[2] = geometry['spacing'][2]
+        header = series_cache.makeHeader(uid, files, (xMin, xMax, yMin, yMax, 0, len(files) - 1), spacing,
+                                         output.GetOrigin(), output.GetScalarType(),
+                                         output.GetNumberOfScalarComponents(),
+                                         first.GetMetaData(), first.GetPatientMatrix(), len(rescales) == 1)
+        header['brickSize'] = size
+        return header
+
+    _cache[0].writeEntry(uid, autoRescale, writeRaw, bricked_volume.LAYOUT)
+
+def brickedSeries(uid, volume, timings):
+    header = volume.header
+    image = vtk.vtkImageData()
+    image.SetExtent(header['extent'])
+    image.SetSpacing(header['spacing'])
+    image.SetOrigin(header['origin'])
+    return Series(uid, image, series_cache.restoreMetaData(header), series_cache.restorePatientMatrix(header),
+                  timings, bricked_volume.BrickedVolumeSource(volume), header.get('uniformRescale'))
+
+def loadBricked(uid, entry, autoRescale, workers, timings):
+    """
+    Return (Series, how) of a series kept out of core, or None if it is
+    small enough for memory or can not be decoded by slice
+    """
+    begin = time.time()
+    volume = bricked_volume.openVolume(_cache[0], uid, autoRescale, entry.paths, _bricks[0])
+    if volume:
+        timings['cache'] = time.time() - begin
+        return (brickedSeries(uid, volume, timings), "bricks from cache")
+
+    # Decoded whole before, or known to be small: no header pass to find out
+    if _cache[0].readHeader(uid, autoRescale, entry.paths):
+        return None
+    geometry = entry.geometry or {}
+    if 'scalarType' in geometry and volumeBytes(geometry) <= _outOfCoreSize[0]:
+        return None
+
+    layout = sliceLayout(uid, entry, autoRescale)
+    timings['sort'] = time.time() - begin
+    if not layout or volumeBytes(layout[1]) <= _outOfCoreSize[0]:
+        return None
+
+    begin = time.time()
+    decodeBricked(uid, layout[0], layout[1], autoRescale, workers)
+    timings['decode'] = time.time() - begin
+    volume = bricked_volume.openVolume(_cache[0], uid, autoRescale, layout[0], _bricks[0])
+    if not volume:
+        # Evicted right away, the cache is smaller than the series
+        return None
+    return (brickedSeries(uid, volume, timings), "decoded to bricks")
+
+def printTimings(uid, files, timings, how):
+    print("Loaded series %s, %d files, %s: %s" % (uid, len(files), how,
+        ', '.join(["%s %.3fs" % (stage, timings[stage]) for stage in timings])))
+    sys.stdout.flush()
+
+# =============================================================================
+# Load a series by its uid
+# =============================================================================
+
+def rescaleList(metaData):
+    """
+    Return the (slope, intercept) of every file in the meta data
+    """
+    if metaData is None:
+        return [(1.0, 0.0)]
+    rescales = []
+    for i in range(max(1, metaData.GetNumberOfInstances())):
+        slope = metaData.Get(i, vtk.vtkDICOMTag(*RESCALE_SLOPE))
+        intercept = metaData.Get(i, vtk.vtkDICOMTag(*RESCALE_INTERCEPT))
+        rescales.append((slope.AsDouble() if slope.IsValid() and slope.AsDouble() else 1.0,
+                         intercept.AsDouble() if intercept.IsValid() else 0.0))
+    return rescales
+
+def rescalesOf(metaData):
+    """
+    Return the set of the different (slope, intercept) in the meta data
+    """
+    return set(rescaleList(metaData))
+
+def rescaleOf(metaData):
+    """
+    Return (slope, intercept) of the first file of a series and whether
+    every file in the meta data has the same
+    """
+    rescales = rescaleList(metaData)
+    return (rescales[0], len(set(rescales)) == 1)
+
+def imageGeometry(image, uniformRescale=None):
+    scalars = image.GetPointData().GetScalars()
+    return { 'extent': list(image.GetExtent()), 'spacing': list(image.GetSpacing()),
+             'origin': list(image.GetOrigin()), 'scalarType': scalars.GetDataType(),
+             'components': scalars.GetNumberOfComponents(), 'uniformRescale': uniformRescale }
+
+def lookupCache(uid, files, autoRescale, timings):
+    cache = _cache[0]
+    if not cache:
+        return None
+    begin = time.time()
+    cached = cache.lookup(uid, autoRescale, files)
+    if cached:
+        timings['cache'] = time.time() - begin
+    return cached
+
+def loadVolume(uid, entry, autoRescale, workers, timings):
+    """
+    Return (image, metaData, patientMatrix, uniformRescale, how) of a
+    series, from the cache or decoded
+    """
+    files = entry.paths
+    cached = lookupCache(uid, files, autoRescale, timings)
+    if cached:
+        return cached + ("from cache",)
+    cache = _cache[0]
+
+    if entry.ordered:
+        # Slice order and spacing are known from the header index or an
+        # earlier load, no need to look at every header first
+        begin = time.time()
+        (image, metaData, patientMatrix, uniformRescale) = decodeOrdered(files, entry.geometry, autoRescale, workers)
+        timings['decode'] = time.time() - begin
+    else:
+        begin = time.time()
+        files = sortFiles(files)
+        header = readHeaders(files, autoRescale)
+        order = sliceOrder(header, files)
+        timings['sort'] = time.time() - begin
+
+        begin = time.time()
+        if order:
+            volume, scalarType = decodeSlices(header, order, workers)
+        else:
+            header.Update()
+        timings['decode'] = time.time() - begin
+
+        begin = time.time()
+        if order:
+            image = assembleImage(header, volume, scalarType)
+        else:
+            image = header.GetOutput()
+        (metaData, patientMatrix) = (header.GetMetaData(), header.GetPatientMatrix())
+        uniformRescale = rescaleOf(metaData)[1]
+        timings['assemble'] = time.time() - begin
+
+        # Multi-frame series have no per file order to remember
+        catalog().remember(uid, order, imageGeometry(image, uniformRescale))
+
+    if cache:
+        begin = time.time()
+        try:
+            cache.store(uid, autoRescale, files, image, metaData, patientMatrix, uniformRescale)
+        except (IOError, OSError) as e:
+            print("Could not cache series %s: %s" % (uid, e))
+        timings['store'] = time.time() - begin
+
+    return (image, metaData, patientMatrix, uniformRescale, "decoded")
+
+def loadSeries(uid, autoRescale=True, workers=DECODE_WORKERS, schedule=None, outOfCore=False):
+    """
+    Return the Series of a uid. With --progressive and a schedule function
+    (see refineInBackground) a series that has to be decoded comes back as
+    a preview and completes in the background, see Series.onUpdate().
+    Shared volumes are always published complete. With outOfCore and
+    --cache-dir a series above --out-of-core-size is read by brick, for
+    pipelines that only request slices of it. With --compact-storage
+    autoRescale only applies to series whose files do not share one
+    rescale, all others keep their stored values, see Series.rescale.
+    """
+    try:
+        rescaled = autoRescale and not _compact[0]
+        series = loadVoxels(uid, rescaled, workers, schedule, outOfCore)
+        if rescaled:
+            return series
+
+        (series.rescale, uniform) = rescaleOf(series.GetMetaData())
+        if series.uniformRescale is not None:
+            uniform = series.uniformRescale
+        if uniform or not autoRescale:
+            return series
+        # One stored value would stand for different modality values
+        print("Files of series %s are rescaled differently, loading it rescaled" % uid)
+        sys.stdout.flush()
+        return loadVoxels(uid, True, workers, schedule, outOfCore)
+    finally:
+        # The paths are known, what loading learns is remembered in memory
+        catalog().release()
+
+def loadVoxels(uid, autoRescale, workers, schedule, outOfCore):
+    timings = collections.OrderedDict()
+
+    begin = time.time()
+    entry = catalog().lookup(uid)
+    timings['query'] = time.time() - begin
+    if not entry:
+        raise ValueError("Series %s has no images in the catalog" % uid)
+    files = entry.paths
+
+    if outOfCore and _bricks[0]:
+        bricked = loadBricked(uid, entry, autoRescale, workers, timings)
+        if bricked:
+            printTimings(uid, files, timings, bricked[1])
+            return bricked[0]
+
+    if _progressive[0] and schedule and not _shared[0]:
+        cached = lookupCache(uid, files, autoRescale, timings)
+        if cached:
+            printTimings(uid, files, timings, "from cache")
+            return Series(uid, cached[0], cached[1], cached[2], timings, uniformRescale=cached[3])
+        series = loadProgressive(uid, entry, autoRescale, workers, timings, schedule)
+        if series:
+            printTimings(uid, files, timings, "preview" if not series.complete else "decoded")
+            return series
+
+    load = lambda: loadVolume(uid, entry, autoRescale, workers, timings)
+    shared = _shared[0]
+    if shared:
+        begin = time.time()
+        (image, metaData, patientMatrix, uniformRescale, how) = shared.attach(uid, autoRescale, files, load)
+        # Includes loading if this process published the series
+        timings['attach'] = time.time() - begin
+    else:
+        (image, metaData, patientMatrix, uniformRescale, how) = load()
+
+    printTimings(uid, files, timings, how)
+
+    return Series(uid, image, metaData, patientMatrix, timings, uniformRescale=uniformRescale)
@@ -0,0 +1,156 @@
+r"""
+    Control channel between the launcher and a render process.
+
+    A process started with --pooled belongs to the launcher's process pool.
+    It imports everything it needs, then blocks until the launcher writes the
+    session variables (as a single JSON line) to its stdin. Only then does it
+    load its data and start the web server.
+
+    A process started with --shared serves every client that opens the same
+    series. The launcher hands each new client's secret over on stdin as a
+    {"secret": ...} line, and revokes it with {"revoke": ...} once the client
+    is gone.
+
+    While serving, the process reports when a client last interacted with it
+    by printing "Last interaction <seconds since epoch>" lines. The launcher
+    reads them to evict sessions that have been idle for too long. Only the
+    RPCs of protocols made interactive() count: renders do not, an idle
+    view may still render for a progressive load or a background job.
+"""
+import functools
+import inspect
+import json
+import sys
+import threading
+import time
+
+# Prefix of the lines reporting the last interaction, the launcher looks for it
+INTERACTION_PREFIX = "Last interaction "
+
+# Report at most once per this many seconds, far below any sensible idle timeout
+INTERACTION_REPORT_INTERVAL = 10
+
+# -----------------------------------------------------------------------------
+
+def add_arguments(parser):
+    parser.add_argument("--pooled",
+        help="start idle and wait for the launcher to assign a session on stdin",
+        action="store_true")
+    parser.add_argument("--shared",
+        help="accept the client secrets the launcher sends on stdin in addition to --authKey",
+        action="store_true")
+
+# -----------------------------------------------------------------------------
+# Block until the launcher hands a session over. Keyword arguments map the
+# launcher variables onto the argument names of the script, for example
+# uid="content" stores the assigned uid in args.content.
+# -----------------------------------------------------------------------------
+
+def waitForAssignment(args, **fields):
+    if not args.pooled:
+        return args
+
+    print("Waiting for session assignment")
+    sys.stdout.flush()
+
+    line = sys.stdin.readline()
+    if not line:
+        # The launcher went away before using us
+        sys.exit(0)
+
+    assignment = json.loads(line)
+    for key in fields:
+        if key in assignment:
+            setattr(args, fields[key], assignment[key])
+
+    return args
+
+# -----------------------------------------------------------------------------
+# Interaction reports
+# -----------------------------------------------------------------------------
+
+_lastReport = [0]
+
+def reportInteraction():
+    now = time.time()
+    if now - _lastReport[0] < INTERACTION_REPORT_INTERVAL:
+        return
+    _lastReport[0] = now
+    print("%s%.3f" % (INTERACTION_PREFIX, now))
+    sys.stdout.flush()
+
+def _reporting(method):
+    @functools.wraps(method)
+    def call(*args, **kwargs):
+        reportInteraction()
+        return method(*args, **kwargs)
+    return call
+
+# -----------------------------------------------------------------------------
+# Return a subclass of a wslink protocol class whose RPCs report an
+# interaction, for the protocols a client only calls when its user acts:
+#
+#   self.registerVtkWebProtocol(session_control.interactive(vtk_protocols.vtkWebMouseHandler)())
+# -----------------------------------------------------------------------------
+
+def interactive(protocolClass):
+    methods = {}
+    for (name, method) in inspect.getmembers(protocolClass, inspect.isfunction):
+        # Set by wslink's register, wraps() copies it to the wrapper
+        if '_wslinkuris' in method.__dict__:
+            methods[name] = _reporting(method)
+    return type(protocolClass.__name__, (protocolClass,), methods)
+
+# -----------------------------------------------------------------------------
+# Client secrets of a shared session
+# -----------------------------------------------------------------------------
+
+class ClientSecrets(str):
+    """
+    Authentication key that compares equal to any secret currently granted.
+    It stands in for the plain key given to updateSecret().
+    """
+    def __new__(cls, secret):
+        self = str.__new__(cls, secret)
+        self.secrets = set([secret])
+        return self
+
+    def __eq__(self, other):
+        return other in self.secrets
+
+    def __ne__(self, other):
+        return not other in self.secrets
+
+    __hash__ = str.__hash__
+
+    def grant(self, secret):
+        self.secrets = self.secrets | set([secret])
+
+    def revoke(self, secret):
+        self.secrets = self.secrets - set([secret])
+
+def _listenForSecrets(secrets):
+    for line in iter(sys.stdin.readline, ''):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            continue
+        if 'secret' in message:
+            secrets.grant(message['secret'])
+        if 'revoke' in message:
+            secrets.revoke(message['revoke'])
+
+# -----------------------------------------------------------------------------
+# Return the key to authenticate clients with. For a shared process this
+# starts listening for the secrets of further clients.
+# -----------------------------------------------------------------------------
+
+def clientSecrets(args):
+    if not args.shared:
+        return args.authKey
+
+    secrets = ClientSecrets(args.authKey)
+    listener = threading.Thread(target=_listenForSecrets, args=(secrets,))
+    listener.daemon = True
+    listener.start()
+    return secrets
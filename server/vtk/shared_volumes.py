@@ -0,0 +1,164 @@
+r"""
+    Host-local registry of decoded series shared by the render processes.
+
+    A radiologist typically has a VRT, one MPR per orientation and a 4-view
+    session open on the same series, each in its own process. With
+    --shared-volumes the first of them decodes the series and publishes the
+    voxels in the registry directory, by default on /dev/shm so they live in
+    memory. Every other process maps the same pages instead of holding its
+    own copy.
+
+    Entries use the format of series_cache. Next to every entry a .refs
+    file lists the pids attached to it; it is also the lock (flock) held
+    while the entry is looked up, published or released, so only one process
+    decodes a series and the others wait for it and then map it. The last
+    process to detach removes the entry. Pids of processes that died
+    without detaching are dropped whenever the registry is touched.
+
+    Mappings are copy-on-write: a process that modified the voxels would get
+    private pages and never change what the others see.
+
+    Needs flock, so POSIX only.
+"""
+import atexit
+import errno
+import io
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import series_cache
+
+# Default registry location, tmpfs on Linux
+DEFAULT_DIRECTORY = "/dev/shm/iqweb-volumes"
+
+# -----------------------------------------------------------------------------
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def _readPids(fd):
+    os.lseek(fd, 0, os.SEEK_SET)
+    with io.open(fd, "r", encoding="utf-8", closefd=False) as refs_file:
+        return [int(line) for line in refs_file.read().split()]
+
+def _writePids(fd, pids):
+    os.lseek(fd, 0, os.SEEK_SET)
+    os.ftruncate(fd, 0)
+    os.write(fd, ''.join(["%d\n" % pid for pid in pids]).encode('utf-8'))
+
+# -----------------------------------------------------------------------------
+
+class SharedVolumes(object):
+    def __init__(self, directory=DEFAULT_DIRECTORY):
+        if not fcntl:
+            raise RuntimeError("Shared volumes need flock, which this platform does not have")
+        # Entries stay until their last process detaches, never evict them
+        self.volumes = series_cache.SeriesCache(directory, float('inf'))
+        self.directory = directory
+        self.attached = set()
+        atexit.register(self.detachAll)
+
+    def _lock(self, path, blocking=True):
+        """
+        Open and lock a .refs file. Return its descriptor, or None if not
+        blocking and another process holds it. The file may be removed by
+        its last user while we wait, so retry until the locked file is the
+        one at path.
+        """
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except (IOError, OSError):
+                os.close(fd)
+                return None
+            try:
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    return fd
+            except OSError:
+                pass
+            os.close(fd)
+
+    def _unlock(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def _remove(self, refsPath):
+        # The .refs file goes last, it is the lock of the entry
+        base = refsPath[:-len(".refs")]
+        for path in (base + ".json", base + ".raw", refsPath):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def attach(self, uid, autoRescale, files, load):
+        """
+        Return (image, metaData, patientMatrix, uniformRescale, how) of the
+        series mapped from the registry. If no process published it yet,
+        load() is called to get the same and the result is published first.
+        """
+        self.sweep()
+
+        refsPath = self.volumes.path(uid, autoRescale, ".refs")
+        fd = self._lock(refsPath)
+        try:
+            pids = [pid for pid in _readPids(fd) if pid != os.getpid() and alive(pid)]
+            shared = self.volumes.lookup(uid, autoRescale, files)
+            if shared:
+                how = "shared with %d sessions" % len(pids)
+                (image, metaData, patientMatrix, uniformRescale) = shared
+            else:
+                (image, metaData, patientMatrix, uniformRescale, how) = load()
+                self.volumes.store(uid, autoRescale, files, image, metaData, patientMatrix, uniformRescale)
+                # Drop our own copy for the shared pages
+                image = self.volumes.lookup(uid, autoRescale, files)[0]
+                how += ", published"
+            _writePids(fd, pids + [os.getpid()])
+            self.attached.add(refsPath)
+        finally:
+            self._unlock(fd)
+
+        return (image, metaData, patientMatrix, uniformRescale, how)
+
+    def detach(self, refsPath):
+        fd = self._lock(refsPath)
+        try:
+            pids = [pid for pid in _readPids(fd) if pid != os.getpid() and alive(pid)]
+            if pids:
+                _writePids(fd, pids)
+            else:
+                self._remove(refsPath)
+        finally:
+            self._unlock(fd)
+        self.attached.discard(refsPath)
+
+    def detachAll(self):
+        for refsPath in list(self.attached):
+            self.detach(refsPath)
+
+    def sweep(self):
+        """
+        Remove the entries of processes that died without detaching. Entries
+        locked by another process are left alone.
+        """
+        for name in os.listdir(self.directory):
+            if not name.endswith(".refs"):
+                continue
+            refsPath = os.path.join(self.directory, name)
+            fd = self._lock(refsPath, blocking=False)
+            if fd is None:
+                continue
+            try:
+                if not [pid for pid in _readPids(fd) if alive(pid)]:
+                    self._remove(refsPath)
+            finally:
+                self._unlock(fd)
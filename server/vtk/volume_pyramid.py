@@ -0,0 +1,240 @@
+r"""
+    Coarse copies of a series for interactive rendering.
+
+    Ray casting and reslicing the full-resolution volume while the user
+    rotates or drags makes every frame as slow as the still frame. A
+    VolumePyramid computes levels downsampled by PYRAMID_FACTORS (2x, 4x)
+    in a background thread once the series is loaded, averaging blocks of
+    voxels with numpy. Between the StartInteractionEvent and the
+    EndInteractionEvent of the web application the registered volumes and
+    reslices use a coarse level, then the full resolution is put back and
+    the still frame is pushed.
+
+    Which level a consumer gets is decided by its threshold: the finest
+    level with at most that many voxels, the full resolution if it is small
+    enough already. Volume rendering and reslicing have their own threshold,
+    one slice of a large volume is still cheap. A threshold of 0 never
+    switches. The levels and thresholds are exposed to the client by the
+    VtkPyramid protocol in vtk_protocol.py.
+
+    Out-of-core series (see bricked_volume) have no voxels in memory and
+    get no pyramid.
+"""
+import sys
+import threading
+import time
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+import series_loader
+
+# Downsampling factors of the levels, each a multiple of the one before
+PYRAMID_FACTORS = (2, 4)
+
+# Most voxels a consumer renders while interacting
+DEFAULT_THRESHOLDS = {
+    'volume': 32 * 1024 * 1024,
+    'reslice': 128 * 1024 * 1024,
+}
+
+# -----------------------------------------------------------------------------
+
+def _averageAxis(volume, factor, axis):
+    """
+    Average runs of factor voxels along an axis into float32, a shorter run
+    left at the end on its own
+    """
+    size = volume.shape[axis]
+    whole = size - size % factor
+    shape = list(volume.shape)
+    shape[axis] = -(-size // factor)
+    averaged = numpy.empty(shape, dtype=numpy.float32)
+    (source, target) = ([slice(None)] * volume.ndim, [slice(None)] * volume.ndim)
+    (source[axis], target[axis]) = (slice(0, whole), slice(0, whole // factor))
+    # Splitting the axis is a view, no copy of the volume
+    runs = volume[tuple(source)].reshape(volume.shape[:axis] + (whole // factor, factor) + volume.shape[axis + 1:])
+    runs.mean(axis=axis + 1, dtype=numpy.float32, out=averaged[tuple(target)])
+    if whole < size:
+        (source[axis], target[axis]) = (slice(whole, size), slice(whole // factor, None))
+        volume[tuple(source)].mean(axis=axis, keepdims=True, dtype=numpy.float32, out=averaged[tuple(target)])
+    return averaged
+
+def downsample(volume, factor):
+    """
+    Average blocks of factor^3 voxels of a (z, y, x, components) array.
+    Edges that do not fill a block average the voxels they have.
+    """
+    # One axis after the other, z first: only the full volume's z runs
+    # read it, everything after works on the smaller averages
+    coarse = volume
+    for axis in range(3):
+        coarse = _averageAxis(coarse, factor, axis)
+    if numpy.issubdtype(volume.dtype, numpy.integer):
+        numpy.rint(coarse, out=coarse)
+    return coarse.astype(volume.dtype)
+
+def createVolumeMapper(port, factor=1):
+    """
+    The ray cast mapper of the volume renderings, for a level of factor.
+    Fits addVolume().
+    """
+    volumeMapper = vtk.vtkGPUVolumeRayCastMapper()
+    volumeMapper.SetInputConnection(port)
+    volumeMapper.SetBlendModeToComposite()
+    volumeMapper.AutoAdjustSampleDistancesOff()
+    volumeMapper.UseJitteringOn()
+    # Coarser levels of the pyramid need fewer samples along a ray
+    volumeMapper.SetSampleDistance(volumeMapper.GetSampleDistance() * factor)
+    return volumeMapper
+
+# -----------------------------------------------------------------------------
+
+class Level(object):
+    def __init__(self, factor, producer, dimensions, spacing):
+        self.factor = factor
+        self.producer = producer
+        self.dimensions = dimensions
+        self.spacing = spacing
+        self.voxels = dimensions[0] * dimensions[1] * dimensions[2]
+
+    def describe(self):
+        return { 'factor': self.factor, 'dimensions': list(self.dimensions),
+                 'spacing': list(self.spacing), 'voxels': self.voxels }
+
+class VolumePyramid(object):
+    def __init__(self, series, application, renderWindow, schedule, factors=PYRAMID_FACTORS):
+        """
+        schedule(function, *args) must run function in the main thread,
+        like reactor.callFromThread
+        """
+        self.series = series
+        self.application = application
+        self.renderWindow = renderWindow
+        self.schedule = schedule
+        self.factors = factors
+        self.thresholds = dict(DEFAULT_THRESHOLDS)
+        image = series.GetOutput()
+        self.levels = [Level(1, series.producer, image.GetDimensions(), image.GetSpacing())]
+        self.volumes = []
+        self.reslices = []
+        self.interacting = False
+        # True while a consumer renders a coarse level
+        self.coarse = False
+        self.building = False
+
+        application.AddObserver('StartInteractionEvent', self._startInteraction)
+        # After the image delivery stopped animating, or it drops the still frame
+        application.AddObserver('EndInteractionEvent', self._endInteraction, -1.0)
+
+        if series.complete:
+            self._build()
+        else:
+            series.onUpdate(lambda: series.complete and self._build())
+
+    def addVolume(self, volume, createMapper):
+        """
+        Render a vtkVolume from a coarse level while interacting.
+        createMapper(port, factor) returns a mapper for a level, every
+        level keeps its own so its texture stays on the GPU.
+        """
+        self.volumes.append((volume, createMapper, { 1: volume.GetMapper() }))
+
+    def addReslice(self, reslice):
+        self.reslices.append(reslice)
+
+    def levelFor(self, kind):
+        threshold = self.thresholds.get(kind)
+        if not threshold:
+            return self.levels[0]
+        for level in self.levels:
+            if level.voxels <= threshold:
+                return level
+        return self.levels[-1]
+
+    def setThresholds(self, thresholds):
+        for kind in thresholds:
+            if kind not in self.thresholds:
+                raise ValueError("Unknown consumer %s" % kind)
+        for kind in thresholds:
+            self.thresholds[kind] = int(thresholds[kind])
+
+    def describe(self):
+        return {
+            'levels': [level.describe() for level in self.levels],
+            'pending': [factor for factor in self.factors if factor not in [level.factor for level in self.levels]],
+            'thresholds': dict(self.thresholds),
+            'interacting': self.interacting,
+            'active': { 'volume': self.levelFor('volume').factor if self.interacting else 1,
+                        'reslice': self.levelFor('reslice').factor if self.interacting else 1 },
+        }
+
+    def _use(self, volumeLevel, resliceLevel):
+        for (volume, createMapper, mappers) in self.volumes:
+            if volumeLevel.factor not in mappers:
+                mappers[volumeLevel.factor] = createMapper(volumeLevel.producer.GetOutputPort(), volumeLevel.factor)
+            volume.SetMapper(mappers[volumeLevel.factor])
+        for reslice in self.reslices:
+            reslice.SetInputConnection(resliceLevel.producer.GetOutputPort())
+        self.coarse = volumeLevel.factor != 1 or resliceLevel.factor != 1
+
+    def _startInteraction(self, *args):
+        self.interacting = True
+        self._use(self.levelFor('volume'), self.levelFor('reslice'))
+
+    def _endInteraction(self, *args):
+        self.interacting = False
+        if not self.coarse:
+            return
+        self._use(self.levels[0], self.levels[0])
+        self.application.InvalidateCache(self.renderWindow)
+        self.application.InvokeEvent('UpdateEvent')
+
+    # -------------------------------------------------------------------------
+    # Building the levels
+    # -------------------------------------------------------------------------
+
+    def _build(self):
+        image = self.series.GetOutput()
+        scalars = image.GetPointData().GetScalars()
+        if self.building or scalars is None:
+            return
+        self.building = True
+
+        (xSize, ySize, zSize) = image.GetDimensions()
+        volume = numpy_support.vtk_to_numpy(scalars).reshape(zSize, ySize, xSize, scalars.GetNumberOfComponents())
+        (x0, y0, z0) = image.GetOrigin()
+        (xMin, xMax, yMin, yMax, zMin, zMax) = image.GetExtent()
+        spacing = image.GetSpacing()
+        corner = (x0 + xMin * spacing[0], y0 + yMin * spacing[1], z0 + zMin * spacing[2])
+        scalarType = scalars.GetDataType()
+
+        def build():
+            current = (1, volume)
+            try:
+                for factor in self.factors:
+                    begin = time.time()
+                    coarse = downsample(current[1], factor // current[0])
+                    current = (factor, coarse)
+                    # The voxel of a block sits at the center of the voxels it averages
+                    origin = [corner[i] + 0.5 * (factor - 1) * spacing[i] for i in range(3)]
+                    self.schedule(self._levelReady, factor, coarse, origin, [s * factor for s in spacing],
+                                  scalarType, time.time() - begin)
+            except Exception as e:
+                print("Building the pyramid of series %s failed: %s" % (self.series.uid, e))
+                sys.stdout.flush()
+
+        thread = threading.Thread(target=build)
+        thread.daemon = True
+        thread.start()
+
+    def _levelReady(self, factor, coarse, origin, spacing, scalarType, elapsed):
+        (z, y, x) = coarse.shape[:3]
+        image = series_loader.imageFromVolume((0, x - 1, 0, y - 1, 0, z - 1), spacing, origin, coarse, scalarType)
+        producer = vtk.vtkTrivialProducer()
+        producer.SetOutput(image)
+        self.levels.append(Level(factor, producer, (x, y, z), spacing))
+
+        print("Pyramid level %dx of series %s: %d x %d x %d in %.3fs" % (factor, self.series.uid, x, y, z, elapsed))
+        sys.stdout.flush()
@@ -45,9 +45,14 @@ from vtk.web import protocols as vtk_protocols
 
 import vtk
 import vtk_override_protocols
-from vtk_protocol import VtkCone
-import mysql.connector
-from credentials import credentials
+
+# import Twisted reactor for later callback
+from twisted.internet import reactor
+
+import session_control
+import series_loader
+import volume_pyramid
+from vtk_protocol import VtkCone, VtkPyramid
 
 # =============================================================================
 # Server class
@@ -68,18 +73,18 @@ class _Server(vtk_wslink.ServerProtocol):
     @staticmethod
     def configure(args):
         # Standard args
-        _Server.authKey = args.authKey
+        _Server.authKey = session_control.clientSecrets(args)
         _Server.uid = args.content
         _Server.orientation = args.uploadPath
 
     def initialize(self):
         # Bring used components
-        self.registerVtkWebProtocol(vtk_protocols.vtkWebMouseHandler())
-        self.registerVtkWebProtocol(vtk_protocols.vtkWebViewPort())
+        self.registerVtkWebProtocol(session_control.interactive(vtk_protocols.vtkWebMouseHandler)())
+        self.registerVtkWebProtocol(session_control.interactive(vtk_protocols.vtkWebViewPort)())
         self.registerVtkWebProtocol(vtk_override_protocols.vtkWebPublishImageDelivery(decode=False))
 
         # Custom API
-        self.registerVtkWebProtocol(VtkCone())
+        self.registerVtkWebProtocol(session_control.interactive(VtkCone)())
 
         # tell the C++ web app to use no encoding.
         # ParaViewWebPublishImageDelivery must be set to decode=False to match.
@@ -159,15 +164,11 @@ class _Server(vtk_wslink.ServerProtocol):
                     return [0.0, 0.0, 1.0, 1.0]
 
         
-            def doVolumeRendering(renWin, reader, viewNr):
+            def doVolumeRendering(renWin, series, viewNr):
                 # The volume will be displayed by ray-cast alpha compositing.
                 # A ray-cast mapper is needed to do the ray-casting, and a
                 # compositing function is needed to do the compositing along the ray.
-                volumeMapper = vtk.vtkGPUVolumeRayCastMapper()
-                volumeMapper.SetInputConnection(reader.GetOutputPort())
-                volumeMapper.SetBlendModeToComposite()
-                volumeMapper.AutoAdjustSampleDistancesOff()
-                volumeMapper.UseJitteringOn()
+                volumeMapper = volume_pyramid.createVolumeMapper(series.GetOutputPort())
                 
                 offset = -1024
 
@@ -176,13 +177,13 @@ class _Server(vtk_wslink.ServerProtocol):
                 # The goal is to one color for flesh (between 500 and 1000)
                 # and another color for bone (1150 and over).
                 volumeColor = vtk.vtkColorTransferFunction()
-                volumeColor.AddRGBPoint(1024 + offset, 0.53125, 0.171875, 0.0507813)
-                volumeColor.AddRGBPoint(1031 + offset, 0.488281, 0.148438, 0.0351563)
-                volumeColor.AddRGBPoint(1000 + offset, 0.589844, 0.0257813, 0.0148438)
-                volumeColor.AddRGBPoint(1170 + offset, 0.589844, 0.0257813, 0.0148438)
-                volumeColor.AddRGBPoint(1181 + offset, 0.957031, 0.996094, 0.878906)
-                volumeColor.AddRGBPoint(2024 + offset, 0.976563, 0.996094, 0.929688)
-                volumeColor.AddRGBPoint(3014 + offset, 0.488281, 0.488281, 0.488281)
+                volumeColor.AddRGBPoint(series.storedValue(1024 + offset), 0.53125, 0.171875, 0.0507813)
+                volumeColor.AddRGBPoint(series.storedValue(1031 + offset), 0.488281, 0.148438, 0.0351563)
+                volumeColor.AddRGBPoint(series.storedValue(1000 + offset), 0.589844, 0.0257813, 0.0148438)
+                volumeColor.AddRGBPoint(series.storedValue(1170 + offset), 0.589844, 0.0257813, 0.0148438)
+                volumeColor.AddRGBPoint(series.storedValue(1181 + offset), 0.957031, 0.996094, 0.878906)
+                volumeColor.AddRGBPoint(series.storedValue(2024 + offset), 0.976563, 0.996094, 0.929688)
+                volumeColor.AddRGBPoint(series.storedValue(3014 + offset), 0.488281, 0.488281, 0.488281)
 
                 # The opacity transfer function is used to control the opacity
                 # of different tissue types.
@@ -192,9 +193,9 @@ class _Server(vtk_wslink.ServerProtocol):
                 #volumeScalarOpacity.AddPoint(1000, 0.15)
                 #volumeScalarOpacity.AddPoint(1150, 0.85)
 
-                volumeScalarOpacity.AddPoint(1131 + offset,  0)
-                volumeScalarOpacity.AddPoint(1463 + offset,  1)
-                volumeScalarOpacity.AddPoint(3135 + offset, 1)
+                volumeScalarOpacity.AddPoint(series.storedValue(1131 + offset),  0)
+                volumeScalarOpacity.AddPoint(series.storedValue(1463 + offset),  1)
+                volumeScalarOpacity.AddPoint(series.storedValue(3135 + offset), 1)
 
                 # The gradient opacity function is used to decrease the opacity
                 # in the "flat" regions of the volume while maintaining the opacity
@@ -202,9 +203,9 @@ class _Server(vtk_wslink.ServerProtocol):
                 # as the amount by which the intensity changes over unit distance.
                 # For most medical data, the unit distance is 1mm.
                 volumeGradientOpacity = vtk.vtkPiecewiseFunction()
-                volumeGradientOpacity.AddPoint(0,   0.0)
-                volumeGradientOpacity.AddPoint(90,  0.9)
-                volumeGradientOpacity.AddPoint(100, 1.0)
+                volumeGradientOpacity.AddPoint(series.storedDelta(0),   0.0)
+                volumeGradientOpacity.AddPoint(series.storedDelta(90),  0.9)
+                volumeGradientOpacity.AddPoint(series.storedDelta(100), 1.0)
 
                 # The VolumeProperty attaches the color and opacity functions to the
                 # volume, and sets other volume properties.  The interpolation should
@@ -254,13 +255,14 @@ class _Server(vtk_wslink.ServerProtocol):
                 
                 ren.ResetCamera();
 
-            def doReslice(renWin, reader, viewNr, orientation, level, window):
+                return volume
+
+            def doReslice(renWin, series, viewNr, orientation, level, window):
                         
                 # Calculate the center of the volume
-                reader.Update()
-                (xMin, xMax, yMin, yMax, zMin, zMax) = reader.GetExecutive().GetWholeExtent(reader.GetOutputInformation(0))
-                (xSpacing, ySpacing, zSpacing) = reader.GetOutput().GetSpacing()
-                (x0, y0, z0) = reader.GetOutput().GetOrigin()
+                (xMin, xMax, yMin, yMax, zMin, zMax) = series.GetOutput().GetExtent()
+                (xSpacing, ySpacing, zSpacing) = series.GetOutput().GetSpacing()
+                (x0, y0, z0) = series.GetOutput().GetOrigin()
 
                 center = [x0 + xSpacing * 0.5 * (xMin + xMax),
                           y0 + ySpacing * 0.5 * (yMin + yMax),
@@ -287,7 +289,7 @@ class _Server(vtk_wslink.ServerProtocol):
 
                 # Extract a slice in the desired orientation
                 reslice = vtk.vtkImageReslice()
-                reslice.SetInputConnection(reader.GetOutputPort())
+                reslice.SetInputConnection(series.GetOutputPort())
                 reslice.SetOutputDimensionality(2)
                 reslice.SetResliceAxes(axial)
                 if orientation == "coronal":
@@ -301,7 +303,7 @@ class _Server(vtk_wslink.ServerProtocol):
 
                 # Create a greyscale lookup table
                 table = vtk.vtkLookupTable()
-                table.SetRange(range1, range2) # image intensity range
+                table.SetRange(*series.storedRange(range1, range2)) # image intensity range, in voxel values
                 table.SetValueRange(0.0, 1.0) # from black to white
                 table.SetSaturationRange(0.0, 0.0) # no color saturation
                 table.SetRampToLinear()
@@ -357,50 +359,29 @@ class _Server(vtk_wslink.ServerProtocol):
             interactorStyleTrackball.SetMotionFactor(20) # 10 is default, we need twice the speed to compensate the smaller viewport
             iren.SetInteractorStyle(interactorStyleImage)
 
-            cred = credentials()
-
-            mydb = mysql.connector.connect(
-              host="localhost",
-              user=cred[0],
-              password=cred[1],
-              database="iqweb"
-            )
-
-            mycursor = mydb.cursor()
-            sql = "SELECT path FROM image WHERE seriesuid = %s"
-            params = (self.uid,)
-            mycursor.execute(sql, params)
-
-            files = mycursor.fetchall()
-            fileset = vtk.vtkStringArray()
-            for file in files:
-                fileset.InsertNextValue(file[0])
-
-            sorter = vtk.vtkDICOMFileSorter()
-            sorter.SetInputFileNames(fileset)
-            sorter.Update()
+            series = series_loader.loadSeries(self.uid)
 
-            sortedFiles = vtk.vtkStringArray()
-            sortedFiles = sorter.GetFileNamesForSeries(0)
-
-            reader = vtk.vtkDICOMReader()
-            reader.SetFileNames(sortedFiles);
-            reader.Update()
-
-            meta = reader.GetMetaData();
+            meta = series.GetMetaData();
 
             level = meta.Get(vtk.vtkDICOMTag(0x0028,0x1050)).AsUTF8String().split("\\")[0]
             window = meta.Get(vtk.vtkDICOMTag(0x0028,0x1051)).AsUTF8String().split("\\")[0]
             
             resliceList = []
             
-            resliceList.append(doReslice(renWin, reader, 0, 'axial', level, window))
+            resliceList.append(doReslice(renWin, series, 0, 'axial', level, window))
+
+            resliceList.append(doReslice(renWin, series, 1, 'coronal', level, window))
 
-            resliceList.append(doReslice(renWin, reader, 1, 'coronal', level, window))
+            resliceList.append(doReslice(renWin, series, 2, 'sagittal', level, window))
 
-            resliceList.append(doReslice(renWin, reader, 2, 'sagittal', level, window))
+            volume = doVolumeRendering(renWin, series, 3)
 
-            doVolumeRendering(renWin, reader, 3)
+            # Interact with downsampled copies, render the full resolution when the user lets go
+            pyramid = volume_pyramid.VolumePyramid(series, self.getApplication(), renWin, reactor.callFromThread)
+            pyramid.addVolume(volume, volume_pyramid.createVolumeMapper)
+            for reslice in resliceList:
+                pyramid.addReslice(reslice)
+            self.registerVtkWebProtocol(session_control.interactive(VtkPyramid)(pyramid))
 
             # Create callbacks for slicing the image
             actions = {}
@@ -473,15 +454,22 @@ class _Server(vtk_wslink.ServerProtocol):
 # Main: Parse args and start serverviewId
 # =============================================================================
 
-if __name__ == "__main__":
+def main(argv=None):
     # Create argument parser
     parser = argparse.ArgumentParser(description="MPR")
 
     # Add arguments
     server.add_arguments(parser)
     _Server.add_arguments(parser)
-    args = parser.parse_args()
+    session_control.add_arguments(parser)
+    series_loader.add_arguments(parser)
+    args = parser.parse_args(argv)
+    session_control.waitForAssignment(args, uid="content")
+    series_loader.configure(args)
     _Server.configure(args)
 
     # Start server
     server.start_webserver(options=args, protocol=_Server, disableLogging=True)
+
+if __name__ == "__main__":
+    main()
@@ -44,9 +44,13 @@ from vtk.web import protocols as vtk_protocols
 
 import vtk
 import vtk_override_protocols
+
+# import Twisted reactor for later callback
+from twisted.internet import reactor
+
+import session_control
+import series_loader
 from vtk_protocol import VtkCone
-import mysql.connector
-from credentials import credentials
 
 # =============================================================================
 # Server class
@@ -67,18 +71,18 @@ class _Server(vtk_wslink.ServerProtocol):
     @staticmethod
     def configure(args):
         # Standard args
-        _Server.authKey = args.authKey
+        _Server.authKey = session_control.clientSecrets(args)
         _Server.uid = args.content
         _Server.orientation = args.uploadPath
 
     def initialize(self):
         # Bring used components
-        self.registerVtkWebProtocol(vtk_protocols.vtkWebMouseHandler())
-        self.registerVtkWebProtocol(vtk_protocols.vtkWebViewPort())
+        self.registerVtkWebProtocol(session_control.interactive(vtk_protocols.vtkWebMouseHandler)())
+        self.registerVtkWebProtocol(session_control.interactive(vtk_protocols.vtkWebViewPort)())
         self.registerVtkWebProtocol(vtk_override_protocols.vtkWebPublishImageDelivery(decode=False))
 
         # Custom API
-        self.registerVtkWebProtocol(VtkCone())
+        self.registerVtkWebProtocol(session_control.interactive(VtkCone)())
 
         # tell the C++ web app to use no encoding.
         # ParaViewWebPublishImageDelivery must be set to decode=False to match.
@@ -100,41 +104,12 @@ class _Server(vtk_wslink.ServerProtocol):
             interactorStyle = vtk.vtkInteractorStyleImage()
             iren.SetInteractorStyle(interactorStyle)
             
-            cred = credentials()
-
-            mydb = mysql.connector.connect(
-              host="localhost",
-              user=cred[0],
-              password=cred[1],
-              database="iqweb"
-            )
-
-            mycursor = mydb.cursor()
-            sql = "SELECT path FROM image WHERE seriesuid = %s"
-            params = (self.uid,)
-            mycursor.execute(sql, params)
-
-            files = mycursor.fetchall()
-            fileset = vtk.vtkStringArray()
-            for file in files:
-                fileset.InsertNextValue(file[0])
-
-            sorter = vtk.vtkDICOMFileSorter()
-            sorter.SetInputFileNames(fileset)
-            sorter.Update()
-
-            sortedFiles = vtk.vtkStringArray()
-            sortedFiles = sorter.GetFileNamesForSeries(0)
-
-            reader = vtk.vtkDICOMReader()
-            reader.SetFileNames(sortedFiles);
-            reader.Update()
+            series = series_loader.loadSeries(self.uid, schedule=reactor.callFromThread, outOfCore=True)
 
             # Calculate the center of the volume
-            reader.Update()
-            (xMin, xMax, yMin, yMax, zMin, zMax) = reader.GetExecutive().GetWholeExtent(reader.GetOutputInformation(0))
-            (xSpacing, ySpacing, zSpacing) = reader.GetOutput().GetSpacing()
-            (x0, y0, z0) = reader.GetOutput().GetOrigin()
+            (xMin, xMax, yMin, yMax, zMin, zMax) = series.GetOutput().GetExtent()
+            (xSpacing, ySpacing, zSpacing) = series.GetOutput().GetSpacing()
+            (x0, y0, z0) = series.GetOutput().GetOrigin()
 
             center = [x0 + xSpacing * 0.5 * (xMin + xMax),
                       y0 + ySpacing * 0.5 * (yMin + yMax),
@@ -161,7 +136,7 @@ class _Server(vtk_wslink.ServerProtocol):
 
             # Extract a slice in the desired orientation
             reslice = vtk.vtkImageReslice()
-            reslice.SetInputConnection(reader.GetOutputPort())
+            reslice.SetInputConnection(series.GetOutputPort())
             reslice.SetOutputDimensionality(2)
             reslice.SetResliceAxes(axial)
             if self.orientation == "coronal":
@@ -170,7 +145,7 @@ class _Server(vtk_wslink.ServerProtocol):
                 reslice.SetResliceAxes(sagittal)
             reslice.SetInterpolationModeToLinear()
 
-            meta = reader.GetMetaData();
+            meta = series.GetMetaData();
 
             level = meta.Get(vtk.vtkDICOMTag(0x0028,0x1050)).AsUTF8String().split("\\")[0]
             window = meta.Get(vtk.vtkDICOMTag(0x0028,0x1051)).AsUTF8String().split("\\")[0]
@@ -180,7 +155,7 @@ class _Server(vtk_wslink.ServerProtocol):
 
             # Create a greyscale lookup table
             table = vtk.vtkLookupTable()
-            table.SetRange(range1, range2) # image intensity range
+            table.SetRange(*series.storedRange(range1, range2)) # image intensity range, in voxel values
             table.SetValueRange(0.0, 1.0) # from black to white
             table.SetSaturationRange(0.0, 0.0) # no color saturation
             table.SetRampToLinear()
@@ -230,6 +205,7 @@ class _Server(vtk_wslink.ServerProtocol):
             interactorStyle.AddObserver("LeftButtonPressEvent", ButtonCallback)
             interactorStyle.AddObserver("LeftButtonReleaseEvent", ButtonCallback)
 
+            series.refreshWhileLoading(self.getApplication(), renWin)
             renWin.Render()
             
             # vtkweb
@@ -239,15 +215,22 @@ class _Server(vtk_wslink.ServerProtocol):
 # Main: Parse args and start serverviewId
 # =============================================================================
 
-if __name__ == "__main__":
+def main(argv=None):
     # Create argument parser
     parser = argparse.ArgumentParser(description="MPR")
 
     # Add arguments
     server.add_arguments(parser)
     _Server.add_arguments(parser)
-    args = parser.parse_args()
+    session_control.add_arguments(parser)
+    series_loader.add_arguments(parser)
+    args = parser.parse_args(argv)
+    session_control.waitForAssignment(args, uid="content", orientation="uploadPath")
+    series_loader.configure(args)
     _Server.configure(args)
 
     # Start server
     server.start_webserver(options=args, protocol=_Server, disableLogging=True)
+
+if __name__ == "__main__":
+    main()
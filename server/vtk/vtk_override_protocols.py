@@ -8,6 +8,10 @@ from twisted.internet import reactor
 # from autobahn.wamp import register as exportRpc
 from wslink import register as exportRpc
 
+import adaptive_quality
+import delta_frames
+import frame_encoders
+
 # =============================================================================
 #
 # Provide publish-based Image delivery mechanism
@@ -15,7 +19,7 @@ from wslink import register as exportRpc
 # =============================================================================
 
 class vtkWebPublishImageDelivery(vtk_protocols.vtkWebProtocol):
-    def __init__(self, decode=True):
+    def __init__(self, decode=True, encodeWorkers=frame_encoders.ENCODE_WORKERS):
         super(vtkWebPublishImageDelivery, self).__init__()
         self.trackingViews = {}
         self.lastStaleTime = 0
@@ -26,6 +30,13 @@ class vtkWebPublishImageDelivery(vtk_protocols.vtkWebProtocol):
         self.targetFrameRate = 30.0
         self.minFrameRate = 12.0
         self.maxFrameRate = 30.0
+        # Frames, bytes and seconds per encoder, see getEncoders()
+        self.encoderStats = {}
+        # Caps quality, ratio and frame rate of interactive frames to the
+        # slowest client that enabled it
+        self.controller = adaptive_quality.ClientControllers()
+        # Frames are rendered on the reactor and encoded in these threads
+        self.encoderPool = frame_encoders.EncoderPool(encodeWorkers, reactor.callFromThread)
 
 
     def pushRender(self, vId, ignoreAnimation = False):
@@ -38,6 +49,11 @@ class vtkWebPublishImageDelivery(vtk_protocols.vtkWebProtocol):
         if not ignoreAnimation and len(self.viewsInAnimations) > 0:
             return
 
+        animating = vId in self.viewsInAnimations
+        # The client is behind, render again once it caught up
+        if ignoreAnimation and animating and self.controller.congested():
+            return
+
         if "originalSize" not in self.trackingViews[vId]:
             view = self.getView(vId)
             self.trackingViews[vId]["originalSize"] = list(view.GetSize());
@@ -48,22 +64,26 @@ class vtkWebPublishImageDelivery(vtk_protocols.vtkWebProtocol):
         ratio = self.trackingViews[vId]["ratio"]
         mtime = self.trackingViews[vId]["mtime"]
         quality = self.trackingViews[vId]["quality"]
+        if self.controller.enabled and animating:
+            ratio = min(ratio, self.controller.ratio)
+            quality = min(quality, self.controller.quality)
+        # Sent again in full once the interaction ends
+        self.trackingViews[vId]["capped"] = (ratio != self.trackingViews[vId]["ratio"]
+                                             or quality != self.trackingViews[vId]["quality"])
         size = [int(s * ratio) for s in self.trackingViews[vId]["originalSize"]]
 
-        reply = self.stillRender({ "view": vId, "mtime": mtime, "quality": quality, "size": size })
+        encoder = self.trackingViews[vId].get("encoder", frame_encoders.DEFAULT_ENCODER)
+        delta = self.trackingViews[vId].get("delta")
+        (reply, encode) = self.renderFrame({ "view": vId, "mtime": mtime, "quality": quality, "size": size,
+                                             "encoder": encoder, "delta": delta, "last": self.trackingViews[vId]["last"] })
         stale = reply["stale"]
-        if reply["image"]:
-            # depending on whether the app has encoding enabled:
-            if self.decode:
-                reply["image"] = base64.standard_b64decode(reply["image"]);
-
-            reply["image"] = self.addAttachment(reply["image"]);
-            reply["format"] = "jpeg"
+        if encode:
             # save mtime for next call.
             self.trackingViews[vId]["mtime"] = reply["mtime"]
-            # echo back real ID, instead of -1 for 'active'
-            reply["id"] = vId
-            self.publish('viewport.image.push.subscription', reply)
+            # A frame of this view still waiting for a thread is replaced
+            if self.encoderPool.submit(vId, lambda: self.encodeFrame(reply, encode),
+                                       lambda reply: self.publishFrame(vId, reply)):
+                self.trackingViews[vId]["stats"]["dropped"] += 1
         if stale:
             self.lastStaleTime = time.time()
             if self.staleHandlerCount == 0:
@@ -73,6 +93,30 @@ class vtkWebPublishImageDelivery(vtk_protocols.vtkWebProtocol):
             self.lastStaleTime = 0
 
 
+    def publishFrame(self, vId, reply):
+        """
+        Publish a frame encoded by the pool, on the reactor
+        """
+        if vId not in self.trackingViews:
+            return
+        # The same as the last frame, or a delta frame without a changed tile
+        if not reply["image"]:
+            self.trackingViews[vId]["stats"]["suppressed"] += 1
+            return
+
+        self.countFrame(reply["encoder"], len(reply["image"]), reply["encodeTime"])
+        self.trackingViews[vId]["stats"]["frames"] += 1
+        if self.controller.enabled:
+            # Echoed by the client in "viewport.image.push.ack"
+            reply["localTime"] = self.controller.now()
+            self.controller.sent(reply["localTime"], len(reply["image"]), reply["encodeTime"])
+        reply["image"] = self.addAttachment(reply["image"]);
+        reply["format"] = reply["format"].split(";")[0]
+        # echo back real ID, instead of -1 for 'active'
+        reply["id"] = vId
+        self.publish('viewport.image.push.subscription', reply)
+
+
     def renderStaleImage(self, vId):
         self.staleHandlerCount -= 1
 
@@ -89,14 +133,18 @@ class vtkWebPublishImageDelivery(vtk_protocols.vtkWebProtocol):
         if len(self.viewsInAnimations) == 0:
             return
 
+        maxFrameRate = self.maxFrameRate
+        if self.controller.enabled:
+            maxFrameRate = min(maxFrameRate, self.controller.fps)
+
         nextAnimateTime = time.time() + 1.0 /  self.targetFrameRate
         for vId in self.viewsInAnimations:
             self.pushRender(vId, True)
 
         nextAnimateTime -= time.time()
 
-        if self.targetFrameRate > self.maxFrameRate:
-            self.targetFrameRate = self.maxFrameRate
+        if self.targetFrameRate > maxFrameRate:
+            self.targetFrameRate = maxFrameRate
 
         if nextAnimateTime < 0:
             if nextAnimateTime < -1.0:
@@ -105,7 +153,7 @@ class vtkWebPublishImageDelivery(vtk_protocols.vtkWebProtocol):
                 self.targetFrameRate -= 1.0
             reactor.callLater(0.001, lambda: self.animate())
         else:
-            if self.targetFrameRate < self.maxFrameRate and nextAnimateTime > 0.005:
+            if self.targetFrameRate < maxFrameRate and nextAnimateTime > 0.005:
                 self.targetFrameRate += 1.0
             reactor.callLater(nextAnimateTime, lambda: self.animate())
 
@@ -138,6 +186,12 @@ class vtkWebPublishImageDelivery(vtk_protocols.vtkWebProtocol):
         if realViewId in self.viewsInAnimations:
             self.viewsInAnimations.remove(realViewId)
 
+        # The last frame had a lower quality or ratio, the still frame has not
+        if realViewId in self.trackingViews and self.trackingViews[realViewId].get("capped"):
+            self.getApplication().InvalidateCache(sView)
+            self.trackingViews[realViewId]["last"].reset()
+            self.pushRender(realViewId, True)
+
 
     @exportRpc("viewport.image.push")
     def imagePush(self, options):
@@ -145,6 +199,10 @@ class vtkWebPublishImageDelivery(vtk_protocols.vtkWebProtocol):
         realViewId = str(self.getGlobalId(sView))
          # Make sure an image is pushed
         self.getApplication().InvalidateCache(sView)
+        if realViewId in self.trackingViews:
+            self.trackingViews[realViewId]["last"].reset()
+            if self.trackingViews[realViewId]["delta"]:
+                self.trackingViews[realViewId]["delta"].forceKeyframe()
         self.pushRender(realViewId)
 
     # Internal function since the reply[image] is not
@@ -153,6 +211,23 @@ class vtkWebPublishImageDelivery(vtk_protocols.vtkWebProtocol):
         """
         RPC Callback to render a view and obtain the rendered image.
         """
+        (reply, encode) = self.renderFrame(options)
+        if not encode:
+            reply.update(image=None, memsize=0, encodeTime=0)
+            return reply
+
+        reply = self.encodeFrame(reply, encode)
+        if self.decode and reply["image"]:
+            reply["image"] = base64.standard_b64encode(reply["image"]).decode('ascii')
+        return reply
+
+    def renderFrame(self, options):
+        """
+        Render a view, the part of stillRender() that needs the reactor.
+        Return the reply without the image and a function that returns the
+        image as bytes, None if the view did not change since options["mtime"].
+        The function encodes or decodes and is safe to call in any thread.
+        """
         beginTime = int(round(time.time() * 1000))
         view = self.getView(options["view"])
         size = view.GetSize()[0:2]
@@ -172,45 +247,94 @@ class vtkWebPublishImageDelivery(vtk_protocols.vtkWebProtocol):
             localTime = options["localTime"]
         reply = {}
         app = self.getApplication()
-        if t == 0:
-            app.InvalidateCache(view)
-        if self.decode:
-            stillRender = app.StillRenderToString
+        encoder = frame_encoders.get(options.get("encoder")) or frame_encoders.get(frame_encoders.DEFAULT_ENCODER)
+        reply["encoder"] = encoder.name
+        # A delta_frames.DeltaEncoder, the frame then carries the changed tiles
+        delta = options.get("delta")
+        # A frame_encoders.LastFrame, frames identical to the last one are dropped
+        last = options.get("last")
+        resets = last.resets if last else 0
+
+        if delta:
+            # Always renders, the tiles are compared when encoding
+            frame = frame_encoders.grabFrame(view)
+            def encode():
+                (image, reply["keyframe"], reply["rectangles"]) = delta.encode(frame, encoder, quality)
+                return image
+            reply["stale"] = False
+            reply["mtime"] = view.GetMTime()
+        elif not encoder.native or last:
+            # Always renders, the framebuffer is compared and encoded by the
+            # function, so an unchanged frame costs a hash and no encoding.
+            # The native JPEG is encoded by the pool then, not the application.
+            frame = frame_encoders.grabFrame(view)
+            def encode():
+                if last and last.unchanged(frame_encoders.framebuffer(frame), resets):
+                    return None
+                return encoder.encode(frame, quality)
+            reply["stale"] = False
+            reply["mtime"] = view.GetMTime()
         else:
-            stillRender = app.StillRenderToBuffer
-        reply_image = stillRender(view, t, quality)
-
-        # Check that we are getting image size we have set if not wait until we
-        # do. The render call will set the actual window size.
-        tries = 10;
-        while resize and list(view.GetSize()) != size \
-              and size != [0, 0] and tries > 0:
-            app.InvalidateCache(view)
+            if t == 0:
+                app.InvalidateCache(view)
+            if self.decode:
+                stillRender = app.StillRenderToString
+            else:
+                stillRender = app.StillRenderToBuffer
             reply_image = stillRender(view, t, quality)
-            tries -= 1
 
-        if not resize and options and ("clearCache" in options) and options["clearCache"]:
-            app.InvalidateCache(view)
-            reply_image = stillRender(view, t, quality)
+            # Check that we are getting image size we have set if not wait until we
+            # do. The render call will set the actual window size.
+            tries = 10;
+            while resize and list(view.GetSize()) != size \
+                  and size != [0, 0] and tries > 0:
+                app.InvalidateCache(view)
+                reply_image = stillRender(view, t, quality)
+                tries -= 1
+
+            if not resize and options and ("clearCache" in options) and options["clearCache"]:
+                app.InvalidateCache(view)
+                reply_image = stillRender(view, t, quality)
+
+            if not reply_image:
+                encode = None
+            else:
+                if not self.decode:
+                    # Convert the vtkUnsignedCharArray into a bytes object, required by Autobahn websockets.
+                    # Copied here: the application refills or reallocates the array of the view with the
+                    # next render, which may come before a thread gets to it
+                    reply_image = memoryview(reply_image).tobytes()
+                def encode():
+                    return base64.standard_b64decode(reply_image) if self.decode else reply_image
+            reply["stale"] = app.GetHasImagesBeingProcessed(view)
+            reply["mtime"] = app.GetLastStillRenderToMTime()
 
-        reply["stale"] = app.GetHasImagesBeingProcessed(view)
-        reply["mtime"] = app.GetLastStillRenderToMTime()
         reply["size"] = view.GetSize()[0:2]
-        reply["memsize"] = reply_image.GetDataSize() if reply_image else 0
-        reply["format"] = "jpeg;base64" if self.decode else "jpeg"
+        reply["format"] = ("delta+" if delta else "") + encoder.format + (";base64" if self.decode else "")
         reply["global_id"] = str(self.getGlobalId(view))
         reply["localTime"] = localTime
-        if self.decode:
-            reply["image"] = reply_image
-        else:
-            # Convert the vtkUnsignedCharArray into a bytes object, required by Autobahn websockets
-            reply["image"] = memoryview(reply_image).tobytes() if reply_image else None
 
         endTime = int(round(time.time() * 1000))
         reply["workTime"] = (endTime - beginTime)
 
+        return (reply, encode)
+
+    def encodeFrame(self, reply, encode):
+        """
+        Complete the reply of renderFrame() with its image, in any thread
+        """
+        beginTime = time.time()
+        reply["image"] = encode()
+        reply["memsize"] = len(reply["image"]) if reply["image"] else 0
+        reply["encodeTime"] = int(round((time.time() - beginTime) * 1000))
         return reply
 
+    def countFrame(self, encoder, size, encodeTime):
+        stats = self.encoderStats.setdefault(encoder, { 'frames': 0, 'bytes': 0, 'encodeTime': 0 })
+        stats['frames'] += 1
+        stats['bytes'] += size
+        stats['encodeTime'] += encodeTime
+
 
     @exportRpc("viewport.image.push.observer.add")
     def addRenderObserver(self, viewId):
@@ -228,7 +352,9 @@ class vtkWebPublishImageDelivery(vtk_protocols.vtkWebProtocol):
             tagStart = self.getApplication().AddObserver('StartInteractionEvent', startCallback)
             tagStop = self.getApplication().AddObserver('EndInteractionEvent', stopCallback)
             # TODO do we need self.getApplication().AddObserver('ResetActiveView', resetActiveView())
-            self.trackingViews[realViewId] = { 'tags': [tag, tagStart, tagStop], 'observerCount': 1, 'mtime': 0, 'enabled': True, 'quality': 100 }
+            self.trackingViews[realViewId] = { 'tags': [tag, tagStart, tagStop], 'observerCount': 1, 'mtime': 0, 'enabled': True, 'quality': 100,
+                                            'encoder': frame_encoders.DEFAULT_ENCODER, 'delta': None,
+                                            'last': frame_encoders.LastFrame(), 'stats': { 'frames': 0, 'dropped': 0, 'suppressed': 0 } }
         else:
             # There is an observer on this view already
             self.trackingViews[realViewId]['observerCount'] += 1
@@ -335,3 +461,122 @@ class vtkWebPublishImageDelivery(vtk_protocols.vtkWebProtocol):
         self.getApplication().InvalidateCache(sView)
         self.getApplication().InvokeEvent('UpdateEvent')
         return { 'result': 'success' }
+
+
+    @exportRpc("viewport.image.push.encoders")
+    def getEncoders(self):
+        """
+        The encoders a view can use, with bytes per frame and milliseconds
+        of encoding per frame of the frames sent so far.
+        """
+        encoders = []
+        for encoder in frame_encoders.available():
+            description = encoder.describe()
+            stats = self.encoderStats.get(encoder.name)
+            if stats:
+                description.update(frames=stats['frames'], bytesPerFrame=stats['bytes'] / stats['frames'],
+                                   encodeTimePerFrame=stats['encodeTime'] / stats['frames'])
+            encoders.append(description)
+        return { 'encoders': encoders, 'default': frame_encoders.DEFAULT_ENCODER }
+
+
+    @exportRpc("viewport.image.push.encoder")
+    def setViewEncoder(self, viewId, encoder):
+        sView = self.getView(viewId)
+        if not sView:
+            return { 'error': 'Unable to get view with id %s' % viewId }
+
+        realViewId = str(self.getGlobalId(sView))
+        observerInfo = None
+        if realViewId in self.trackingViews:
+            observerInfo = self.trackingViews[realViewId]
+
+        if not observerInfo:
+            return { 'error': 'Unable to find subscription for view %s' % realViewId }
+
+        if not frame_encoders.get(encoder):
+            return { 'error': 'Unknown encoder %s' % encoder }
+
+        observerInfo['encoder'] = encoder
+        # Send a frame in the new format right away
+        observerInfo['mtime'] = 0
+        observerInfo['last'].reset()
+        self.getApplication().InvalidateCache(sView)
+        self.pushRender(realViewId)
+
+        return { 'result': 'success' }
+
+
+    @exportRpc("viewport.image.push.stats")
+    def getViewStats(self, viewId):
+        """
+        Frames published, frames dropped unencoded because a newer one of
+        the view came in and frames suppressed because nothing changed
+        """
+        sView = self.getView(viewId)
+        if not sView:
+            return { 'error': 'Unable to get view with id %s' % viewId }
+
+        realViewId = str(self.getGlobalId(sView))
+        if realViewId not in self.trackingViews:
+            return { 'error': 'Unable to find subscription for view %s' % realViewId }
+
+        return dict(self.trackingViews[realViewId]['stats'])
+
+
+    @exportRpc("viewport.image.push.delta")
+    def setViewDelta(self, viewId, enabled, keyframeInterval = delta_frames.KEYFRAME_INTERVAL,
+                     tileSize = delta_frames.TILE_SIZE):
+        """
+        Publish frames of a view as the tiles that changed, see
+        delta_frames.py for the format. "viewport.image.push" sends a
+        keyframe.
+        """
+        sView = self.getView(viewId)
+        if not sView:
+            return { 'error': 'Unable to get view with id %s' % viewId }
+
+        realViewId = str(self.getGlobalId(sView))
+        observerInfo = None
+        if realViewId in self.trackingViews:
+            observerInfo = self.trackingViews[realViewId]
+
+        if not observerInfo:
+            return { 'error': 'Unable to find subscription for view %s' % realViewId }
+
+        observerInfo['delta'] = delta_frames.DeltaEncoder(tileSize, keyframeInterval) if enabled else None
+        # Start over with a keyframe, or a full frame
+        observerInfo['mtime'] = 0
+        observerInfo['last'].reset()
+        self.getApplication().InvalidateCache(sView)
+        self.pushRender(realViewId)
+
+        return { 'result': 'success' }
+
+
+    @exportRpc("viewport.image.push.adaptive")
+    def setAdaptiveQuality(self, enabled, targetLatency = adaptive_quality.DEFAULT_TARGET_LATENCY, client = None):
+        """
+        Adapt quality, ratio and frame rate of interactive frames to a
+        target latency in milliseconds. The client must then acknowledge
+        every frame with "viewport.image.push.ack". Clients of a shared
+        session pass an id of their own, like the clientID of wslink.
+        """
+        if enabled:
+            self.controller.enable(client, targetLatency)
+        else:
+            self.controller.disable(client)
+        return self.controller.describe(client)
+
+
+    @exportRpc("viewport.image.push.adaptive.get")
+    def getAdaptiveQuality(self, client = None):
+        return self.controller.describe(client)
+
+
+    @exportRpc("viewport.image.push.ack")
+    def acknowledgeFrame(self, localTime, client = None):
+        """
+        The client shows the frame published with this localTime
+        """
+        self.controller.acknowledged(client, localTime)
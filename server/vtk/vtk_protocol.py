@@ -123,3 +123,23 @@ class VtkCone(vtk_protocols.vtkWebProtocol):
 
       if 'End' in event["type"]:
         self.getApplication().InvokeEvent('EndInteractionEvent')
+
+# -------------------------------------------------------------------------
+# Levels of the volume pyramid (see volume_pyramid.py)
+# -------------------------------------------------------------------------
+
+class VtkPyramid(vtk_protocols.vtkWebProtocol):
+    def __init__(self, pyramid):
+        self.pyramid = pyramid
+
+    @exportRpc("volume.pyramid.get")
+    def getPyramid(self):
+        return self.pyramid.describe()
+
+    @exportRpc("volume.pyramid.thresholds.update")
+    def updateThresholds(self, thresholds):
+        try:
+            self.pyramid.setThresholds(thresholds)
+        except (TypeError, ValueError) as e:
+            return { 'error': str(e) }
+        return self.pyramid.describe()